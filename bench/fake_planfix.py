@@ -0,0 +1,60 @@
+# bench/fake_planfix.py
+"""Локальный стенд вебхука Planfix: принимает лиды, отвечает 200 (или 5xx с заданной долей)."""
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+
+class FakePlanfixServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_ms: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency_ms / 1000.0
+        self.error_rate = error_rate
+        self.received: List[float] = []
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/webhook"
+
+    def start(self) -> "FakePlanfixServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-planfix", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(length)
+                if server.latency:
+                    time.sleep(server.latency * random.uniform(0.7, 1.3))
+                status = 503 if server.error_rate and random.random() < server.error_rate else 200
+                if status == 200:
+                    with server.lock:
+                        server.received.append(time.time())
+                body = json.dumps({"ok": status == 200}).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
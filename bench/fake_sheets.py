@@ -0,0 +1,332 @@
+# bench/fake_sheets.py
+"""
+Локальный стенд Google Sheets API v4 для бенчмарков.
+
+Моделирует те вызовы, которые делает services/sheets.py:
+- POST /v4/spreadsheets/{id}:batchUpdate  (insertDimension, updateCells, addSheet)
+- PUT  /v4/spreadsheets/{id}/values/{range}  (values.update)
+- GET  /v4/spreadsheets/{id}/values/{range}  (values.get)
+- POST /v4/spreadsheets/{id}/values/{range}:append  (values.append, режим SHEETS_LAYOUT=append)
+- GET  /v4/spreadsheets/{id}  (список вкладок)
+- GET  /v4/spreadsheets/{id}/values:batchGet, POST /v4/spreadsheets/{id}/values:batchUpdate
+
+Задержка и доля ответов 429 (с Retry-After) настраиваются.
+GET /_bench/stats отдаёт время получения каждой строки по click_id — для расчёта лага доставки.
+"""
+import re
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, unquote, urlparse
+
+_RANGE_RE = re.compile(
+    r"^(?:'?(?P<sheet>(?:[^'!]|'')+)'?!)?(?P<c1>[A-Z]*)(?P<r1>\d*)(?::(?P<c2>[A-Z]*)(?P<r2>\d*))?$"
+)
+
+
+def _col_index(letters: str) -> int:
+    n = 0
+    for ch in letters:
+        n = n * 26 + (ord(ch) - 64)
+    return n - 1
+
+
+def _cell_value(cell: dict):
+    v = cell.get("userEnteredValue", {})
+    for key in ("stringValue", "numberValue", "boolValue"):
+        if key in v:
+            return v[key]
+    return ""
+
+
+class FakeSpreadsheet:
+    """Таблица в памяти: вкладки title -> строки (rows[0] — заголовок); первая вкладка — основная."""
+
+    def __init__(self, columns: int = 17, title: str = "Bench", gid: int = 0):
+        self.lock = threading.Lock()
+        self.main = title
+        self.tabs: Dict[str, List[list]] = {title: [[f"col{i + 1}" for i in range(columns)]]}
+        self.gids: Dict[int, str] = {gid: title}
+        self.received: Dict[str, float] = {}
+        self.messenger_updated: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+        self.throttled = 0
+
+    def count(self, name: str) -> None:
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    @property
+    def rows(self) -> List[list]:
+        return self.tabs[self.main]
+
+    def total_rows(self) -> int:
+        return sum(len(rows) - 1 for rows in self.tabs.values())
+
+    def _tab(self, sheet_id: Optional[int] = None, title: Optional[str] = None) -> List[list]:
+        if title is None:
+            title = self.gids.get(sheet_id or 0, self.main)
+        return self.tabs.setdefault(title, [[]])
+
+    @staticmethod
+    def _ensure(rows: List[list], row_idx: int) -> None:
+        while len(rows) <= row_idx:
+            rows.append([])
+
+    def _set(self, rows: List[list], row_idx: int, col_idx: int, value) -> None:
+        self._ensure(rows, row_idx)
+        row = rows[row_idx]
+        if len(row) <= col_idx:
+            row.extend([""] * (col_idx + 1 - len(row)))
+        row[col_idx] = value
+
+    def batch_update(self, body: dict) -> dict:
+        now = time.time()
+        replies = []
+        with self.lock:
+            for req in body.get("requests", []):
+                if "addSheet" in req:
+                    props = req["addSheet"].get("properties", {})
+                    title = props["title"]
+                    if title in self.tabs:
+                        raise ValueError(f'A sheet with the name "{title}" already exists.')
+                    gid = props.get("sheetId", len(self.gids) + 1)
+                    self.gids[gid] = title
+                    self.tabs[title] = [[]]
+                    replies.append({"addSheet": {"properties": {"sheetId": gid, "title": title}}})
+                    continue
+                if "insertDimension" in req:
+                    rng = req["insertDimension"]["range"]
+                    rows = self._tab(rng.get("sheetId"))
+                    start, end = rng["startIndex"], rng["endIndex"]
+                    self._ensure(rows, start - 1)
+                    rows[start:start] = [[] for _ in range(end - start)]
+                elif "updateCells" in req:
+                    uc = req["updateCells"]
+                    rows = self._tab(uc["start"].get("sheetId"))
+                    r0 = uc["start"].get("rowIndex", 0)
+                    c0 = uc["start"].get("columnIndex", 0)
+                    for i, row in enumerate(uc.get("rows", [])):
+                        for j, cell in enumerate(row.get("values", [])):
+                            self._set(rows, r0 + i, c0 + j, _cell_value(cell))
+                        cid = rows[r0 + i][0] if rows[r0 + i] and r0 + i > 0 else ""
+                        if cid:
+                            self.received.setdefault(str(cid), now)
+                replies.append({})
+        return {"spreadsheetId": "fake", "replies": replies}
+
+    def _parse_range(self, rng: str):
+        m = _RANGE_RE.match(unquote(rng))
+        if not m:
+            raise ValueError(f"bad range {rng}")
+        title = m["sheet"].replace("''", "'") if m["sheet"] else self.main
+        c1 = _col_index(m["c1"]) if m["c1"] else 0
+        if m["c2"]:
+            c2 = _col_index(m["c2"])
+        elif m["c1"] and not m["r2"]:
+            c2 = c1
+        else:
+            c2 = 10 ** 4  # целая строка ("1:1")
+        r1 = int(m["r1"]) - 1 if m["r1"] else 0
+        if m["r2"]:
+            r2 = int(m["r2"]) - 1
+        elif m["c2"] and not m["r1"]:
+            r2 = None  # вся колонка
+        else:
+            r2 = r1
+        return title, c1, c2, r1, r2
+
+    def values_get(self, rng: str) -> dict:
+        title, c1, c2, r1, r2 = self._parse_range(rng)
+        with self.lock:
+            rows = self._tab(title=title)
+            last = len(rows) - 1 if r2 is None else min(r2, len(rows) - 1)
+            values = []
+            for r in range(r1, last + 1):
+                row = rows[r][c1:c2 + 1]
+                values.append([str(v) for v in row])
+        while values and not values[-1]:
+            values.pop()
+        return {"range": unquote(rng), "majorDimension": "ROWS", "values": values}
+
+    def values_update(self, rng: str, body: dict) -> dict:
+        title, c1, _, r1, _ = self._parse_range(rng)
+        now = time.time()
+        with self.lock:
+            rows = self._tab(title=title)
+            for i, row in enumerate(body.get("values", [])):
+                for j, v in enumerate(row):
+                    self._set(rows, r1 + i, c1 + j, v)
+                    if c1 + j == 14 and rows[r1 + i]:
+                        self.messenger_updated.setdefault(str(rows[r1 + i][0]), now)
+                cid = rows[r1 + i][0] if rows[r1 + i] else ""
+                if c1 == 0 and cid:
+                    self.received.setdefault(str(cid), now)
+        return {"updatedRange": unquote(rng), "updatedRows": len(body.get("values", []))}
+
+    def values_append(self, rng: str, body: dict) -> dict:
+        title, _, _, _, _ = self._parse_range(rng)
+        now = time.time()
+        values = body.get("values", [])
+        with self.lock:
+            rows = self._tab(title=title)
+            while len(rows) > 1 and not rows[-1]:
+                rows.pop()
+            first = len(rows)
+            for row in values:
+                rows.append(list(row))
+                if row and row[0]:
+                    self.received.setdefault(str(row[0]), now)
+        quoted = "'" + title.replace("'", "''") + "'"
+        return {"updates": {"updatedRange": f"{quoted}!A{first + 1}:Z{first + len(values)}",
+                            "updatedRows": len(values)}}
+
+    def values_batch_get(self, ranges: List[str]) -> dict:
+        return {"valueRanges": [self.values_get(r) for r in ranges]}
+
+    def values_batch_update(self, body: dict) -> dict:
+        replies = [self.values_update(d["range"], d) for d in body.get("data", [])]
+        return {"totalUpdatedCells": sum(r["updatedRows"] for r in replies), "responses": replies}
+
+    def metadata(self) -> dict:
+        with self.lock:
+            return {"sheets": [{"properties": {"sheetId": gid, "title": title}} for gid, title in self.gids.items()]}
+
+
+class FakeSheetsServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_ms: float = 0.0,
+                 throttle_rate: float = 0.0, retry_after: int = 1, columns: int = 17):
+        self.sheet = FakeSpreadsheet(columns=columns)
+        self.latency = latency_ms / 1000.0
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self) -> "FakeSheetsServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-sheets", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, payload: dict, headers: Optional[dict] = None):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _body(self) -> dict:
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+            def _simulate(self, op: str) -> bool:
+                server.sheet.count(op)
+                if server.latency:
+                    time.sleep(server.latency * random.uniform(0.7, 1.3))
+                if server.throttle_rate and random.random() < server.throttle_rate:
+                    server.sheet.throttled += 1
+                    self._reply(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED",
+                                                "message": "Quota exceeded (fake)"}},
+                                {"Retry-After": str(server.retry_after)})
+                    return False
+                return True
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                if path == "/_bench/stats":
+                    with server.sheet.lock:
+                        payload = {
+                            "rows": server.sheet.total_rows(),
+                            "tabs": {t: len(r) - 1 for t, r in server.sheet.tabs.items()},
+                            "received": dict(server.sheet.received),
+                            "messenger_updated": dict(server.sheet.messenger_updated),
+                            "calls": dict(server.sheet.calls),
+                            "throttled": server.sheet.throttled,
+                        }
+                    return self._reply(200, payload)
+                if re.match(r"^/v4/spreadsheets/[^/]+/values:batchGet$", path):
+                    ranges = parse_qs(urlparse(self.path).query).get("ranges", [])
+                    if self._simulate("values.batchGet"):
+                        self._reply(200, server.sheet.values_batch_get(ranges))
+                    return
+                if re.match(r"^/v4/spreadsheets/[^/:]+$", path):
+                    if self._simulate("get"):
+                        self._reply(200, server.sheet.metadata())
+                    return
+                m = re.match(r"^/v4/spreadsheets/[^/]+/values/(.+)$", path)
+                if not m:
+                    return self._reply(404, {"error": {"code": 404, "message": path}})
+                if self._simulate("values.get"):
+                    self._reply(200, server.sheet.values_get(m.group(1)))
+
+            def do_PUT(self):
+                path = urlparse(self.path).path
+                m = re.match(r"^/v4/spreadsheets/[^/]+/values/(.+)$", path)
+                body = self._body()
+                if not m:
+                    return self._reply(404, {"error": {"code": 404, "message": path}})
+                if self._simulate("values.update"):
+                    self._reply(200, server.sheet.values_update(m.group(1), body))
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                body = self._body()
+                if re.match(r"^/v4/spreadsheets/[^/]+:batchUpdate$", path):
+                    if self._simulate("batchUpdate"):
+                        try:
+                            self._reply(200, server.sheet.batch_update(body))
+                        except ValueError as e:
+                            self._reply(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT", "message": str(e)}})
+                    return
+                if re.match(r"^/v4/spreadsheets/[^/]+/values:batchUpdate$", path):
+                    if self._simulate("values.batchUpdate"):
+                        self._reply(200, server.sheet.values_batch_update(body))
+                    return
+                m = re.match(r"^/v4/spreadsheets/[^/]+/values/(.+):append$", path)
+                if m:
+                    if self._simulate("values.append"):
+                        self._reply(200, server.sheet.values_append(m.group(1), body))
+                    return
+                self._reply(404, {"error": {"code": 404, "message": path}})
+
+        return Handler
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Fake Google Sheets v4 server")
+    ap.add_argument("--port", type=int, default=8801)
+    ap.add_argument("--latency-ms", type=float, default=80)
+    ap.add_argument("--throttle-rate", type=float, default=0.0)
+    args = ap.parse_args()
+    srv = FakeSheetsServer(port=args.port, latency_ms=args.latency_ms, throttle_rate=args.throttle_rate).start()
+    print(f"fake sheets at {srv.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        srv.stop()
@@ -0,0 +1,227 @@
+# bench/ingest_bench.py
+"""
+Сравнение быстрого пути приёма (services/ingest) со старым: модели Pydantic + getattr,
+ZoneInfo и strftime на каждое событие, os.getenv и quote() на каждую ссылку, стандартный json.
+
+1) Эквивалентность: на случайных и граничных телах (None, отсутствующие поля, приведение типов,
+   лишние поля, невалидные тела) строки и ссылки обоих путей совпадают, а ошибки валидации
+   совпадают с точностью до префикса "body" в loc. Расхождение — ненулевой код выхода.
+2) Скорость: разбор тела + сборка строки + ссылка + сериализация ответа, мкс на событие.
+
+    python -m bench.ingest_bench --cases 20000 --iterations 50000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import datetime
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+from zoneinfo import ZoneInfo
+
+os.environ.setdefault("TELEGRAM_BOT_USERNAME", "bench_bot")
+os.environ.setdefault("WHATSAPP_NUMBER", "79000000000")
+os.environ.setdefault("WHATSAPP_PREFILL_TEXT", "Здравствуйте! Номер обращения: ")
+
+from fastapi.exceptions import RequestValidationError  # noqa: E402
+from fastapi.responses import JSONResponse, ORJSONResponse  # noqa: E402
+from pydantic import ValidationError  # noqa: E402
+
+from models.event import MessengerClick, FormSubmit  # noqa: E402
+from services import ingest  # noqa: E402
+
+EVENTS = ("telegram_click", "whatsapp_click", "form_submit")
+
+
+# ── старый путь (как в main.py до services/ingest) ─────────────────────────
+def legacy_build_row(click_id, event, data, ip, city, ua, region="", country="") -> list:
+    timestamp = datetime.now(ZoneInfo("Europe/Moscow")).strftime("%d.%m.%Y %H:%M:%S")
+    page_city = getattr(data, "page_city", "") or ""
+    utm = getattr(data, "utm", None)
+    utm_source = getattr(utm, "source", "") if utm else ""
+    utm_medium = getattr(utm, "medium", "") if utm else ""
+    utm_campaign = getattr(utm, "campaign", "") if utm else ""
+    utm_content = getattr(utm, "content", "") if utm else ""
+    utm_term = getattr(utm, "term", "") if utm else ""
+    client = getattr(data, "client", None)
+    time_on_page = getattr(client, "time_on_page_ms", 0) if client else 0
+    ref = getattr(client, "referrer", "") if client else ""
+    return [click_id, timestamp, event, page_city, utm_source, utm_medium, utm_campaign, utm_content,
+            utm_term, time_on_page, ip, city, ua, ref, "", region, country]
+
+
+def legacy_link(event: str, click_id: str) -> Optional[str]:
+    if event == "telegram_click":
+        return f"https://t.me/{os.getenv('TELEGRAM_BOT_USERNAME')}?start={click_id}"
+    if event == "whatsapp_click":
+        prefill = quote(os.getenv("WHATSAPP_PREFILL_TEXT", ""))
+        return f"https://wa.me/{os.getenv('WHATSAPP_NUMBER')}?text={prefill}{click_id}"
+    return None
+
+
+def legacy_decode(raw: bytes, event: str):
+    return (FormSubmit if event == "form_submit" else MessengerClick).model_validate(json.loads(raw))
+
+
+def fast_link(event: str, click_id: str) -> Optional[str]:
+    if event == "telegram_click":
+        return ingest.tg_link(click_id)
+    if event == "whatsapp_click":
+        return ingest.wa_link(click_id)
+    return None
+
+
+# ── генератор тел ───────────────────────────────────────────────────────────
+def _maybe(rnd: random.Random, value, missing=None):
+    r = rnd.random()
+    if r < 0.1:
+        return missing
+    if r < 0.2:
+        return None
+    return value
+
+
+def random_body(rnd: random.Random, event: str) -> dict:
+    body: dict = {}
+    page_city = _maybe(rnd, rnd.choice(["moscow", "spb", "", "Казань"]), missing=...)
+    if page_city is not ...:
+        body["page_city"] = page_city
+    utm = {}
+    for f in ("source", "medium", "campaign", "content", "term"):
+        if rnd.random() < 0.85:
+            utm[f] = rnd.choice(["yandex", "cpc", f"camp-{rnd.randint(1, 9)}", "", "ёж & co"])
+    if rnd.random() < 0.1:
+        utm["term"] = None
+    if rnd.random() < 0.05:
+        utm["extra"] = "x"
+    body["utm"] = utm
+    r = rnd.random()
+    if r < 0.6:
+        client = {}
+        if rnd.random() < 0.8:
+            client["time_on_page_ms"] = rnd.choice([rnd.randint(0, 10 ** 6), None, 1500.0, "2500"])
+        if rnd.random() < 0.8:
+            client["referrer"] = rnd.choice(["https://ya.ru/", "", None])
+        body["client"] = client
+    elif r < 0.7:
+        body["client"] = None
+    if event == "form_submit" and rnd.random() < 0.97:
+        body["form"] = {"name": "Иван", "phone": f"+7900{rnd.randint(1000000, 9999999)}"}
+    if rnd.random() < 0.1:
+        body["event_key"] = f"k{rnd.randint(1, 10 ** 6)}"
+    # Невалидные тела
+    r = rnd.random()
+    if r < 0.02:
+        del body["utm"]
+    elif r < 0.04:
+        body["utm"] = "x"
+    elif r < 0.05:
+        body["client"] = {"time_on_page_ms": "abc"}
+    elif r < 0.06:
+        body["page_city"] = 42
+    return body
+
+
+# ── проверки ────────────────────────────────────────────────────────────────
+def check_equivalence(cases: int, seed: int) -> Tuple[int, int, List[str]]:
+    rnd = random.Random(seed)
+    checked = invalid = 0
+    failures: List[str] = []
+    for n in range(cases):
+        event = rnd.choice(EVENTS)
+        body = random_body(rnd, event)
+        raw = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        click_id = str(1000 + n)
+        args = ("1.2.3.4", "Москва", "ua/1.0", "Москва", "RU")
+
+        legacy_err = fast_err = None
+        try:
+            model = legacy_decode(raw, event)
+        except ValidationError as e:
+            legacy_err = e.errors(include_url=False)
+        try:
+            flat = ingest.decode_event(ingest.loads(raw), event)
+        except RequestValidationError as e:
+            fast_err = [{**err, "loc": tuple(err["loc"][1:])} for err in e.errors()]
+
+        if legacy_err is not None or fast_err is not None:
+            invalid += 1
+            if legacy_err != fast_err:
+                failures.append(f"errors differ for {body}: {legacy_err} != {fast_err}")
+            continue
+
+        # Строки собираем в одну и ту же секунду, чтобы сравнить и колонку B
+        for _ in range(3):
+            old_row = legacy_build_row(click_id, event, model, *args)
+            new_row = ingest.build_row(click_id, event, flat, *args)
+            if old_row[1] == new_row[1]:
+                break
+        if old_row != new_row:
+            failures.append(f"rows differ for {body}: {old_row} != {new_row}")
+        if legacy_link(event, click_id) != fast_link(event, click_id):
+            failures.append(f"links differ for {event} {click_id}")
+        if event == "form_submit" and (model.form.name, model.form.phone) != tuple(flat.form):
+            failures.append(f"form differs for {body}")
+        checked += 1
+    return checked, invalid, failures
+
+
+def benchmark(iterations: int, seed: int) -> dict:
+    rnd = random.Random(seed)
+    bodies = []
+    while len(bodies) < 1000:
+        event = rnd.choice(EVENTS)
+        body = {
+            "page_city": rnd.choice(["moscow", "spb"]),
+            "utm": {"source": "yandex", "medium": "cpc", "campaign": f"camp-{rnd.randint(1, 20)}",
+                    "content": "banner", "term": "hair transplant"},
+            "client": {"time_on_page_ms": rnd.randint(1000, 300000), "referrer": "https://ya.ru/"},
+        }
+        if event == "form_submit":
+            body["form"] = {"name": "Bench", "phone": "+79001234567"}
+        bodies.append((event, json.dumps(body).encode("utf-8")))
+    args = ("1.2.3.4", "Москва", "ua/1.0", "Москва", "RU")
+
+    def legacy(event, raw, click_id):
+        data = legacy_decode(raw, event)
+        legacy_build_row(click_id, event, data, *args)
+        link = legacy_link(event, click_id)
+        return JSONResponse({"ok": True, "link": link}).body
+
+    def fast(event, raw, click_id):
+        data = ingest.decode_event(ingest.loads(raw), event)
+        ingest.build_row(click_id, event, data, *args)
+        link = fast_link(event, click_id)
+        return ORJSONResponse({"ok": True, "link": link}).body
+
+    out = {}
+    for name, fn in (("legacy", legacy), ("fast", fast)):
+        started = time.perf_counter()
+        for i in range(iterations):
+            event, raw = bodies[i % len(bodies)]
+            fn(event, raw, str(1000 + i))
+        out[name] = round((time.perf_counter() - started) / iterations * 1e6, 2)
+    out["speedup"] = round(out["legacy"] / out["fast"], 2)
+    return out
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Equivalence check and micro-benchmark of the ingest fast path")
+    ap.add_argument("--cases", type=int, default=20000)
+    ap.add_argument("--iterations", type=int, default=50000)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args(argv)
+
+    checked, invalid, failures = check_equivalence(args.cases, args.seed)
+    print(f"Equivalence: {checked} valid and {invalid} invalid bodies compared, {len(failures)} mismatches")
+    for line in failures[:10]:
+        print("  " + line)
+    timings = benchmark(args.iterations, args.seed)
+    print(f"Per event, us: legacy={timings['legacy']}  fast={timings['fast']}  speedup x{timings['speedup']}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
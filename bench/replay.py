@@ -0,0 +1,353 @@
+# bench/replay.py
+"""
+Воспроизведение и дозапись захваченного трафика (services/capture.py, CAPTURE_ENABLED=1).
+
+Replay — записи всех воркеров по времени, с исходными интервалами (--speed 1), ускоренно
+(--speed 10) или без пауз (--speed max), не больше --concurrency запросов одновременно.
+Цель — работающий сервис (--target URL) или приложение в этом процессе (--in-process).
+Колбэки бота ссылаются на click_id, выданные при воспроизведении (из ответов кликов
+той же записи); ip клиента уходит в X-Forwarded-For (in-process — в scope["client"]).
+uvicorn верит X-Forwarded-For только от адресов из --forwarded-allow-ips (по умолчанию 127.0.0.1):
+цель на другом хосте без доверенного прокси видит ip машины replay, и колонки ip/geo в строках неверны.
+
+    python -m bench.replay data/capture --target http://127.0.0.1:8000 --speed 5 --concurrency 32
+    python -m bench.replay data/capture --in-process --speed max
+
+Backfill — строки событий пересобираются через main._build_common_values с исходными
+click_id и временем захвата, messenger из колбэков бота проставляется в ту же строку,
+и всё пишется в Sheets обычным путём (services/sheets) пачками по --batch-size.
+--skip-existing пропускает id, которые уже есть в листе, — повторный запуск безопасен.
+
+    python -m bench.replay data/capture --backfill --since 2025-10-01T09:00 --until 2025-10-01T13:00 --skip-existing
+"""
+import re
+import sys
+import time
+import asyncio
+import argparse
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+import httpx
+
+from bench.run import percentile, TG_ID_RE, WA_ID_RE
+from services.capture import read_records, ENDPOINTS
+
+logger = logging.getLogger("replay")
+
+CLICK_ENDPOINTS = ("telegram_click", "whatsapp_click", "form_submit")
+BOT_MESSENGER = {"bot_telegram": "telegram", "bot_whatsapp": "whatsapp"}
+# Цели, от которых uvicorn по умолчанию (--forwarded-allow-ips=127.0.0.1) принимает X-Forwarded-For
+_LOCAL_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+
+def parse_time(raw: Optional[str]) -> Optional[float]:
+    """Unix-время или ISO 8601 (без зоны — локальное время)."""
+    if not raw:
+        return None
+    try:
+        return float(raw)
+    except ValueError:
+        return datetime.fromisoformat(raw).timestamp()
+
+
+def select(paths: List[str], since: Optional[float], until: Optional[float],
+           endpoints: Optional[List[str]], limit: Optional[int]) -> Iterator[dict]:
+    n = 0
+    for rec in read_records(paths):
+        if since is not None and rec["ts"] < since:
+            continue
+        if until is not None and rec["ts"] >= until:
+            break
+        if endpoints and rec["endpoint"] not in endpoints:
+            continue
+        yield rec
+        n += 1
+        if limit and n >= limit:
+            break
+
+
+# ── replay ──────────────────────────────────────────────────────────────────
+def _client_ip_from_header(app):
+    """ASGI-обёртка для --in-process: X-Forwarded-For -> scope["client"] (request.client.host)."""
+    async def wrapped(scope, receive, send):
+        if scope["type"] == "http":
+            for name, value in scope.get("headers", []):
+                if name == b"x-forwarded-for":
+                    scope = dict(scope, client=(value.decode("latin-1").split(",")[0].strip(), 0))
+                    break
+        await app(scope, receive, send)
+    return wrapped
+
+
+class Replayer:
+    def __init__(self, client: httpx.AsyncClient, speed: Optional[float], concurrency: int):
+        self.client = client
+        self.speed = speed
+        self.concurrency = concurrency
+        # исходный click_id -> click_id при воспроизведении (None — ответ без id)
+        self.ids: Dict[str, asyncio.Future] = {}
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.max_lag = 0.0
+
+    def _expect(self, original: Optional[str]) -> None:
+        if original and original not in self.ids:
+            self.ids[original] = asyncio.get_running_loop().create_future()
+
+    def _resolve(self, original: Optional[str], new: Optional[str]) -> None:
+        fut = self.ids.get(original or "")
+        if fut is not None and not fut.done():
+            fut.set_result(new)
+
+    async def _mapped(self, original: Optional[str]) -> Optional[str]:
+        fut = self.ids.get(original or "")
+        if fut is None:
+            return None
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), 30)
+        except asyncio.TimeoutError:
+            return None
+
+    async def _request(self, rec: dict) -> Tuple[str, str, object, Optional[dict]]:
+        endpoint, body = rec["endpoint"], rec["body"]
+        if endpoint in CLICK_ENDPOINTS:
+            return "POST", f"/events/{endpoint}", body, None
+        if endpoint == "batch":
+            return "POST", "/events/batch", body["events"], None
+        msg = body.get("msg") or ""
+        original = rec.get("click_id")
+        new = await self._mapped(original)
+        if new and original:
+            # Подставляем ID, выданный при воспроизведении, на место исходного
+            msg = re.sub(rf"\b{re.escape(original)}\b", new, msg)
+        params = {"confirm": str(body["confirm"]).lower()} if body.get("confirm") is not None else None
+        return "POST", "/bot/" + BOT_MESSENGER[endpoint], {"msg": msg}, params
+
+    def _learn(self, rec: dict, resp: httpx.Response) -> None:
+        endpoint = rec["endpoint"]
+        try:
+            data = resp.json() if resp.status_code < 400 else {}
+        except ValueError:
+            data = {}
+        if endpoint == "batch":
+            results = data.get("results") or []
+            for original, res in zip(rec.get("click_ids") or [], results):
+                self._resolve(original, res.get("click_id") if isinstance(res, dict) else None)
+            for original in rec.get("click_ids") or []:
+                self._resolve(original, None)
+            return
+        new = None
+        if endpoint == "telegram_click":
+            m = TG_ID_RE.search(data.get("tg_link") or "")
+            new = m.group(1) if m else None
+        elif endpoint == "whatsapp_click":
+            m = WA_ID_RE.search(unquote(data.get("wa_link") or ""))
+            new = m.group(1) if m else None
+        self._resolve(rec.get("click_id"), new)
+
+    async def _send(self, rec: dict, sem: asyncio.Semaphore) -> None:
+        endpoint = rec["endpoint"]
+        try:
+            method, path, body, params = await self._request(rec)
+            headers = {"user-agent": rec.get("ua") or "", "x-forwarded-for": rec.get("ip") or "127.0.0.1"}
+            started = time.perf_counter()
+            resp = await self.client.request(method, path, json=body, params=params, headers=headers)
+            self.latencies[endpoint].append(time.perf_counter() - started)
+            self.statuses[endpoint][resp.status_code] += 1
+            if endpoint != "form_submit":
+                self._learn(rec, resp)
+        except Exception as e:
+            self.errors[endpoint] += 1
+            logger.debug("replay_error %s: %s", endpoint, e)
+        finally:
+            # Клик без ответа — колбэки, которые ждут его ID, уходят с исходным
+            for original in ([rec.get("click_id")] if endpoint in CLICK_ENDPOINTS else rec.get("click_ids") or []):
+                self._resolve(original, None)
+            sem.release()
+
+    async def run(self, records: Iterator[dict]) -> float:
+        sem = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        started = time.perf_counter()
+        first_ts = None
+        for rec in records:
+            if rec["endpoint"] in CLICK_ENDPOINTS:
+                self._expect(rec.get("click_id"))
+            elif rec["endpoint"] == "batch":
+                for original in rec.get("click_ids") or []:
+                    self._expect(original)
+            if self.speed is not None:
+                first_ts = rec["ts"] if first_ts is None else first_ts
+                due = (rec["ts"] - first_ts) / self.speed
+                delay = due - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    self.max_lag = max(self.max_lag, -delay)
+            await sem.acquire()
+            task = asyncio.create_task(self._send(rec, sem))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+
+    def report(self, wall: float) -> None:
+        print(f"{'endpoint':<16}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  statuses")
+        total = 0
+        for endpoint in ENDPOINTS:
+            lat = self.latencies.get(endpoint, [])
+            if not lat and not self.errors.get(endpoint):
+                continue
+            total += len(lat)
+            ms = [x * 1000 for x in lat]
+            statuses = " ".join(f"{code}:{n}" for code, n in sorted(self.statuses[endpoint].items()))
+            print(f"{endpoint:<16}{len(lat):>8}{self.errors.get(endpoint, 0):>8}"
+                  f"{percentile(ms, 50):>10.2f}{percentile(ms, 95):>10.2f}{percentile(ms, 99):>10.2f}  {statuses}")
+        print(f"\nRPS: {total / wall if wall else 0:.1f}  (requests={total}, wall={wall:.2f}s)")
+        if self.speed is not None:
+            print(f"Max lag behind schedule: {self.max_lag * 1000:.0f} ms")
+
+
+async def replay(args, records: Iterator[dict]) -> int:
+    speed = None if args.speed == "max" else float(args.speed)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    if args.in_process:
+        import main
+
+        transport = httpx.ASGITransport(app=_client_ip_from_header(main.app))
+        async with main.app.router.lifespan_context(main.app):
+            async with httpx.AsyncClient(transport=transport, base_url="http://replay", timeout=60) as client:
+                runner = Replayer(client, speed, args.concurrency)
+                wall = await runner.run(records)
+    else:
+        if urlsplit(args.target).hostname not in _LOCAL_HOSTS:
+            print("warning: the original client IP is sent as X-Forwarded-For; unless this target runs uvicorn "
+                  "with --forwarded-allow-ips covering this host (or sits behind a trusted proxy), ip and geo "
+                  "columns of replayed rows will be wrong", file=sys.stderr)
+        async with httpx.AsyncClient(base_url=args.target, limits=limits, timeout=60) as client:
+            runner = Replayer(client, speed, args.concurrency)
+            wall = await runner.run(records)
+    runner.report(wall)
+    return 1 if any(runner.errors.values()) else 0
+
+
+# ── backfill ────────────────────────────────────────────────────────────────
+def rebuild_rows(records: Iterator[dict]) -> Tuple[List[list], Dict[str, str]]:
+    """Строки листа (по первой записи каждого click_id) и messenger из колбэков бота."""
+    from main import _build_common_values
+    from services import geoip, ingest
+
+    rows: Dict[str, list] = {}
+    messengers: Dict[str, str] = {}
+    for rec in records:
+        endpoint = rec["endpoint"]
+        if endpoint in BOT_MESSENGER:
+            if rec.get("click_id"):
+                messengers[rec["click_id"]] = BOT_MESSENGER[endpoint]
+            continue
+        if endpoint == "batch":
+            items = [(ingest.decode_batch_item(item), cid) for item, cid in zip(rec["body"]["events"], rec["click_ids"])]
+        else:
+            items = [(ingest.decode_event(rec["body"], endpoint), rec["click_id"])]
+        geo = geoip.lookup(rec.get("ip") or "")
+        timestamp = datetime.fromtimestamp(rec["ts"], ingest.MOSCOW_TZ).strftime("%d.%m.%Y %H:%M:%S")
+        for data, click_id in items:
+            if not click_id or click_id in rows:
+                continue
+            values = _build_common_values(
+                click_id, data.type or endpoint, data, rec.get("ip") or "", geo.city, rec.get("ua") or "",
+                geo.region, geo.country,
+            )
+            values[1] = timestamp
+            rows[click_id] = values
+    for click_id, messenger in list(messengers.items()):
+        if click_id in rows:
+            rows[click_id][14] = messenger
+            del messengers[click_id]
+    return list(rows.values()), messengers
+
+
+async def backfill(args, records: Iterator[dict]) -> int:
+    from services.geoip import init_geoip
+    from services.redis_client import init_redis, close_redis
+    from services.sheets import append_rows_to_sheets, update_messengers_by_ids, existing_ids, close_sheets
+
+    init_redis(logger)
+    init_geoip(logger)
+    try:
+        rows, updates = rebuild_rows(records)
+        skipped = 0
+        if args.skip_existing and rows:
+            present = await existing_ids()
+            kept = [values for values in rows if values[0] not in present]
+            skipped = len(rows) - len(kept)
+            rows = kept
+        print(f"Backfill: {len(rows)} rows to write, {skipped} already in the sheet, {len(updates)} messenger updates")
+        if args.dry_run:
+            return 0
+
+        written = 0
+        for i in range(0, len(rows), args.batch_size):
+            chunk = rows[i:i + args.batch_size]
+            ok, result = await append_rows_to_sheets(chunk)
+            if not ok:
+                print(f"Write failed after {written} rows (next click_id {chunk[0][0]}): {result}")
+                print("Re-run with --skip-existing to resume.")
+                return 1
+            written += len(chunk)
+            print(f"  {written}/{len(rows)} rows")
+
+        missing = failed = 0
+        items = list(updates.items())
+        for i in range(0, len(items), args.batch_size):
+            results = await update_messengers_by_ids(dict(items[i:i + args.batch_size]))
+            for ok, res in results.values():
+                if not ok:
+                    missing += res == "ID not found"
+                    failed += res != "ID not found"
+        print(f"Done: {written} rows written, {len(updates) - missing - failed} messenger cells updated, "
+              f"{missing} ids not in the sheet, {failed} failed")
+        return 1 if failed else 0
+    finally:
+        await close_sheets()
+        await close_redis()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Replay captured traffic or backfill Sheets from a capture")
+    ap.add_argument("paths", nargs="+", help="capture files or directories")
+    mode = ap.add_mutually_exclusive_group(required=True)
+    mode.add_argument(
+        "--target",
+        help="base URL of a running instance; client IPs go in X-Forwarded-For, which uvicorn only trusts "
+             "from --forwarded-allow-ips (127.0.0.1 by default), otherwise ip/geo columns are wrong",
+    )
+    mode.add_argument("--in-process", action="store_true", help="replay against main:app in this process")
+    mode.add_argument("--backfill", action="store_true", help="rebuild rows and write them to Sheets")
+    ap.add_argument("--speed", default="1", help="1 = original pace, N = N times faster, max = no pauses")
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--since", help="unix time or ISO 8601")
+    ap.add_argument("--until", help="unix time or ISO 8601")
+    ap.add_argument("--endpoint", action="append", choices=ENDPOINTS, help="only these endpoints (repeatable)")
+    ap.add_argument("--limit", type=int, default=None)
+    ap.add_argument("--batch-size", type=int, default=2000, help="rows per Sheets write in --backfill")
+    ap.add_argument("--skip-existing", action="store_true", help="--backfill: skip ids already in the sheet")
+    ap.add_argument("--dry-run", action="store_true", help="--backfill: only count rows")
+    args = ap.parse_args(argv)
+
+    if args.speed != "max" and float(args.speed) <= 0:
+        ap.error("--speed must be positive or 'max'")
+    records = select(args.paths, parse_time(args.since), parse_time(args.until), args.endpoint, args.limit)
+    if args.backfill:
+        return asyncio.run(backfill(args, records))
+    return asyncio.run(replay(args, records))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+# bench/run.py
+"""
+Нагрузочный прогон сервиса против локальных стендов.
+
+Поднимает fake Sheets (bench/fake_sheets.py), fake Planfix (bench/fake_planfix.py)
+и fakeredis по TCP (или использует --redis host:port), запускает `uvicorn main:app`
+отдельным процессом и гоняет смешанный трафик по пяти эндпоинтам.
+Отчёт: p50/p95/p99 по каждому эндпоинту, RPS и лаг доставки строки в Sheets.
+
+    python -m bench.run --duration 30 --concurrency 64 --sheets-latency-ms 120
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote
+
+import httpx
+
+from bench.fake_sheets import FakeSheetsServer
+from bench.fake_planfix import FakePlanfixServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MIX = "telegram_click=40,whatsapp_click=30,form_submit=10,bot_telegram=10,bot_whatsapp=10"
+TG_ID_RE = re.compile(r"start=(\d+)")
+WA_ID_RE = re.compile(r"(\d+)$")
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    data = sorted(values)
+    k = (len(data) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(data) - 1)
+    return data[lo] + (data[hi] - data[lo]) * (k - lo)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def parse_mix(raw: str) -> List[Tuple[str, float]]:
+    mix = []
+    for part in raw.split(","):
+        name, _, weight = part.partition("=")
+        mix.append((name.strip(), float(weight or 1)))
+    return mix
+
+
+def start_redis(addr: Optional[str]) -> Tuple[str, int, Optional[object]]:
+    if addr:
+        host, _, port = addr.partition(":")
+        return host, int(port or 6379), None
+    from fakeredis import TcpFakeServer  # type: ignore
+
+    port = free_port()
+    server = TcpFakeServer(("127.0.0.1", port), server_type="redis")
+    threading.Thread(target=server.serve_forever, name="fake-redis", daemon=True).start()
+    return "127.0.0.1", port, server
+
+
+def event_payload(rnd: random.Random) -> dict:
+    return {
+        "page_city": rnd.choice(["moscow", "spb", "kazan", "ekb"]),
+        "utm": {
+            "source": rnd.choice(["yandex", "google", "vk"]),
+            "medium": "cpc",
+            "campaign": f"camp-{rnd.randint(1, 20)}",
+            "content": "banner",
+            "term": "hair transplant",
+        },
+        "client": {"time_on_page_ms": rnd.randint(1000, 300000), "referrer": "https://ya.ru/"},
+    }
+
+
+class LoadRunner:
+    def __init__(self, base_url: str, mix: List[Tuple[str, float]], concurrency: int, duration: float, seed: int):
+        self.base_url = base_url
+        self.names = [n for n, _ in mix]
+        self.weights = [w for _, w in mix]
+        self.concurrency = concurrency
+        self.duration = duration
+        self.rnd = random.Random(seed)
+        self.latencies: Dict[str, List[float]] = {n: [] for n in self.names}
+        self.errors: Dict[str, int] = {n: 0 for n in self.names}
+        self.issued_tg: List[str] = []
+        self.issued_wa: List[str] = []
+        self.sent_at: Dict[str, float] = {}
+
+    async def _one(self, client: httpx.AsyncClient, name: str) -> None:
+        headers = {"user-agent": f"bench/{self.rnd.randint(1, 500)}"}
+        if name == "bot_telegram":
+            if not self.issued_tg:
+                name = "telegram_click"
+            else:
+                cid = self.rnd.choice(self.issued_tg)
+                req = ("POST", "/bot/telegram", {"msg": f"/start {cid}"})
+        if name == "bot_whatsapp":
+            if not self.issued_wa:
+                name = "whatsapp_click"
+            else:
+                cid = self.rnd.choice(self.issued_wa)
+                req = ("POST", "/bot/whatsapp", {"msg": f"Здравствуйте! Номер обращения: {cid}"})
+        if name in ("telegram_click", "whatsapp_click"):
+            req = ("POST", f"/events/{name}", event_payload(self.rnd))
+        elif name == "form_submit":
+            body = event_payload(self.rnd)
+            body["form"] = {"name": "Bench", "phone": f"+7900{self.rnd.randint(1000000, 9999999)}"}
+            req = ("POST", "/events/form_submit", body)
+
+        method, path, body = req
+        started = time.perf_counter()
+        try:
+            resp = await client.request(method, path, json=body, headers=headers)
+        except Exception:
+            self.errors[name] += 1
+            return
+        elapsed = time.perf_counter() - started
+        self.latencies[name].append(elapsed)
+        # 404 на колбэк бота допустим, пока строка ещё не доехала до Sheets
+        if resp.status_code >= 500 or (resp.status_code >= 400 and not name.startswith("bot_")):
+            self.errors[name] += 1
+            return
+        if name == "telegram_click":
+            m = TG_ID_RE.search(resp.json().get("tg_link", ""))
+            if m:
+                self.issued_tg.append(m.group(1))
+                self.sent_at[m.group(1)] = time.time()
+        elif name == "whatsapp_click":
+            m = WA_ID_RE.search(unquote(resp.json().get("wa_link", "")))
+            if m:
+                self.issued_wa.append(m.group(1))
+                self.sent_at[m.group(1)] = time.time()
+
+    async def _worker(self, client: httpx.AsyncClient, deadline: float) -> None:
+        while time.perf_counter() < deadline:
+            name = self.rnd.choices(self.names, self.weights)[0]
+            await self._one(client, name)
+
+    async def run(self) -> float:
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=30) as client:
+            started = time.perf_counter()
+            deadline = started + self.duration
+            await asyncio.gather(*(self._worker(client, deadline) for _ in range(self.concurrency)))
+            return time.perf_counter() - started
+
+
+def wait_ready(url: str, timeout: float = 30.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url + "/health", timeout=1).status_code == 200:
+                return
+        except Exception:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("app did not become ready")
+
+
+def wait_delivered(sheets: FakeSheetsServer, ids: List[str], timeout: float) -> Dict[str, float]:
+    deadline = time.time() + timeout
+    while True:
+        with sheets.sheet.lock:
+            received = dict(sheets.sheet.received)
+        if all(i in received for i in ids) or time.time() > deadline:
+            return received
+        time.sleep(0.25)
+
+
+def print_report(runner: LoadRunner, wall: float, received: Dict[str, float], sheets: FakeSheetsServer,
+                 planfix: FakePlanfixServer) -> dict:
+    total = sum(len(v) for v in runner.latencies.values())
+    report = {"wall_seconds": round(wall, 2), "requests": total, "rps": round(total / wall, 1) if wall else 0.0,
+              "endpoints": {}}
+    print(f"\n{'endpoint':<16}{'count':>8}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, lat in runner.latencies.items():
+        ms = [x * 1000 for x in lat]
+        row = {"count": len(lat), "errors": runner.errors[name],
+               "p50": round(percentile(ms, 50), 2), "p95": round(percentile(ms, 95), 2),
+               "p99": round(percentile(ms, 99), 2)}
+        report["endpoints"][name] = row
+        print(f"{name:<16}{row['count']:>8}{row['errors']:>6}{row['p50']:>10}{row['p95']:>10}{row['p99']:>10}")
+
+    lags = [(received[i] - t) * 1000 for i, t in runner.sent_at.items() if i in received]
+    missing = len(runner.sent_at) - len(lags)
+    report["delivery_lag_ms"] = {"p50": round(percentile(lags, 50), 1), "p95": round(percentile(lags, 95), 1),
+                                 "p99": round(percentile(lags, 99), 1), "undelivered": missing}
+    report["sheets_calls"] = dict(sheets.sheet.calls)
+    report["sheets_throttled"] = sheets.sheet.throttled
+    report["planfix_received"] = len(planfix.received)
+    print(f"\nRPS: {report['rps']}  (requests={total}, wall={report['wall_seconds']}s)")
+    print(f"Delivery lag to Sheets, ms: {report['delivery_lag_ms']}")
+    print(f"Sheets calls: {report['sheets_calls']}  throttled: {report['sheets_throttled']}")
+    print(f"Planfix leads received: {report['planfix_received']}")
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Load test against local service stand-ins")
+    ap.add_argument("--duration", type=float, default=20)
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--mix", default=DEFAULT_MIX, help="endpoint=weight,...")
+    ap.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    ap.add_argument("--sheets-latency-ms", type=float, default=80)
+    ap.add_argument("--sheets-429-rate", type=float, default=0.0)
+    ap.add_argument("--planfix-latency-ms", type=float, default=50)
+    ap.add_argument("--planfix-error-rate", type=float, default=0.0)
+    ap.add_argument("--delivery-workers", type=int, default=0,
+                    help="run with DELIVERY_MODE=stream and N worker.py delivery processes")
+    ap.add_argument("--redis", default=None, help="host:port of a real Redis (default: fakeredis over TCP)")
+    ap.add_argument("--drain-timeout", type=float, default=30)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", dest="json_out", default=None, help="write the report as JSON to this file")
+    ap.add_argument("--env", action="append", default=[], help="extra KEY=VALUE for the app process")
+    args = ap.parse_args(argv)
+
+    sheets = FakeSheetsServer(latency_ms=args.sheets_latency_ms, throttle_rate=args.sheets_429_rate).start()
+    planfix = FakePlanfixServer(latency_ms=args.planfix_latency_ms, error_rate=args.planfix_error_rate).start()
+    redis_host, redis_port, _redis_server = start_redis(args.redis)
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    port = free_port()
+
+    env = dict(os.environ)
+    env.update({
+        "SHEETS_ID": "bench",
+        "SHEET_NAME": "Bench",
+        "SHEET_GID": "0",
+        "SHEETS_API_ENDPOINT": sheets.url,
+        "GOOGLE_SERVICE_ACCOUNT_FILE": "",
+        "PLANFIX_WEBHOOK_URL": planfix.url,
+        "REDIS_HOST": redis_host,
+        "REDIS_PORT": str(redis_port),
+        "TELEGRAM_BOT_USERNAME": "bench_bot",
+        "WHATSAPP_NUMBER": "79000000000",
+        "OUTBOX_PATH": os.path.join(workdir, "outbox.sqlite3"),
+        "EVENT_STORE_PATH": os.path.join(workdir, "events.sqlite3"),
+        "CLICK_ID_RESERVE_DIR": os.path.join(workdir, "reserve"),
+        "LOG_FILE": os.path.join(workdir, "app.log"),
+        "LOG_LEVEL_CONSOLE": "WARNING",
+        "GEOIP_DB_PATH": "",
+    })
+    for kv in args.env:
+        k, _, v = kv.partition("=")
+        env[k] = v
+    if args.delivery_workers:
+        env["DELIVERY_MODE"] = "stream"
+
+    cmd = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+           "--workers", str(args.workers), "--log-level", "warning", "--no-access-log"]
+    app = subprocess.Popen(cmd, cwd=ROOT, env=env)
+    workers = [
+        subprocess.Popen([sys.executable, "worker.py", "--consumer", f"bench-{i}"], cwd=ROOT, env=env)
+        for i in range(args.delivery_workers)
+    ]
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_ready(base_url)
+        runner = LoadRunner(base_url, parse_mix(args.mix), args.concurrency, args.duration, args.seed)
+        wall = asyncio.run(runner.run())
+        received = wait_delivered(sheets, list(runner.sent_at), args.drain_timeout)
+        report = print_report(runner, wall, received, sheets, planfix)
+        if args.json_out:
+            with open(args.json_out, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+    finally:
+        for proc in [app, *workers]:
+            proc.terminate()
+        for proc in [app, *workers]:
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        sheets.stop()
+        planfix.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
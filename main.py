@@ -11,23 +11,99 @@ logger = logging.getLogger(__name__)
 
 # ── app imports ──────────────────────────────────────────────────────────────
 import os
-from fastapi import FastAPI, HTTPException, Request, BackgroundTasks
+import hmac
+import time
+import asyncio
+from datetime import date, timedelta
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from datetime import datetime
+from fastapi.responses import JSONResponse, PlainTextResponse, ORJSONResponse
+from contextlib import asynccontextmanager
 import re
-import geoip2.database
-from urllib.parse import quote
-from typing import Union
-from zoneinfo import ZoneInfo
+from typing import List, Optional
+from pydantic import ValidationError
 
 from models.event import MessengerClick, FormSubmit, BotContact
-from services.sheets import append_row_to_sheets, update_messenger_by_id
-from services.planfix import build_planfix_payload, send_to_planfix
-from services.redis_client import init_redis, get_next_click_id
+from services.sheets import close_sheets, warm_sheets
+from services.sheets_writer import writer as sheets_writer, messenger_updates
+from services.planfix import build_planfix_payload, send_to_planfix, init_planfix, close_planfix
+from services.redis_client import (
+    init_redis, close_redis, get_next_click_id, get_next_click_ids,
+    allocator as click_id_allocator, ClickIdUnavailable,
+)
+from services.outbox import outbox
+from services.event_store import event_store
+from services.projector import projector
+from services import geoip
+from services.geoip import init_geoip
+from services import readiness, idempotency, ingest, tracing, profiler, analytics, delivery_stream
+from services.capture import capture, body_of, CAPTURE_ENABLED
+from services.ingest import FlatEvent, build_row, tg_link, wa_link
+from services.issued_ids import issued_ids, NOT_ISSUED
+from services.metrics import registry as metrics_registry, MetricsMiddleware, QUEUE_DEPTH, QUEUE_OLDEST_AGE
+from services.tracing import TracingMiddleware, span
 
 # ── FastAPI app ─────────────────────────────────────────────────────────────
-app = FastAPI(title="Data Collection API")
+async def _timed(component: str, aw) -> None:
+    """Выполняет шаг старта и логирует, сколько он занял."""
+    started = time.perf_counter()
+    try:
+        await aw
+    finally:
+        logger.info("startup_component", extra={
+            "component": component, "ms": round((time.perf_counter() - started) * 1000, 1),
+        })
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    # Независимые зависимости поднимаем параллельно; блокирующие init_* — в потоках
+    await asyncio.gather(
+        _timed("redis", asyncio.to_thread(init_redis, logger)),
+        # GeoIP (mmap, общий для воркеров через page cache)
+        _timed("geoip", asyncio.to_thread(init_geoip, logger)),
+        _timed("planfix", init_planfix()),
+        _timed("event_store", event_store.open()),
+        _timed("sheets", warm_sheets()),
+    )
+    await sheets_writer.start()
+    await messenger_updates.start()
+    # Аренда блока click_id и порог реестра выданных ID — после init_redis
+    await _timed("click_id", asyncio.gather(click_id_allocator.start(), issued_ids.start()))
+    # Всё, что не успели доставить до прошлой остановки, воркер outbox подхватит сразу после старта
+    await _timed("outbox", outbox.start())
+    # Проекция продолжает с отметки hwm, сохранённой в хранилище событий
+    # (при DELIVERY_MODE=stream она публикует в стрим, а пишут в лист воркеры worker.py)
+    await projector.start()
+    await analytics.start()
+    if CAPTURE_ENABLED:
+        capture.start()
+    readiness.mark_started()
+    logger.info("startup_complete", extra={"ms": round((time.perf_counter() - started) * 1000, 1)})
+    try:
+        yield
+    finally:
+        readiness.mark_started(False)
+        # Сначала догоняем лист и дренируем outbox (он пишет через sheets_writer), затем дописываем буфер строк
+        await projector.stop()
+        await outbox.stop()
+        await messenger_updates.stop()
+        await sheets_writer.stop()
+        await close_sheets()
+        await event_store.close()
+        await close_planfix()
+        await analytics.stop()
+        await close_redis()
+        await asyncio.to_thread(capture.stop)
+
+
+# orjson (если установлен) сериализует ответы заметно быстрее стандартного json
+app = FastAPI(
+    title="Data Collection API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse if ingest.orjson is not None else JSONResponse,
+)
 
 # CORS
 origins = [o.strip() for o in os.getenv("CORS_ORIGINS", "").split(",") if o.strip()]
@@ -38,38 +114,108 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-
-# Redis init
-init_redis(logger=logger)
-
-# GeoIP
-geoip_reader = None
-geoip_path = os.getenv("GEOIP_DB_PATH")
-if geoip_path and os.path.exists(geoip_path):
-    try:
-        geoip_reader = geoip2.database.Reader(geoip_path)
-        logger.info(f"GeoIP DB loaded: {geoip_path}")
-    except Exception as e:
-        logger.warning(f"GeoIP load failed: path={geoip_path} err={e}")
-else:
-    logger.info("GeoIP disabled or file not found")
-
-
-def get_city_by_ip(ip: str) -> str:
-    if not geoip_reader:
-        return ""
-    try:
-        resp = geoip_reader.city(ip)
-        return resp.city.name or ""
-    except Exception:
-        return ""
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 
 
 @app.get("/health")
 def health_check():
+    """Liveness: процесс жив и обслуживает запросы. Готовность к трафику — /ready."""
     logger.debug("health_check")
     return {"status": "ok"}
 
+@app.get("/ready")
+async def ready_check():
+    """Readiness: Redis, Sheets, GeoIP и очереди доставки; 503, пока воркер не готов принимать клики."""
+    result = await readiness.check_ready()
+    return JSONResponse(result, status_code=200 if result["ready"] else 503)
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики процесса в текстовом формате Prometheus (каждый воркер отдаёт свои)."""
+    for kind in ("sheets", "planfix"):
+        QUEUE_DEPTH.set(0, kind)
+        QUEUE_OLDEST_AGE.set(0, kind)
+    for kind, (depth, age) in (await outbox.stats()).items():
+        QUEUE_DEPTH.set(depth, kind)
+        QUEUE_OLDEST_AGE.set(age, kind)
+    for name, (depth, age) in (await event_store.projection_lag(projector.projections())).items():
+        QUEUE_DEPTH.set(depth, name)
+        QUEUE_OLDEST_AGE.set(age, name)
+    if delivery_stream.STREAM_DELIVERY:
+        try:
+            for name, (depth, age) in (await delivery_stream.stats()).items():
+                QUEUE_DEPTH.set(depth, name)
+                QUEUE_OLDEST_AGE.set(age, name)
+        except Exception as e:
+            logger.warning("delivery_stream_stats_failed", extra={"error": str(e)})
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+# ========== Администрирование ==========
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+def _require_admin(request: Request) -> None:
+    # Без ADMIN_TOKEN админ-эндпоинтов как будто нет
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+
+@app.post("/admin/profile")
+async def admin_profile(request: Request, seconds: float = 30, format: str = "collapsed"):
+    """
+    Снимает профиль воркера, принявшего запрос, на seconds секунд (без рестарта).
+    format=collapsed — сэмплы стеков для flamegraph, format=pstats — cProfile event loop.
+    Ответ сразу: путь к файлу, который появится по окончании. 409 — профиль уже идёт.
+    """
+    _require_admin(request)
+    try:
+        return {"ok": True, **profiler.start(seconds, format)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except profiler.ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+# ========== Аналитика конверсий ==========
+ANALYTICS_TOKEN = os.getenv("ANALYTICS_TOKEN", "")
+
+
+@app.get("/analytics/conversions")
+async def analytics_conversions(
+    request: Request,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    page_city: Optional[str] = None,
+    utm_source: Optional[str] = None,
+    utm_campaign: Optional[str] = None,
+    event: Optional[str] = None,
+    group_by: str = ",".join(analytics.DIMENSIONS),
+):
+    """
+    Клики, формы и подтверждённые контакты по дням (Москва) × page_city × utm_source × utm_campaign × event
+    из счётчиков в Redis, без обращения к Google Sheets. По умолчанию — последние 7 дней.
+    group_by — измерения через запятую (остальные суммируются). ANALYTICS_TOKEN задан — нужен X-Analytics-Token.
+    """
+    if ANALYTICS_TOKEN and not hmac.compare_digest(request.headers.get("x-analytics-token", ""), ANALYTICS_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid analytics token")
+    date_to = date_to or analytics.today()
+    date_from = date_from or date_to - timedelta(days=6)
+    if date_from > date_to:
+        raise HTTPException(status_code=400, detail="date_from is after date_to")
+    if (date_to - date_from).days >= analytics.ANALYTICS_MAX_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail=f"Range is longer than {analytics.ANALYTICS_MAX_RANGE_DAYS} days")
+    dims = [d.strip() for d in group_by.split(",") if d.strip()]
+    unknown = [d for d in dims if d not in analytics.DIMENSIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown group_by dimension: {', '.join(unknown)}")
+    filters = {"page_city": page_city, "utm_source": utm_source, "utm_campaign": utm_campaign, "event": event}
+    try:
+        return await analytics.conversions(date_from, date_to, filters, dims)
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
 # ========== Поиск click_id в тексте ==========
 # Ищем целое число длиной >= 4 символов (наш ID начиная с 1000),
 # Берём ПОСЛЕДНЕЕ совпадение в строке — мы добавляем ID в конец prefill.
@@ -83,130 +229,182 @@ def extract_click_id_from_text(text: str) -> str | None:
         return None
     return ids[-1]
 
+
+async def resolve_click_id_from_text(text: str) -> str | None:
+    """
+    Как extract_click_id_from_text, но из всех чисел в тексте выбирает реально выданный ID
+    (кусок телефона или другое число не перехватывает последнюю позицию). None — ни одно не выдавалось.
+    """
+    return await issued_ids.pick(INT_CLICK_ID_RE.findall(text or ""))
+
 def _build_common_values(
     click_id: str,
     event: str,
-    data: Union[MessengerClick, FormSubmit],
+    data: FlatEvent,
     ip: str,
     city: str,
-    ua: str
+    ua: str,
+    region: str = "",
+    country: str = "",
 ) -> list:
     """
-    Универсальная сборка строки данных для Google Sheets.
+    Универсальная сборка строки данных для Google Sheets (см. services/ingest.build_row).
+    """
+    return build_row(click_id, event, data, ip, city, ua, region, country)
+
+
+async def append_row_bg(item: dict) -> bool:
+    """
+    Обработчик outbox для kind="sheets": строка уходит в общий буфер sheets_writer.
+    Новые события пишутся в хранилище событий и попадают в лист через проекцию;
+    обработчик остаётся, чтобы дослать строки, поставленные в outbox до этого.
     """
-    timestamp = datetime.now(ZoneInfo("Europe/Moscow")).strftime("%d.%m.%Y %H:%M:%S")
-    page_city = getattr(data, "page_city", "") or ""
-    utm = getattr(data, "utm", None)
-    utm_source = getattr(utm, "source", "") if utm else ""
-    utm_medium = getattr(utm, "medium", "") if utm else ""
-    utm_campaign = getattr(utm, "campaign", "") if utm else ""
-    utm_content = getattr(utm, "content", "") if utm else ""
-    utm_term = getattr(utm, "term", "") if utm else ""
-
-    client = getattr(data, "client", None)
-    time_on_page = getattr(client, "time_on_page_ms", 0) if client else 0
-    ref = getattr(client, "referrer", "") if client else ""
-
-    values = [
-        click_id,          # A id
-        timestamp,         # B timestamp
-        event,             # C event
-        page_city,         # D page_city
-        utm_source,        # E utm_source
-        utm_medium,        # F utm_medium
-        utm_campaign,      # G utm_campaign
-        utm_content,       # H utm_content
-        utm_term,          # I utm_term
-        time_on_page,      # J time_on_page_ms
-        ip,                # K ip
-        city,              # L geo_city
-        ua,                # M user_agent
-        ref,               # N referrer
-        "",                # O messenger (заполняется позже ботом)
-    ]
-    return values
-
-
-def append_row_bg(values: list, click_id: str, event: str):
+    values, click_id, event = item["values"], item["click_id"], item["event"]
+    # При GEOIP_ENRICH_AT=delivery гео заполняется здесь, вне пути запроса
+    values = geoip.enrich_row(values)
     try:
-        success, result = append_row_to_sheets(values)
+        # Ждём результат той пачки, в которую попала строка
+        success, result = await sheets_writer.submit(values, click_id, event)
         if success:
             logger.info("sheets_append_ok (bg)", extra={"click_id": click_id, "event": event})
         else:
             logger.error("sheets_append_fail (bg)", extra={"click_id": click_id, "event": event, "error": str(result)})
+        return success
     except Exception:
         logger.exception("sheets_append_exception (bg)", extra={"click_id": click_id, "event": event})
+        return False
+
+
+async def send_to_planfix_bg(item: dict) -> bool:
+    """Обработчик outbox для kind="planfix"; при DELIVERY_MODE=stream лид уходит в стрим воркеров доставки."""
+    if delivery_stream.STREAM_DELIVERY:
+        return await delivery_stream.publish_planfix(item["payload"])
+    return await send_to_planfix(item["payload"])
+
+
+outbox.register_handler("sheets", append_row_bg)
+outbox.register_handler("planfix", send_to_planfix_bg)
+
+
+async def _store_events(rows: List[list]) -> None:
+    """Событие сохраняется локально (система записи); в Google Sheets его дошлёт проекция."""
+    await asyncio.gather(event_store.put_many(rows), issued_ids.mark([values[0] for values in rows]))
+    analytics.record_events(rows)
+    projector.notify()
 
 
 # ========== 1) Telegram click endpoint (redirect) ==========
-@app.post("/events/telegram_click")
-async def telegram_click(data: MessengerClick, request: Request, background_tasks: BackgroundTasks):
+@app.post("/events/telegram_click", openapi_extra=ingest.openapi_body(MessengerClick))
+async def telegram_click(request: Request):
     """
     Логирует клик на Telegram, добавляет строку в Google Sheet и возвращает RedirectResponse на t.me?start=<id>
+    Повтор в окне идемпотентности получает ту же ссылку без новой записи.
     """
+    with span("decode"):
+        data = await ingest.read_event(request, "telegram_click")
+    key = idempotency.event_key(request, "telegram_click", data, request.client.host, request.headers.get("user-agent", ""))
+    return await idempotency.once(key, lambda: _telegram_click(data, request))
+
+
+async def _telegram_click(data: FlatEvent, request: Request):
     ip = request.client.host
-    city = get_city_by_ip(ip)
+    geo = geoip.lookup_on_request(ip)
     ua = request.headers.get("user-agent", "")
 
-    # Генерируем атомарный integer ID (строкой)
-    click_id = get_next_click_id()  # мягкий фолбэк на UUID, если Redis недоступен
+    # Уникальный integer ID (строкой): из арендованного блока, без Redis — из локального резерва
+    try:
+        with span("click_id"):
+            click_id = await get_next_click_id()
+    except ClickIdUnavailable:
+        logger.error("click_id_unavailable", extra={"event": "telegram_click"})
+        return JSONResponse(status_code=503, content={"ok": False, "error": "click_id unavailable"})
+    tracing.set_click_id(click_id)
     logger.info("telegram_click", extra={"click_id": click_id, "page_city": data.page_city, "ip": ip})
 
-    values = _build_common_values(click_id, "telegram_click", data, ip, city, ua)
-    background_tasks.add_task(append_row_bg, values, click_id, "telegram_click")
+    with span("build_row"):
+        values = _build_common_values(click_id, "telegram_click", data, ip, geo.city, ua, geo.region, geo.country)
+    with span("store"):
+        await _store_events([values])
+    capture.record("telegram_click", body_of(data), ip, ua, click_id)
 
-    BOT_USERNAME = os.getenv("TELEGRAM_BOT_USERNAME")
-    if not BOT_USERNAME:
+    link = tg_link(click_id)
+    if not link:
         logger.error("telegram_username_missing")
         return JSONResponse(status_code=500, content={"ok": False, "error": "TELEGRAM_BOT_USERNAME not set"})
 
-    tg_link = f"https://t.me/{BOT_USERNAME}?start={click_id}"
-    logger.info("telegram_link_built", extra={"click_id": click_id, "tg_link": tg_link})
+    logger.info("telegram_link_built", extra={"click_id": click_id, "tg_link": link})
 
-    return {"ok": True, "tg_link": tg_link}
+    return {"ok": True, "tg_link": link}
 
 
 # ========== 2) WhatsApp click endpoint (return wa.me link with prefilled text) ==========
-@app.post("/events/whatsapp_click")
-async def whatsapp_click(data: MessengerClick, request: Request, background_tasks: BackgroundTasks):
+@app.post("/events/whatsapp_click", openapi_extra=ingest.openapi_body(MessengerClick))
+async def whatsapp_click(request: Request):
     """
     Логирует клик, сохраняет строку в таблицу и возвращает JSON с готовой ссылкой на WhatsApp.
+    Повтор в окне идемпотентности получает ту же ссылку без новой записи.
     """
+    with span("decode"):
+        data = await ingest.read_event(request, "whatsapp_click")
+    key = idempotency.event_key(request, "whatsapp_click", data, request.client.host, request.headers.get("user-agent", ""))
+    return await idempotency.once(key, lambda: _whatsapp_click(data, request))
+
+
+async def _whatsapp_click(data: FlatEvent, request: Request):
     ip = request.client.host
-    city = get_city_by_ip(ip)
+    geo = geoip.lookup_on_request(ip)
     ua = request.headers.get("user-agent", "")
 
-    click_id = get_next_click_id()
+    try:
+        with span("click_id"):
+            click_id = await get_next_click_id()
+    except ClickIdUnavailable:
+        logger.error("click_id_unavailable", extra={"event": "whatsapp_click"})
+        return JSONResponse(status_code=503, content={"ok": False, "error": "click_id unavailable"})
+    tracing.set_click_id(click_id)
     logger.info("whatsapp_click", extra={"click_id": click_id, "page_city": data.page_city, "ip": ip})
 
-    values = _build_common_values(click_id, "whatsapp_click", data, ip, city, ua)
-    background_tasks.add_task(append_row_bg, values, click_id, "whatsapp_click")
+    with span("build_row"):
+        values = _build_common_values(click_id, "whatsapp_click", data, ip, geo.city, ua, geo.region, geo.country)
+    with span("store"):
+        await _store_events([values])
+    capture.record("whatsapp_click", body_of(data), ip, ua, click_id)
 
-    WHATSAPP_NUMBER = os.getenv("WHATSAPP_NUMBER")
-    if not WHATSAPP_NUMBER:
+    # Префикс ссылки (номер + закодированный prefill) собран один раз при импорте
+    link = wa_link(click_id)
+    if not link:
         logger.error("whatsapp_number_missing")
         return JSONResponse(status_code=500, content={"ok": False, "error": "WHATSAPP_NUMBER not set"})
 
-    PREFILL = quote(os.getenv("WHATSAPP_PREFILL_TEXT", ""))
-    prefilled_text = f"{PREFILL}{click_id}"
-
-    wa_link = f"https://wa.me/{WHATSAPP_NUMBER}?text={prefilled_text}"
-
-    logger.info("whatsapp_link_built", extra={"click_id": click_id, "wa_link": wa_link})
-    return {"ok": True, "wa_link": wa_link}
+    logger.info("whatsapp_link_built", extra={"click_id": click_id, "wa_link": link})
+    return {"ok": True, "wa_link": link}
 
 
 # ========== 3) Form submit endpoint ==========
-@app.post("/events/form_submit")
-async def form_submit(data: FormSubmit, request: Request, background_tasks: BackgroundTasks):
+@app.post("/events/form_submit", openapi_extra=ingest.openapi_body(FormSubmit))
+async def form_submit(request: Request):
     """
     Обработка отправки формы: сохраняет данные, записывает в Planfix и в Google Sheets.
+    Повторная отправка той же формы в окне идемпотентности не создаёт второй лид.
     """
+    with span("decode"):
+        data = await ingest.read_event(request, "form_submit")
+    key = idempotency.event_key(request, "form_submit", data, request.client.host, request.headers.get("user-agent", ""))
+    return await idempotency.once(key, lambda: _form_submit(data, request))
+
+
+async def _form_submit(data: FlatEvent, request: Request):
     ip = request.client.host
-    city = get_city_by_ip(ip)
+    geo = geoip.lookup_on_request(ip)
     ua = request.headers.get("user-agent", "")
 
-    click_id = get_next_click_id()
+    try:
+        with span("click_id"):
+            click_id = await get_next_click_id()
+    except ClickIdUnavailable:
+        logger.error("click_id_unavailable", extra={"event": "form_submit"})
+        return JSONResponse(status_code=503, content={"ok": False, "error": "click_id unavailable"})
+    tracing.set_click_id(click_id)
     logger.info(
         "form_submit",
         extra={
@@ -217,8 +415,9 @@ async def form_submit(data: FormSubmit, request: Request, background_tasks: Back
         }
     )
 
-    values = _build_common_values(click_id, "form_submit", data, ip, city, ua)
-    background_tasks.add_task(append_row_bg, values, click_id, "form_submit")
+    with span("build_row"):
+        values = _build_common_values(click_id, "form_submit", data, ip, geo.city, ua, geo.region, geo.country)
+    writes = [_store_events([values])]
 
     if data.form:
         payload = build_planfix_payload(
@@ -226,15 +425,152 @@ async def form_submit(data: FormSubmit, request: Request, background_tasks: Back
             phone=data.form.phone,
             page_city=data.page_city or "",
         )
-        background_tasks.add_task(send_to_planfix, payload)
+        writes.append(outbox.put("planfix", {"payload": payload, "click_id": click_id}))
+
+    # Событие и лид фиксируются на диске параллельно; отвечаем после обоих коммитов
+    with span("store"):
+        await asyncio.gather(*writes)
+    capture.record("form_submit", body_of(data), ip, ua, click_id)
+    if data.form:
         logger.info("planfix_enqueued", extra={"click_id": click_id, "form_name": data.form.name})
 
     return {"ok": True}
 
 
+# ========== 3b) Пачка событий с лендинга (совместимо с navigator.sendBeacon) ==========
+BATCH_MAX_EVENTS = int(os.getenv("BATCH_MAX_EVENTS", "100"))
+
+
+@app.post("/events/batch")
+async def events_batch(request: Request):
+    """
+    Принимает массив событий telegram_click / whatsapp_click / form_submit (поле type).
+    Тело читаем сами: sendBeacon шлёт его как text/plain. Все click_id выделяются одной арендой,
+    все строки ложатся в хранилище событий, а лиды в outbox — по одной транзакции. Результаты — в порядке входа.
+    """
+    try:
+        raw = ingest.loads(await request.body() or b"null")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be JSON")
+    events = raw.get("events") if isinstance(raw, dict) else raw
+    if not isinstance(events, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array of events")
+    if len(events) > BATCH_MAX_EVENTS:
+        raise HTTPException(status_code=413, detail=f"Too many events (max {BATCH_MAX_EVENTS})")
+
+    results: List[dict] = [{} for _ in events]
+    valid = []
+    with span("decode"):
+        for i, item in enumerate(events):
+            try:
+                valid.append((i, ingest.decode_batch_item(item)))
+            except ValidationError as e:
+                results[i] = {"ok": False, "error": "validation error", "detail": e.errors(include_url=False, include_context=False)}
+
+    ip = request.client.host
+    ua = request.headers.get("user-agent", "")
+
+    # Идемпотентность по каждому событию: повторы получают первый результат без записи.
+    # Одинаковые события внутри пачки обрабатываются один раз.
+    first_of: dict = {}
+    duplicates: List[tuple] = []
+    keyed = []
+    for i, data in valid:
+        key = idempotency.item_key(data.type, data, ip, ua)
+        if key is not None and key in first_of:
+            duplicates.append((i, first_of[key]))
+            continue
+        if key is not None:
+            first_of[key] = i
+        keyed.append((i, data, key))
+    with span("idempotency"):
+        stored = await idempotency.claim_many([key for _, _, key in keyed])
+    fresh = []
+    for (i, data, key), prev in zip(keyed, stored):
+        if prev is None:
+            fresh.append((i, data, key))
+        elif prev.get("in_progress"):
+            results[i] = {"ok": False, "error": "duplicate request in progress"}
+        else:
+            results[i] = {"event": data.type, **prev["body"], "replayed": True}
+
+    if fresh:
+        try:
+            with span("click_id"):
+                click_ids = await get_next_click_ids(len(fresh))
+        except ClickIdUnavailable:
+            await idempotency.release_many([key for _, _, key in fresh if key])
+            logger.error("click_id_unavailable", extra={"event": "batch", "count": len(fresh)})
+            return JSONResponse(status_code=503, content={"ok": False, "error": "click_id unavailable"})
+
+        # Все события пачки пришли с одного IP — один lookup на пачку
+        geo = geoip.lookup_on_request(ip)
+        tracing.set_click_id(click_ids[0] if len(click_ids) == 1 else f"{click_ids[0]}..{click_ids[-1]}")
+
+        rows, items = [], []
+        for (i, data, _), click_id in zip(fresh, click_ids):
+            event = data.type
+            logger.info(event, extra={"click_id": click_id, "page_city": data.page_city, "ip": ip, "batch": True})
+            values = _build_common_values(click_id, event, data, ip, geo.city, ua, geo.region, geo.country)
+            rows.append(values)
+            result = {"ok": True, "event": event, "click_id": click_id}
+
+            if event == "telegram_click":
+                result["tg_link"] = tg_link(click_id)
+                if not result["tg_link"]:
+                    result.update(ok=False, error="TELEGRAM_BOT_USERNAME not set")
+            elif event == "whatsapp_click":
+                result["wa_link"] = wa_link(click_id)
+                if not result["wa_link"]:
+                    result.update(ok=False, error="WHATSAPP_NUMBER not set")
+            elif data.form:
+                payload = build_planfix_payload(
+                    name=data.form.name,
+                    phone=data.form.phone,
+                    page_city=data.page_city or "",
+                )
+                items.append(("planfix", {"payload": payload, "click_id": click_id}))
+            results[i] = result
+
+        try:
+            with span("store"):
+                await asyncio.gather(_store_events(rows), outbox.put_many(items))
+        except BaseException:
+            await idempotency.release_many([key for _, _, key in fresh if key])
+            raise
+        capture.record(
+            "batch", {"events": [{"type": data.type, **body_of(data)} for _, data, _ in fresh]}, ip, ua, click_ids,
+        )
+        await idempotency.complete_many({
+            key: {"status": 200, "body": results[i]} for i, _, key in fresh if key and results[i]["ok"]
+        })
+        await idempotency.release_many([key for i, _, key in fresh if key and not results[i]["ok"]])
+
+    for i, first in duplicates:
+        results[i] = {**results[first], "replayed": True} if results[first].get("ok") else results[first]
+
+    logger.info("events_batch", extra={"count": len(events), "accepted": len(valid)})
+    return {"ok": True, "results": results}
+
+
+# ========== Колбэки бота ==========
+# async — событие не из локального хранилища ставится в очередь обновлений листа, ответ 202 сразу;
+# sync — ждём записи в лист (404, если id там нет). ?confirm=true|false переопределяет режим для запроса.
+BOT_CONFIRM_MODE = os.getenv("BOT_CONFIRM_MODE", "async").lower()
+
+
+def _confirm_required(confirm: Optional[bool]) -> bool:
+    return BOT_CONFIRM_MODE == "sync" if confirm is None else confirm
+
+
 # ========== 4) Endpoint для Planfix, который присылает текст с /start <id> ==========
 @app.post("/bot/telegram")
-async def bot_telegram(body: BotContact):
+async def bot_telegram(body: BotContact, request: Request, confirm: Optional[bool] = None):
+    # Повторная доставка того же колбэка не трогает ни хранилище, ни лист
+    return await idempotency.once(idempotency.bot_key("telegram", body.msg or "", _confirm_required(confirm)), lambda: _bot_telegram(body, confirm, request))
+
+
+async def _bot_telegram(body: BotContact, confirm: Optional[bool], request: Request):
     # ожидаем "/start <id>"
     parts = (body.msg or "").split()
     if len(parts) < 2:
@@ -242,7 +578,30 @@ async def bot_telegram(body: BotContact):
         raise HTTPException(status_code=400, detail="Bad payload: expected '/start <id>'")
 
     click_id = parts[1]
-    ok, res = update_messenger_by_id(click_id, "telegram")
+    tracing.set_click_id(click_id)
+    capture.record("bot_telegram", {"msg": body.msg, "confirm": confirm}, request.client.host, request.headers.get("user-agent", ""), click_id)
+    # Невыданный ID отклоняем сразу — без хранилища и поиска по листу
+    if await issued_ids.check(click_id) == NOT_ISSUED:
+        logger.warning("bot_telegram_id_not_issued", extra={"click_id": click_id})
+        raise HTTPException(status_code=404, detail="ID not found")
+
+    # Событие есть в локальном хранилище — обновляем его там, в лист изменение дошлёт проекция
+    with span("event_store.set_messenger"):
+        updated = await event_store.set_messenger(click_id, "telegram")
+    if updated:
+        projector.notify()
+        analytics.record_contacts([click_id])
+        logger.info("bot_telegram_updated", extra={"click_id": click_id, "messenger": "telegram"})
+        return {"ok": True, "detail": "updated"}
+
+    # Событие старше хранилища — есть только в листе: обновление уходит в общий values.batchUpdate
+    pending = messenger_updates.submit(click_id, "telegram")
+    if not _confirm_required(confirm):
+        logger.info("bot_telegram_queued", extra={"click_id": click_id, "messenger": "telegram"})
+        return JSONResponse(status_code=202, content={"ok": True, "detail": "queued"})
+
+    with span("sheets.messenger_update"):
+        ok, res = await pending
     if not ok:
         if res == "ID not found":
             logger.warning("bot_telegram_id_not_found", extra={"click_id": click_id})
@@ -256,19 +615,42 @@ async def bot_telegram(body: BotContact):
 
 # ========== 5) Endpoint для Planfix, который присылает текст с ?text=... ==========
 @app.post("/bot/whatsapp")
-async def bot_whatsapp(body: BotContact):
+async def bot_whatsapp(body: BotContact, request: Request, confirm: Optional[bool] = None):
+    return await idempotency.once(idempotency.bot_key("whatsapp", body.msg or "", _confirm_required(confirm)), lambda: _bot_whatsapp(body, confirm, request))
+
+
+async def _bot_whatsapp(body: BotContact, confirm: Optional[bool], request: Request):
     # ожидаем текст пользователя, где есть click_id (целое число длиной >=4)
     text = (body.msg or "").strip()
     if not text:
         logger.warning("bot_whatsapp_empty_payload", extra={"body": body.dict()})
         raise HTTPException(status_code=400, detail="Empty payload")
 
-    click_id = extract_click_id_from_text(text)
-    if not click_id:
+    if not extract_click_id_from_text(text):
         logger.warning("bot_whatsapp_no_id", extra={"text": text})
         raise HTTPException(status_code=400, detail="click_id not found in text")
-
-    ok, res = update_messenger_by_id(click_id, "whatsapp")
+    click_id = await resolve_click_id_from_text(text)
+    if not click_id:
+        logger.warning("bot_whatsapp_id_not_issued", extra={"text": text})
+        raise HTTPException(status_code=404, detail="ID not found")
+    tracing.set_click_id(click_id)
+    capture.record("bot_whatsapp", {"msg": body.msg, "confirm": confirm}, request.client.host, request.headers.get("user-agent", ""), click_id)
+
+    with span("event_store.set_messenger"):
+        updated = await event_store.set_messenger(click_id, "whatsapp")
+    if updated:
+        projector.notify()
+        analytics.record_contacts([click_id])
+        logger.info("bot_whatsapp_updated", extra={"click_id": click_id, "text": text})
+        return {"ok": True, "detail": "updated"}
+
+    pending = messenger_updates.submit(click_id, "whatsapp")
+    if not _confirm_required(confirm):
+        logger.info("bot_whatsapp_queued", extra={"click_id": click_id, "text": text})
+        return JSONResponse(status_code=202, content={"ok": True, "detail": "queued"})
+
+    with span("sheets.messenger_update"):
+        ok, res = await pending
     if not ok:
         if res == "ID not found":
             logger.warning("bot_whatsapp_id_not_found", extra={"click_id": click_id, "text": text})
@@ -1,6 +1,6 @@
 # models/event.py
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import Annotated, Literal, Optional, Union
 
 class UTM(BaseModel):
     source: str = ""
@@ -22,6 +22,8 @@ class MessengerClick(BaseModel):
     page_city: Optional[str] = ""
     utm: UTM
     client: Optional[ClientInfo] = ClientInfo()
+    # Ключ идемпотентности от клиента (иначе — отпечаток запроса)
+    event_key: Optional[str] = None
 
 # ─── Событие отправки формы ───
 class FormSubmit(BaseModel):
@@ -29,7 +31,17 @@ class FormSubmit(BaseModel):
     utm: UTM
     client: Optional[ClientInfo] = ClientInfo()
     form: FormData
+    event_key: Optional[str] = None
 
 # ─── Контакт от бота ───
 class BotContact(BaseModel):
     msg: str
+
+# ─── Элементы пачки /events/batch (тип события задаётся полем type) ───
+class BatchMessengerClick(MessengerClick):
+    type: Literal["telegram_click", "whatsapp_click"]
+
+class BatchFormSubmit(FormSubmit):
+    type: Literal["form_submit"]
+
+BatchEvent = Annotated[Union[BatchMessengerClick, BatchFormSubmit], Field(discriminator="type")]
@@ -0,0 +1,278 @@
+# services/analytics.py
+"""
+Агрегаты конверсии, которые ведутся при записи (без чтения Google Sheets).
+
+Redis-хеш на день (по Москве) conv:<YYYY-MM-DD>, поле — "page_city\\tutm_source\\tutm_campaign\\tevent\\tметрика":
+- clicks   — клики telegram_click / whatsapp_click;
+- forms    — отправки форм;
+- contacts — подтверждённые контакты: колбэк бота успешно проставил messenger.
+
+Контакт относится к дню и измерениям клика: при записи клика его измерения кладутся
+в conv:c:<click_id> (TTL ANALYTICS_ATTRIBUTION_DAYS), а первый успешный колбэк забирает
+ключ атомарно (GET + DEL в MULTI) — повторные колбэки и второй мессенджер контакт не удваивают.
+Контакт может прийти раньше, чем другой воркер сбросит ключ своего клика: такой контакт
+повторяется ANALYTICS_CONTACT_RETRIES сбросов, а не сопоставленный и после них — учитывается
+в analytics_contacts_dropped_total.
+
+Приращения и подтверждённые контакты копятся в памяти процесса и уходят в Redis раз
+в ANALYTICS_FLUSH_INTERVAL_MS (не отдельным походом на каждый запрос); без Redis — ждут следующего сброса.
+"""
+import os
+import asyncio
+import logging
+from collections import Counter
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from services.ingest import MOSCOW_TZ
+from services.metrics import registry, track
+from services.redis_client import get_aredis
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_ENABLED = os.getenv("ANALYTICS_ENABLED", "1") not in ("0", "false", "no")
+ANALYTICS_KEY_PREFIX = os.getenv("ANALYTICS_KEY_PREFIX", "conv:")
+ANALYTICS_RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", "400"))
+# Сколько дней после клика контакт ещё засчитывается этому клику
+ANALYTICS_ATTRIBUTION_DAYS = int(os.getenv("ANALYTICS_ATTRIBUTION_DAYS", "30"))
+ANALYTICS_MAX_RANGE_DAYS = int(os.getenv("ANALYTICS_MAX_RANGE_DAYS", "366"))
+ANALYTICS_FLUSH_INTERVAL_MS = int(os.getenv("ANALYTICS_FLUSH_INTERVAL_MS", "500"))
+# Потолок приращений, копящихся в памяти без Redis
+ANALYTICS_PENDING_MAX = int(os.getenv("ANALYTICS_PENDING_MAX", "100000"))
+# Сколько сбросов ждём ключ атрибуции клика, ещё не сброшенный другим воркером
+ANALYTICS_CONTACT_RETRIES = int(os.getenv("ANALYTICS_CONTACT_RETRIES", "20"))
+
+DIMENSIONS = ("day", "page_city", "utm_source", "utm_campaign", "event")
+METRICS = ("clicks", "forms", "contacts")
+CLICK_EVENTS = ("telegram_click", "whatsapp_click")
+
+# Колонки строки из main._build_common_values (0-based)
+_COL_TIMESTAMP, _COL_EVENT, _COL_PAGE_CITY, _COL_UTM_SOURCE, _COL_UTM_CAMPAIGN = 1, 2, 3, 4, 6
+
+# (день, поле) -> приращение, ещё не записанное в Redis
+_unsynced: Counter = Counter()
+# click_id -> "день\tизмерения" кликов, ещё не записанных в Redis
+_attributions: Dict[str, str] = {}
+# click_id подтверждённых контактов, ещё не сопоставленных с кликом -> оставшиеся попытки
+_contacts: Dict[str, int] = {}
+_task: Optional[asyncio.Task] = None
+
+CONTACTS_DROPPED = registry.counter(
+    "analytics_contacts_dropped_total", "Confirmed contacts never matched to a click attribution"
+)
+
+
+def _clean(value) -> str:
+    return str(value or "").replace("\t", " ")
+
+
+def _day_of(timestamp: str) -> str:
+    """"dd.mm.YYYY HH:MM:SS" (колонка B) -> "YYYY-MM-DD"."""
+    d, m, y = timestamp[:10].split(".")
+    return f"{y}-{m}-{d}"
+
+
+def _dims(values: list) -> Tuple[str, str]:
+    """(день, "page_city\\tutm_source\\tutm_campaign\\tevent") строки события."""
+    return _day_of(str(values[_COL_TIMESTAMP])), "\t".join(
+        _clean(values[i]) for i in (_COL_PAGE_CITY, _COL_UTM_SOURCE, _COL_UTM_CAMPAIGN, _COL_EVENT)
+    )
+
+
+def _day_key(day: str) -> str:
+    return f"{ANALYTICS_KEY_PREFIX}{day}"
+
+
+def _click_key(click_id: str) -> str:
+    return f"{ANALYTICS_KEY_PREFIX}c:{click_id}"
+
+
+def today() -> date:
+    return datetime.now(MOSCOW_TZ).date()
+
+
+async def _resolve_contacts(r) -> None:
+    """
+    Забирает ключи атрибуции накопленных контактов (GET + DEL в MULTI) и считает их.
+    Контакты без ключа остаются до следующего сброса, пока не кончатся попытки.
+    """
+    global _contacts
+    pending, _contacts = _contacts, {}
+    ids = list(pending)
+    try:
+        pipe = r.pipeline(transaction=True)
+        for click_id in ids:
+            pipe.get(_click_key(click_id))
+            pipe.delete(_click_key(click_id))
+        with track("redis", "analytics_contact"):
+            res = await pipe.execute()
+    except Exception as e:
+        _contacts = {**dict(list(pending.items())[:ANALYTICS_PENDING_MAX]), **_contacts}
+        logger.warning("analytics_redis_error", extra={"op": "contact", "error": str(e), "pending": len(ids)})
+        return
+    dropped = 0
+    for click_id, raw in zip(ids, res[0::2]):
+        if raw:
+            raw = raw.decode() if isinstance(raw, bytes) else raw
+            day, dims = raw.split("\t", 1)
+            _unsynced[(day, f"{dims}\tcontacts")] += 1
+        elif pending[click_id] > 1:
+            _contacts.setdefault(click_id, pending[click_id] - 1)
+        else:
+            dropped += 1
+    if dropped:
+        CONTACTS_DROPPED.inc(amount=dropped)
+        logger.info("analytics_contacts_dropped", extra={"count": dropped})
+
+
+async def flush() -> None:
+    """Сопоставляет контакты и пишет накопленные приращения и ключи атрибуции; при ошибке — оставляет их в памяти."""
+    global _unsynced, _attributions
+    r = get_aredis()
+    if r is None:
+        _keep(_unsynced)
+        return
+    # Ключи атрибуции кликов пишем раньше, чем забираем ключи контактов
+    todo, attributions = _unsynced, _attributions
+    _unsynced, _attributions = Counter(), {}
+    try:
+        if todo or attributions:
+            pipe = r.pipeline(transaction=False)
+            for (day, field), n in todo.items():
+                pipe.hincrby(_day_key(day), field, n)
+            for day in {day for day, _ in todo}:
+                pipe.expire(_day_key(day), ANALYTICS_RETENTION_DAYS * 86400)
+            for click_id, dims in attributions.items():
+                pipe.set(_click_key(click_id), dims, ex=ANALYTICS_ATTRIBUTION_DAYS * 86400)
+            with track("redis", "analytics_incr"):
+                await pipe.execute()
+    except Exception as e:
+        _keep(todo + _unsynced)
+        _attributions = {**attributions, **_attributions}
+        logger.warning("analytics_redis_error", extra={"op": "incr", "error": str(e), "pending": len(todo)})
+        return
+    if _contacts:
+        await _resolve_contacts(r)
+
+
+async def _run() -> None:
+    while True:
+        await asyncio.sleep(ANALYTICS_FLUSH_INTERVAL_MS / 1000)
+        await flush()
+
+
+async def start() -> None:
+    global _task
+    if ANALYTICS_ENABLED and _task is None:
+        _task = asyncio.create_task(_run(), name="analytics-flush")
+
+
+async def stop() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+    # Второй сброс дописывает контакты, сопоставленные первым
+    await flush()
+    await flush()
+
+
+def _keep(todo: Counter) -> None:
+    global _unsynced, _attributions
+    if len(_attributions) > ANALYTICS_PENDING_MAX:
+        _attributions = dict(list(_attributions.items())[-ANALYTICS_PENDING_MAX:])
+    if len(todo) > ANALYTICS_PENDING_MAX:
+        logger.warning("analytics_pending_dropped", extra={"fields": len(todo) - ANALYTICS_PENDING_MAX})
+        todo = Counter(dict(list(todo.items())[:ANALYTICS_PENDING_MAX]))
+    _unsynced = todo
+
+
+def record_events(rows: Iterable[list]) -> None:
+    """Клики и формы из только что сохранённых строк событий (в Redis — со следующим сбросом)."""
+    if not ANALYTICS_ENABLED:
+        return
+    for values in rows:
+        event = values[_COL_EVENT]
+        if event in CLICK_EVENTS:
+            metric = "clicks"
+        elif event == "form_submit":
+            metric = "forms"
+        else:
+            continue
+        day, dims = _dims(values)
+        _unsynced[(day, f"{dims}\t{metric}")] += 1
+        if metric == "clicks":
+            _attributions[str(values[0])] = f"{day}\t{dims}"
+
+
+def record_contacts(click_ids: Iterable[str]) -> None:
+    """Подтверждённые контакты (в Redis — со следующим сбросом); каждый клик засчитывается не больше раза."""
+    if not ANALYTICS_ENABLED:
+        return
+    for click_id in click_ids:
+        dims = _attributions.pop(click_id, None)
+        if dims is not None:
+            # Клик этого воркера, ещё не сброшенный в Redis
+            day, dims = dims.split("\t", 1)
+            _unsynced[(day, f"{dims}\tcontacts")] += 1
+        elif len(_contacts) < ANALYTICS_PENDING_MAX:
+            _contacts.setdefault(click_id, ANALYTICS_CONTACT_RETRIES)
+
+
+def _days(date_from: date, date_to: date) -> List[str]:
+    return [(date_from + timedelta(days=i)).isoformat() for i in range((date_to - date_from).days + 1)]
+
+
+async def conversions(
+    date_from: date,
+    date_to: date,
+    filters: Optional[Dict[str, str]] = None,
+    group_by: Sequence[str] = DIMENSIONS,
+) -> Dict[str, object]:
+    """
+    Строки {измерения group_by..., clicks, forms, contacts, contact_rate} за дни [date_from, date_to].
+    filters — точное совпадение по page_city / utm_source / utm_campaign / event.
+    RuntimeError — Redis недоступен.
+    """
+    r = get_aredis()
+    if r is None:
+        raise RuntimeError("redis unavailable")
+    days = _days(date_from, date_to)
+    pipe = r.pipeline(transaction=False)
+    for day in days:
+        pipe.hgetall(_day_key(day))
+    with track("redis", "analytics_query"):
+        hashes = await pipe.execute()
+
+    filters = {k: v for k, v in (filters or {}).items() if v is not None}
+    groups: Dict[tuple, Counter] = {}
+    totals: Counter = Counter()
+    for day, fields in zip(days, hashes):
+        for field, n in fields.items():
+            field = field.decode() if isinstance(field, bytes) else field
+            page_city, utm_source, utm_campaign, event, metric = field.split("\t")
+            row = {"day": day, "page_city": page_city, "utm_source": utm_source,
+                   "utm_campaign": utm_campaign, "event": event}
+            if any(row[k] != v for k, v in filters.items()):
+                continue
+            key = tuple(row[d] for d in group_by)
+            groups.setdefault(key, Counter())[metric] += int(n)
+            totals[metric] += int(n)
+
+    def with_rate(counts: Counter) -> dict:
+        out = {m: counts.get(m, 0) for m in METRICS}
+        out["contact_rate"] = round(out["contacts"] / out["clicks"], 4) if out["clicks"] else None
+        return out
+
+    rows = [{**dict(zip(group_by, key)), **with_rate(counts)} for key, counts in sorted(groups.items())]
+    return {
+        "date_from": date_from.isoformat(),
+        "date_to": date_to.isoformat(),
+        "group_by": list(group_by),
+        "rows": rows,
+        "totals": with_rate(totals),
+    }
@@ -0,0 +1,212 @@
+# services/capture.py
+"""
+Запись принятых событий для воспроизведения и дозаписи (bench/replay.py).
+
+При CAPTURE_ENABLED=1 хендлеры пяти эндпоинтов (и /events/batch) после валидации и записи
+события отдают сюда тело в форме модели, ip, user-agent и выданный click_id. Запись — JSONL
+в gzip-файлах CAPTURE_DIR/capture-<pid>-<время>-<n>.jsonl.gz; файл закрывается и начинается
+новый по размеру (CAPTURE_ROTATE_MB несжатых данных) или возрасту (CAPTURE_ROTATE_SECONDS),
+хранятся последние CAPTURE_KEEP_FILES файлов. Сериализует и сжимает фоновый поток;
+при переполнении очереди запись отбрасывается (capture_dropped_total), запрос не ждёт.
+
+Формат строки:
+    {"ts": 1760000000.123, "endpoint": "telegram_click", "ip": "...", "ua": "...",
+     "click_id": "1000", "body": {...}}
+у /events/batch вместо click_id — click_ids (по порядку body["events"]),
+у колбэков бота body = {"msg": ..., "confirm": ...}.
+"""
+import os
+import glob
+import gzip
+import json
+import time
+import heapq
+import queue
+import logging
+import threading
+from typing import Iterable, Iterator, List, Optional
+
+from services.ingest import FlatEvent
+from services.metrics import registry
+
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_ENABLED = os.getenv("CAPTURE_ENABLED", "0") == "1"
+CAPTURE_DIR = os.getenv("CAPTURE_DIR", "./data/capture")
+CAPTURE_ROTATE_MB = float(os.getenv("CAPTURE_ROTATE_MB", "64"))
+CAPTURE_ROTATE_SECONDS = float(os.getenv("CAPTURE_ROTATE_SECONDS", "3600"))
+CAPTURE_KEEP_FILES = int(os.getenv("CAPTURE_KEEP_FILES", "168"))
+CAPTURE_QUEUE_SIZE = int(os.getenv("CAPTURE_QUEUE_SIZE", "10000"))
+# Как часто недописанный блок gzip сбрасывается на диск (файл читается до последнего сброса)
+CAPTURE_FLUSH_SECONDS = float(os.getenv("CAPTURE_FLUSH_SECONDS", "1"))
+
+ENDPOINTS = ("telegram_click", "whatsapp_click", "form_submit", "batch", "bot_telegram", "bot_whatsapp")
+
+CAPTURED = registry.counter("capture_records_total", "Captured requests", ("endpoint",))
+DROPPED = registry.counter("capture_dropped_total", "Captured requests dropped on a full queue")
+
+
+def _dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def body_of(data: FlatEvent) -> dict:
+    """Тело запроса в форме модели (MessengerClick / FormSubmit / элемент пачки) из FlatEvent."""
+    body = {
+        "page_city": data.page_city,
+        "utm": {
+            "source": data.utm_source, "medium": data.utm_medium, "campaign": data.utm_campaign,
+            "content": data.utm_content, "term": data.utm_term,
+        },
+        "client": {"time_on_page_ms": data.time_on_page_ms, "referrer": data.referrer},
+    }
+    if data.form is not None:
+        body["form"] = {"name": data.form.name, "phone": data.form.phone}
+    if data.event_key is not None:
+        body["event_key"] = data.event_key
+    return body
+
+
+class CaptureWriter:
+    def __init__(self, directory: str = CAPTURE_DIR):
+        self.directory = directory
+        self._queue: "queue.Queue" = queue.Queue(maxsize=CAPTURE_QUEUE_SIZE)
+        self._thread: Optional[threading.Thread] = None
+        self._file = None
+        self._path: Optional[str] = None
+        self._opened = 0.0
+        self._written = 0
+        self._seq = 0
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="capture-writer", daemon=True)
+        self._thread.start()
+        logger.info("capture_started", extra={"dir": self.directory})
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Дописывает очередь и закрывает текущий файл."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def record(self, endpoint: str, body: dict, ip: str, ua: str, click_id=None) -> None:
+        if self._thread is None:
+            return
+        rec = {"ts": round(time.time(), 3), "endpoint": endpoint, "ip": ip, "ua": ua}
+        if isinstance(click_id, list):
+            rec["click_ids"] = click_id
+        else:
+            rec["click_id"] = click_id
+        rec["body"] = body
+        try:
+            self._queue.put_nowait(rec)
+        except queue.Full:
+            DROPPED.inc()
+            return
+        CAPTURED.inc(endpoint)
+
+    # ── фоновый поток ────────────────────────────────────────────────────────
+    def _run(self) -> None:
+        last_flush = time.monotonic()
+        while True:
+            try:
+                rec = self._queue.get(timeout=CAPTURE_FLUSH_SECONDS)
+            except queue.Empty:
+                rec = ...
+            if rec is None:
+                break
+            try:
+                if rec is not ...:
+                    self._write(_dumps(rec) + b"\n")
+                if self._file is not None and time.monotonic() - last_flush >= CAPTURE_FLUSH_SECONDS:
+                    self._file.flush()
+                    last_flush = time.monotonic()
+            except Exception as e:
+                logger.error("capture_write_failed", extra={"path": self._path, "error": str(e)})
+                self._close()
+        self._close()
+
+    def _write(self, line: bytes) -> None:
+        if self._file is not None and (
+            self._written >= CAPTURE_ROTATE_MB * 1024 * 1024
+            or time.time() - self._opened >= CAPTURE_ROTATE_SECONDS
+        ):
+            self._close()
+        if self._file is None:
+            self._open()
+        self._file.write(line)
+        self._written += len(line)
+
+    def _open(self) -> None:
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        self._seq += 1
+        self._path = os.path.join(self.directory, f"capture-{os.getpid()}-{stamp}-{self._seq:04d}.jsonl.gz")
+        self._file = gzip.open(self._path, "wb")
+        self._opened = time.time()
+        self._written = 0
+        self._prune()
+
+    def _close(self) -> None:
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+        except Exception:
+            pass
+        self._file = None
+
+    def _prune(self) -> None:
+        files = sorted(glob.glob(os.path.join(self.directory, "capture-*.jsonl.gz")), key=os.path.getmtime)
+        for path in files[:-CAPTURE_KEEP_FILES] if CAPTURE_KEEP_FILES > 0 else []:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+capture = CaptureWriter()
+
+
+# ── чтение ──────────────────────────────────────────────────────────────────
+def capture_files(paths: Iterable[str]) -> List[str]:
+    """Файлы захвата: пути к файлам и каталоги (берутся все capture-*.jsonl.gz)."""
+    out = []
+    for path in paths:
+        if os.path.isdir(path):
+            out.extend(sorted(glob.glob(os.path.join(path, "capture-*.jsonl.gz"))))
+        else:
+            out.append(path)
+    return out
+
+
+def _read_file(path: str) -> Iterator[dict]:
+    opener = gzip.open if path.endswith(".gz") else open
+    try:
+        with opener(path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # Строка, оборванная при падении процесса
+                        logger.warning("capture_bad_line", extra={"path": path})
+    except (EOFError, gzip.BadGzipFile) as e:
+        # Файл пишется сейчас или процесс упал: читаем до последнего сброшенного блока
+        logger.warning("capture_truncated", extra={"path": path, "error": str(e)})
+
+
+def read_records(paths: Iterable[str]) -> Iterator[dict]:
+    """Записи из всех файлов (всех воркеров) в порядке времени."""
+    return heapq.merge(*(_read_file(p) for p in capture_files(paths)), key=lambda rec: rec["ts"])
@@ -0,0 +1,276 @@
+# services/delivery_stream.py
+"""
+Доставка в Sheets и Planfix отдельными воркерами (worker.py) через Redis Stream.
+
+При DELIVERY_MODE=stream воркер uvicorn только принимает события: они, как и раньше,
+сначала ложатся в хранилище событий, а проекция (services/projector) вместо записи в лист
+публикует их в стрим DELIVERY_STREAM_KEY и двигает отметку hwm после XADD. Лиды Planfix
+публикует обработчик outbox. Так публикация не стоит на пути запроса, а при недоступном
+Redis события ждут в хранилище / outbox, как раньше ждали Sheets.
+
+Сообщение стрима: {"kind": "row" | "messenger" | "planfix", "data": JSON}
+- row       — строка события (values), в лист пишется пачкой по шардам;
+- messenger — [click_id, messenger] для колонки O, пачкой values.batchUpdate;
+- planfix   — payload лида.
+
+Воркеры читают стрим в группе DELIVERY_STREAM_GROUP (XREADGROUP), подтверждают (XACK + XDEL)
+только доставленное. Сообщения, которые висят неподтверждёнными дольше
+DELIVERY_CLAIM_IDLE_MS (воркер упал или доставка не удалась), забирает себе любой живой
+воркер (XAUTOCLAIM); после DELIVERY_MAX_ATTEMPTS попыток сообщение уходит в DELIVERY_DEAD_KEY.
+Семантика — at-least-once, как у outbox.
+"""
+import os
+import json
+import time
+import socket
+import asyncio
+import logging
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from services import geoip, sheet_shards
+from services.metrics import DELIVERIES, DELIVERY_RETRIES, track
+from services.planfix import send_to_planfix
+from services.redis_client import get_aredis
+from services.sheets import append_rows_to_sheets, update_messengers_by_ids
+
+logger = logging.getLogger(__name__)
+
+# local — доставка в процессе uvicorn (проекция и outbox); stream — воркеры worker.py
+DELIVERY_MODE = os.getenv("DELIVERY_MODE", "local").lower()
+STREAM_DELIVERY = DELIVERY_MODE == "stream"
+
+DELIVERY_STREAM_KEY = os.getenv("DELIVERY_STREAM_KEY", "delivery:stream")
+DELIVERY_STREAM_GROUP = os.getenv("DELIVERY_STREAM_GROUP", "delivery")
+DELIVERY_DEAD_KEY = os.getenv("DELIVERY_DEAD_KEY", "delivery:dead")
+DELIVERY_BATCH_SIZE = int(os.getenv("DELIVERY_BATCH_SIZE", "200"))
+# Ожидание новых сообщений в XREADGROUP; меньше таймаута сокета Redis-клиента (1 с)
+DELIVERY_BLOCK_MS = int(os.getenv("DELIVERY_BLOCK_MS", "500"))
+DELIVERY_CLAIM_IDLE_MS = int(os.getenv("DELIVERY_CLAIM_IDLE_MS", "60000"))
+DELIVERY_CLAIM_INTERVAL = float(os.getenv("DELIVERY_CLAIM_INTERVAL", "10"))
+DELIVERY_MAX_ATTEMPTS = int(os.getenv("DELIVERY_MAX_ATTEMPTS", "10"))
+# Потребители без pending, молчащие дольше этого (с), удаляются из группы
+DELIVERY_CONSUMER_TTL = float(os.getenv("DELIVERY_CONSUMER_TTL", "3600"))
+DELIVERY_BACKOFF_MAX = float(os.getenv("DELIVERY_BACKOFF_MAX", "30"))
+
+ROW, MESSENGER, PLANFIX = "row", "messenger", "planfix"
+
+
+# ── публикация (процесс uvicorn) ────────────────────────────────────────────
+async def publish(items: Iterable[Tuple[str, object]]) -> int:
+    """XADD пачки сообщений (kind, data) одним pipeline; исключение — ничего не гарантировано."""
+    r = get_aredis()
+    if r is None:
+        raise RuntimeError("redis unavailable")
+    pipe = r.pipeline(transaction=False)
+    n = 0
+    for kind, data in items:
+        pipe.xadd(DELIVERY_STREAM_KEY, {"kind": kind, "data": json.dumps(data, ensure_ascii=False)})
+        n += 1
+    if n:
+        with track("redis", "stream_publish"):
+            await pipe.execute()
+    return n
+
+
+async def publish_rows(rows: List[list]) -> None:
+    await publish((ROW, values) for values in rows)
+
+
+async def publish_messengers(updates: Dict[str, str]) -> None:
+    await publish((MESSENGER, [click_id, messenger]) for click_id, messenger in updates.items())
+
+
+async def publish_planfix(payload: dict) -> bool:
+    """Для обработчика outbox: True — лид в стриме, False — outbox повторит позже."""
+    try:
+        await publish([(PLANFIX, payload)])
+        return True
+    except Exception as e:
+        logger.warning("delivery_stream_publish_failed", extra={"kind": PLANFIX, "error": str(e)})
+        return False
+
+
+async def stats() -> Dict[str, Tuple[int, float]]:
+    """{"stream": (недоставленных сообщений, возраст самого старого в секундах)} для /ready и /metrics."""
+    r = get_aredis()
+    if r is None:
+        return {}
+    pipe = r.pipeline(transaction=False)
+    pipe.xlen(DELIVERY_STREAM_KEY)
+    pipe.xrange(DELIVERY_STREAM_KEY, count=1)
+    with track("redis", "stream_stats"):
+        depth, first = await pipe.execute()
+    # Подтверждённые сообщения удаляются (XDEL), так что в стриме — только недоставленное
+    age = max(0.0, time.time() - int(first[0][0].split("-")[0]) / 1000) if first else 0.0
+    return {"stream": (depth, age)}
+
+
+# ── потребитель (worker.py) ─────────────────────────────────────────────────
+class DeliveryConsumer:
+    """
+    Потребитель группы DELIVERY_STREAM_GROUP: читает пачку, доставляет её батчевыми путями
+    (append_rows_to_sheets по шардам, update_messengers_by_ids, send_to_planfix) и подтверждает
+    доставленное. Раз в DELIVERY_CLAIM_INTERVAL забирает зависшие сообщения других потребителей.
+    """
+
+    def __init__(self, name: Optional[str] = None):
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.stats: Counter = Counter()
+        self._closing = False
+        self._failures = 0
+        self._group_ready = False
+
+    def stop(self) -> None:
+        """Цикл завершится после текущей пачки."""
+        self._closing = True
+
+    async def run(self) -> None:
+        next_claim = 0.0
+        logger.info("delivery_consumer_started", extra={"consumer": self.name, "stream": DELIVERY_STREAM_KEY})
+        while not self._closing:
+            try:
+                r = get_aredis()
+                if r is None:
+                    raise RuntimeError("redis unavailable")
+                await self._ensure_group(r)
+                if time.monotonic() >= next_claim:
+                    await self._reclaim(r)
+                    next_claim = time.monotonic() + DELIVERY_CLAIM_INTERVAL
+                res = await r.xreadgroup(
+                    DELIVERY_STREAM_GROUP, self.name, {DELIVERY_STREAM_KEY: ">"},
+                    count=DELIVERY_BATCH_SIZE, block=DELIVERY_BLOCK_MS,
+                )
+                for _, messages in res or []:
+                    await self._handle(r, messages)
+                self._failures = 0
+            except Exception:
+                logger.exception("delivery_consumer_error", extra={"consumer": self.name})
+                self._failures += 1
+                await asyncio.sleep(min(DELIVERY_BACKOFF_MAX, 2 ** (self._failures - 1)))
+        logger.info("delivery_consumer_stopped", extra={"consumer": self.name, **self.stats})
+
+    async def _ensure_group(self, r) -> None:
+        if self._group_ready:
+            return
+        try:
+            # id=0: всё, что опубликовано до первого воркера, тоже будет доставлено
+            await r.xgroup_create(DELIVERY_STREAM_KEY, DELIVERY_STREAM_GROUP, id="0", mkstream=True)
+        except Exception as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_ready = True
+
+    async def _handle(self, r, messages: List[Tuple[str, dict]]) -> None:
+        rows: Dict[str, List[Tuple[str, list]]] = {}
+        messengers: List[Tuple[str, str, str]] = []
+        leads: List[Tuple[str, dict]] = []
+        broken: List[str] = []
+        for mid, fields in messages:
+            try:
+                kind, data = fields["kind"], json.loads(fields["data"])
+            except (KeyError, ValueError):
+                broken.append(mid)
+                continue
+            if kind == ROW:
+                # При GEOIP_ENRICH_AT=delivery гео заполняется здесь
+                values = geoip.enrich_row(data)
+                rows.setdefault(sheet_shards.shard_for_row(values), []).append((mid, values))
+            elif kind == MESSENGER:
+                messengers.append((mid, data[0], data[1]))
+            elif kind == PLANFIX:
+                leads.append((mid, data))
+            else:
+                broken.append(mid)
+        if broken:
+            logger.error("delivery_stream_bad_message", extra={"ids": broken})
+            await self._dead_letter(r, broken)
+
+        parts = await asyncio.gather(
+            *(self._rows(shard, items) for shard, items in rows.items()),
+            self._planfix(leads),
+        )
+        # Обновления — после строк: строка и её messenger часто приходят в одной пачке
+        done = [mid for part in parts for mid in part] + await self._messengers(messengers)
+        if done:
+            pipe = r.pipeline(transaction=False)
+            pipe.xack(DELIVERY_STREAM_KEY, DELIVERY_STREAM_GROUP, *done)
+            pipe.xdel(DELIVERY_STREAM_KEY, *done)
+            with track("redis", "stream_ack"):
+                await pipe.execute()
+        self.stats["delivered"] += len(done)
+        self.stats["failed"] += len(messages) - len(done) - len(broken)
+
+    async def _rows(self, shard: str, items: List[Tuple[str, list]]) -> List[str]:
+        ok, result = await append_rows_to_sheets([values for _, values in items], shard=shard)
+        DELIVERIES.inc("sheets", "ok" if ok else "fail", amount=len(items))
+        if not ok:
+            DELIVERY_RETRIES.inc("sheets", amount=len(items))
+            logger.error("delivery_rows_failed", extra={"shard": shard, "rows": len(items), "error": str(result)})
+            return []
+        return [mid for mid, _ in items]
+
+    async def _messengers(self, items: List[Tuple[str, str, str]]) -> List[str]:
+        if not items:
+            return []
+        # Несколько обновлений одной ячейки схлопываем — в лист уходит последнее значение
+        latest = {click_id: messenger for _, click_id, messenger in items}
+        results = await update_messengers_by_ids(latest)
+        # "ID not found" не подтверждаем: строку может ещё писать другой воркер — повторим после XAUTOCLAIM
+        return [mid for mid, click_id, _ in items if results.get(click_id, (False, None))[0]]
+
+    async def _planfix(self, items: List[Tuple[str, dict]]) -> List[str]:
+        if not items:
+            return []
+        results = await asyncio.gather(*(send_to_planfix(payload) for _, payload in items), return_exceptions=True)
+        for ok in results:
+            DELIVERIES.inc("planfix", "ok" if ok is True else "fail")
+            if ok is not True:
+                DELIVERY_RETRIES.inc("planfix")
+        return [mid for (mid, _), ok in zip(items, results) if ok is True]
+
+    async def _reclaim(self, r) -> None:
+        """Зависшие сообщения: исчерпавшие попытки — в DELIVERY_DEAD_KEY, остальные — себе и доставить."""
+        pending = await r.xpending_range(
+            DELIVERY_STREAM_KEY, DELIVERY_STREAM_GROUP, min="-", max="+",
+            count=DELIVERY_BATCH_SIZE, idle=DELIVERY_CLAIM_IDLE_MS,
+        )
+        dead = [p["message_id"] for p in pending if p["times_delivered"] >= DELIVERY_MAX_ATTEMPTS]
+        if dead:
+            await self._dead_letter(r, dead)
+
+        reply = await r.xautoclaim(
+            DELIVERY_STREAM_KEY, DELIVERY_STREAM_GROUP, self.name,
+            min_idle_time=DELIVERY_CLAIM_IDLE_MS, start_id="0-0", count=DELIVERY_BATCH_SIZE,
+        )
+        # Redis 6.2 отвечает [next, messages], Redis 7 добавляет третьим элементом удалённые id
+        messages = reply[1]
+        deleted = reply[2] if len(reply) > 2 else []
+        if deleted:
+            # Записи уже нет в стриме — подтверждаем, чтобы не висели в pending
+            await r.xack(DELIVERY_STREAM_KEY, DELIVERY_STREAM_GROUP, *deleted)
+        if messages:
+            logger.warning("delivery_stream_reclaimed", extra={"consumer": self.name, "messages": len(messages)})
+            self.stats["reclaimed"] += len(messages)
+            await self._handle(r, messages)
+
+        for c in await r.xinfo_consumers(DELIVERY_STREAM_KEY, DELIVERY_STREAM_GROUP):
+            if c["name"] != self.name and not c["pending"] and c["idle"] > DELIVERY_CONSUMER_TTL * 1000:
+                await r.xgroup_delconsumer(DELIVERY_STREAM_KEY, DELIVERY_STREAM_GROUP, c["name"])
+                logger.info("delivery_consumer_removed", extra={"consumer": c["name"]})
+        logger.info("delivery_consumer_stats", extra={"consumer": self.name, **self.stats})
+
+    async def _dead_letter(self, r, ids: List[str]) -> None:
+        pipe = r.pipeline(transaction=False)
+        for mid in ids:
+            pipe.xrange(DELIVERY_STREAM_KEY, min=mid, max=mid)
+        entries = await pipe.execute()
+        pipe = r.pipeline(transaction=False)
+        for mid, found in zip(ids, entries):
+            for _, fields in found:
+                pipe.xadd(DELIVERY_DEAD_KEY, {**fields, "source_id": mid, "consumer": self.name})
+        pipe.xack(DELIVERY_STREAM_KEY, DELIVERY_STREAM_GROUP, *ids)
+        pipe.xdel(DELIVERY_STREAM_KEY, *ids)
+        await pipe.execute()
+        self.stats["dead"] += len(ids)
+        logger.error("delivery_stream_dead_letter", extra={"ids": ids[:20], "count": len(ids)})
@@ -0,0 +1,313 @@
+# services/event_store.py
+import os
+import json
+import time
+import socket
+import sqlite3
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from services.tracing import span
+
+logger = logging.getLogger(__name__)
+
+EVENT_STORE_PATH = os.getenv("EVENT_STORE_PATH", "./data/events.sqlite3")
+EVENT_STORE_SYNCHRONOUS = os.getenv("EVENT_STORE_SYNCHRONOUS", "FULL").upper()
+
+# Колонки строки из main._build_common_values (0-based), которые выносим в индексируемые поля
+_COL = {"click_id": 0, "event": 2, "page_city": 3, "utm_source": 4, "utm_medium": 5, "utm_campaign": 6, "ip": 10}
+COL_MESSENGER = 14
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq          INTEGER PRIMARY KEY AUTOINCREMENT,
+    click_id     TEXT    NOT NULL UNIQUE,
+    created_at   REAL    NOT NULL,
+    event        TEXT    NOT NULL,
+    page_city    TEXT,
+    utm_source   TEXT,
+    utm_medium   TEXT,
+    utm_campaign TEXT,
+    ip           TEXT,
+    messenger    TEXT,
+    updated_at   REAL,
+    row          TEXT    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_created_at ON events (created_at);
+CREATE INDEX IF NOT EXISTS events_utm_campaign ON events (utm_campaign, created_at);
+
+-- Журнал изменений уже записанных событий (messenger из колбэков бота)
+CREATE TABLE IF NOT EXISTS event_changes (
+    seq        INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_seq  INTEGER NOT NULL,
+    click_id   TEXT    NOT NULL,
+    col        INTEGER NOT NULL,
+    value      TEXT,
+    created_at REAL    NOT NULL
+);
+
+-- Отметки проекций (high-water mark) и аренда — проецирует только один воркер
+CREATE TABLE IF NOT EXISTS projections (
+    name        TEXT PRIMARY KEY,
+    hwm         INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_until REAL    NOT NULL DEFAULT 0
+);
+"""
+
+
+class EventStore:
+    """
+    Локальное хранилище событий на SQLite — система записи.
+
+    Каждая строка из _build_common_values сначала ложится сюда (одновременные put()
+    склеиваются в одну транзакцию), а Google Sheets догоняет её асинхронно:
+    проекция (services/projector) читает события и изменения после своей отметки hwm.
+    click_id, время, utm_campaign и др. вынесены в индексируемые колонки для локальных запросов.
+    """
+
+    def __init__(self, path: str = EVENT_STORE_PATH):
+        self.path = path
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        # Как и в outbox: одно соединение, все обращения — из одного потока
+        self._db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="event-store-db")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pending: List[Tuple[tuple, asyncio.Future]] = []
+        self._commit_task: Optional[asyncio.Task] = None
+
+    async def open(self) -> None:
+        await self._db(self._open)
+
+    async def close(self) -> None:
+        if self._commit_task is not None:
+            await self._commit_task
+        await self._db(self._close)
+
+    # ── write path ──────────────────────────────────────────────────────────
+    async def put(self, values: list) -> None:
+        await self.put_many([values])
+
+    async def put_many(self, rows: List[list]) -> None:
+        """Сохраняет строки событий; возвращается после коммита."""
+        if not rows:
+            return
+        loop = asyncio.get_running_loop()
+        futs = []
+        for values in rows:
+            fut = loop.create_future()
+            self._pending.append((self._record(values), fut))
+            futs.append(fut)
+        if self._commit_task is None or self._commit_task.done():
+            self._commit_task = asyncio.create_task(self._commit_loop())
+        # Ожидание групповой транзакции (включая очередь перед ней)
+        with span("event_store.commit"):
+            await asyncio.gather(*futs)
+
+    async def _commit_loop(self) -> None:
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                await self._db(self._insert, [record for record, _ in batch])
+            except Exception as e:
+                logger.exception("event_store_put_fail", extra={"rows": len(batch)})
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_result(None)
+
+    async def set_messenger(self, click_id: str, messenger: str) -> bool:
+        """Локально проставляет messenger (колонка O); False, если такого click_id в хранилище нет."""
+        return await self._db(self._set_column, click_id, COL_MESSENGER, messenger)
+
+    # ── read path ───────────────────────────────────────────────────────────
+    async def get(self, click_id: str) -> Optional[dict]:
+        return await self._db(self._get, click_id)
+
+    # ── проекции ────────────────────────────────────────────────────────────
+    async def acquire_projection(self, name: str, lease_seconds: float, seed_from: Optional[str] = None) -> Optional[int]:
+        """
+        Берёт/продлевает аренду проекции; hwm, если аренда наша, иначе None.
+        Новая проекция начинает с hwm проекции seed_from (если та есть), а не с начала хранилища.
+        """
+        return await self._db(self._acquire, name, lease_seconds, seed_from)
+
+    async def advance_projection(self, name: str, hwm: int) -> None:
+        await self._db(self._advance, name, hwm)
+
+    async def release_projection(self, name: str) -> None:
+        await self._db(self._release, name)
+
+    async def events_after(self, seq: int, limit: int) -> List[Tuple[int, list]]:
+        return await self._db(self._events_after, seq, limit)
+
+    async def changes_after(self, seq: int, limit: int, route_by: Optional[str] = None) -> List[tuple]:
+        """
+        (seq, event_seq, click_id, col, value) изменений после seq; с route_by (page_city,
+        utm_source, utm_campaign) — ещё и значение этого поля события, по нему выбирается шард.
+        """
+        return await self._db(self._changes_after, seq, limit, route_by)
+
+    async def projection_lag(self, names: Sequence[str] = ("sheets_rows", "sheets_updates")) -> Dict[str, Tuple[int, float]]:
+        """name -> (непроецированных записей, возраст самой старой в секундах)."""
+        return await self._db(self._lag, names)
+
+    # ── SQLite (выполняется в потоке event-store-db) ────────────────────────
+    async def _db(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._db_executor, fn, *args)
+
+    @staticmethod
+    def _record(values: list) -> tuple:
+        def col(name: str) -> str:
+            i = _COL[name]
+            return str(values[i]) if len(values) > i and values[i] is not None else ""
+
+        return (
+            col("click_id"), time.time(), col("event"), col("page_city"), col("utm_source"),
+            col("utm_medium"), col("utm_campaign"), col("ip"), json.dumps(values, ensure_ascii=False),
+        )
+
+    def _open(self) -> None:
+        if self._conn is not None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={EVENT_STORE_SYNCHRONOUS}")
+        conn.executescript(_SCHEMA)
+        self._conn = conn
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _insert(self, records: List[tuple]) -> None:
+        with self._tx():
+            # Повтор того же click_id (ретрай клиента) не плодит дубликатов
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO events (click_id, created_at, event, page_city, utm_source, "
+                "utm_medium, utm_campaign, ip, row) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                records,
+            )
+
+    def _set_column(self, click_id: str, col: int, value: str) -> bool:
+        now = time.time()
+        with self._tx():
+            row = self._conn.execute("SELECT seq, row FROM events WHERE click_id = ?", (click_id,)).fetchone()
+            if row is None:
+                return False
+            seq, raw = row
+            values = json.loads(raw)
+            if len(values) <= col:
+                values += [""] * (col + 1 - len(values))
+            values[col] = value
+            self._conn.execute(
+                "UPDATE events SET row = ?, updated_at = ? WHERE seq = ?",
+                (json.dumps(values, ensure_ascii=False), now, seq),
+            )
+            if col == COL_MESSENGER:
+                self._conn.execute("UPDATE events SET messenger = ? WHERE seq = ?", (value, seq))
+            self._conn.execute(
+                "INSERT INTO event_changes (event_seq, click_id, col, value, created_at) VALUES (?, ?, ?, ?, ?)",
+                (seq, click_id, col, value, now),
+            )
+        return True
+
+    def _get(self, click_id: str) -> Optional[dict]:
+        row = self._conn.execute(
+            "SELECT seq, created_at, event, messenger, row FROM events WHERE click_id = ?", (click_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        seq, created_at, event, messenger, raw = row
+        return {"seq": seq, "created_at": created_at, "event": event, "messenger": messenger, "values": json.loads(raw)}
+
+    def _acquire(self, name: str, lease_seconds: float, seed_from: Optional[str] = None) -> Optional[int]:
+        now = time.time()
+        with self._tx():
+            if seed_from is not None:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO projections (name, hwm) SELECT ?, hwm FROM projections WHERE name = ?",
+                    (name, seed_from),
+                )
+            self._conn.execute("INSERT OR IGNORE INTO projections (name) VALUES (?)", (name,))
+            hwm, owner, until = self._conn.execute(
+                "SELECT hwm, lease_owner, lease_until FROM projections WHERE name = ?", (name,)
+            ).fetchone()
+            if owner not in (None, self.owner) and until > now:
+                return None
+            self._conn.execute(
+                "UPDATE projections SET lease_owner = ?, lease_until = ? WHERE name = ?",
+                (self.owner, now + lease_seconds, name),
+            )
+        return hwm
+
+    def _advance(self, name: str, hwm: int) -> None:
+        with self._tx():
+            self._conn.execute(
+                "UPDATE projections SET hwm = ? WHERE name = ? AND lease_owner = ? AND hwm < ?",
+                (hwm, name, self.owner, hwm),
+            )
+
+    def _release(self, name: str) -> None:
+        with self._tx():
+            self._conn.execute(
+                "UPDATE projections SET lease_owner = NULL, lease_until = 0 WHERE name = ? AND lease_owner = ?",
+                (name, self.owner),
+            )
+
+    def _events_after(self, seq: int, limit: int) -> List[Tuple[int, list]]:
+        rows = self._conn.execute(
+            "SELECT seq, row FROM events WHERE seq > ? ORDER BY seq LIMIT ?", (seq, limit)
+        ).fetchall()
+        return [(s, json.loads(raw)) for s, raw in rows]
+
+    def _changes_after(self, seq: int, limit: int, route_by: Optional[str] = None) -> List[tuple]:
+        if route_by is None:
+            return self._conn.execute(
+                "SELECT seq, event_seq, click_id, col, value FROM event_changes WHERE seq > ? ORDER BY seq LIMIT ?",
+                (seq, limit),
+            ).fetchall()
+        if route_by not in _COL:
+            raise ValueError(f"unknown column {route_by}")
+        return self._conn.execute(
+            f"SELECT c.seq, c.event_seq, c.click_id, c.col, c.value, e.{route_by} FROM event_changes c "
+            "LEFT JOIN events e ON e.seq = c.event_seq WHERE c.seq > ? ORDER BY c.seq LIMIT ?",
+            (seq, limit),
+        ).fetchall()
+
+    def _lag(self, names: Sequence[str]) -> Dict[str, Tuple[int, float]]:
+        if self._conn is None:
+            return {}
+        now = time.time()
+        out = {}
+        # Проекции строк (у шардов — "sheets_rows:<шард>") идут по events, изменений — по event_changes
+        for name in names:
+            table = "events" if name.startswith("sheets_rows") else "event_changes"
+            row = self._conn.execute("SELECT hwm FROM projections WHERE name = ?", (name,)).fetchone()
+            hwm = row[0] if row else 0
+            count, oldest = self._conn.execute(
+                f"SELECT COUNT(*), MIN(created_at) FROM {table} WHERE seq > ?", (hwm,)
+            ).fetchone()
+            out[name] = (count, max(0.0, now - oldest) if oldest else 0.0)
+        return out
+
+    @contextmanager
+    def _tx(self):
+        # IMMEDIATE — несколько воркеров uvicorn пишут в один файл
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+
+event_store = EventStore()
@@ -0,0 +1,167 @@
+# services/geoip.py
+import os
+import time
+import ipaddress
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
+
+from services.metrics import registry, track
+
+try:
+    import geoip2.database  # type: ignore
+    import geoip2.errors  # type: ignore
+    import maxminddb  # type: ignore
+except Exception:
+    geoip2 = None
+    maxminddb = None
+
+logger = logging.getLogger(__name__)
+
+GEOIP_DB_PATH = os.getenv("GEOIP_DB_PATH")
+GEOIP_CACHE_SIZE = int(os.getenv("GEOIP_CACHE_SIZE", "50000"))
+GEOIP_CACHE_TTL = float(os.getenv("GEOIP_CACHE_TTL", "86400"))
+# ip — кэш по точному адресу; prefix — по /24 для IPv4 (и /64 для IPv6)
+GEOIP_CACHE_KEY = os.getenv("GEOIP_CACHE_KEY", "ip").lower()
+# request — город определяется в хендлере; delivery — при доставке строки в Sheets
+GEOIP_ENRICH_AT = os.getenv("GEOIP_ENRICH_AT", "request").lower()
+
+# Колонки строки из main._build_common_values (0-based)
+COL_IP, COL_CITY, COL_REGION, COL_COUNTRY = 10, 11, 15, 16
+
+
+class GeoInfo(NamedTuple):
+    city: str = ""
+    region: str = ""
+    country: str = ""
+
+
+EMPTY = GeoInfo()
+
+_reader = None
+_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_lock = threading.Lock()
+stats: Dict[str, int] = {"hits": 0, "misses": 0, "not_found": 0, "errors": 0}
+
+
+def init_geoip(logger: Optional[logging.Logger] = None) -> None:
+    """
+    Открывает базу GeoLite2 в режиме mmap: страницы файла общие для всех воркеров
+    через page cache ОС, а не копия базы в памяти каждого процесса.
+    """
+    global _reader
+    log = logger or logging.getLogger(__name__)
+    if _reader is not None:
+        return
+    if geoip2 is None:
+        log.info("GeoIP disabled: geoip2 package is not installed")
+        return
+    if not (GEOIP_DB_PATH and os.path.exists(GEOIP_DB_PATH)):
+        log.info("GeoIP disabled or file not found")
+        return
+    try:
+        _reader = geoip2.database.Reader(GEOIP_DB_PATH, mode=maxminddb.MODE_MMAP)
+        log.info(f"GeoIP DB loaded: {GEOIP_DB_PATH}")
+    except Exception as e:
+        log.warning(f"GeoIP load failed: path={GEOIP_DB_PATH} err={e}")
+
+
+def enabled() -> bool:
+    return _reader is not None
+
+
+def _cache_key(ip: str) -> str:
+    if GEOIP_CACHE_KEY != "prefix":
+        return ip
+    try:
+        # Сеть, а не склейка групп адреса: у сжатых IPv6 ("2001:db8::1") первые группы — не /64
+        return str(ipaddress.ip_network(f"{ip}/{64 if ':' in ip else 24}", strict=False))
+    except ValueError:
+        return ip
+
+
+def lookup(ip: str) -> GeoInfo:
+    """
+    Город/регион/страна по IP с LRU+TTL кэшем. Отрицательные результаты
+    (адреса нет в базе, некорректный IP) кэшируются так же, как положительные.
+    """
+    if _reader is None or not ip:
+        return EMPTY
+
+    key = _cache_key(ip)
+    now = time.monotonic()
+    with _lock:
+        item = _cache.get(key)
+        if item is not None and item[1] > now:
+            _cache.move_to_end(key)
+            stats["hits"] += 1
+            return item[0]
+        stats["misses"] += 1
+
+    try:
+        with track("geoip", "city"):
+            resp = _reader.city(ip)
+        info = GeoInfo(
+            resp.city.name or "",
+            resp.subdivisions.most_specific.name or "",
+            resp.country.name or "",
+        )
+    except (geoip2.errors.AddressNotFoundError, ValueError):
+        stats["not_found"] += 1
+        info = EMPTY
+    except Exception as e:
+        # Неожиданная ошибка — не кэшируем, чтобы не закрепить её на TTL
+        stats["errors"] += 1
+        logger.warning("geoip_lookup_error", extra={"ip": ip, "error": str(e)})
+        return EMPTY
+
+    with _lock:
+        _cache[key] = (info, now + GEOIP_CACHE_TTL)
+        _cache.move_to_end(key)
+        while len(_cache) > GEOIP_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return info
+
+
+def lookup_on_request(ip: str) -> GeoInfo:
+    """Lookup в хендлере; при GEOIP_ENRICH_AT=delivery откладывается до доставки строки."""
+    if GEOIP_ENRICH_AT == "delivery":
+        return EMPTY
+    return lookup(ip)
+
+
+def enrich_row(values: list) -> list:
+    """Заполняет geo-колонки строки по IP, если они ещё пустые (режим GEOIP_ENRICH_AT=delivery)."""
+    if _reader is None or len(values) <= COL_CITY or values[COL_CITY]:
+        return values
+    info = lookup(str(values[COL_IP] or ""))
+    if info is EMPTY:
+        return values
+    row = list(values)
+    if len(row) <= COL_COUNTRY:
+        row += [""] * (COL_COUNTRY + 1 - len(row))
+    row[COL_CITY], row[COL_REGION], row[COL_COUNTRY] = info.city, info.region, info.country
+    return row
+
+
+GEOIP_CACHE = registry.counter("geoip_cache_lookups_total", "GeoIP cache lookups by outcome", ("outcome",))
+GEOIP_CACHE_SIZE_GAUGE = registry.gauge("geoip_cache_entries", "Entries in the GeoIP cache")
+
+
+def _collect_metrics() -> None:
+    for outcome in ("hits", "misses", "not_found", "errors"):
+        GEOIP_CACHE.set_total(stats[outcome], outcome)
+    GEOIP_CACHE_SIZE_GAUGE.set(len(_cache))
+
+
+registry.add_collector(_collect_metrics)
+
+
+def geoip_stats() -> Dict[str, object]:
+    lookups = stats["hits"] + stats["misses"]
+    return {
+        **stats,
+        "size": len(_cache),
+        "hit_rate": round(stats["hits"] / lookups, 4) if lookups else 0.0,
+    }
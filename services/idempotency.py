@@ -0,0 +1,241 @@
+# services/idempotency.py
+"""
+Окно идемпотентности для событий и колбэков бота.
+
+Повтор того же события в пределах IDEMPOTENCY_WINDOW_SECONDS (двойной клик, повторная
+отправка при навигации назад, повторная доставка колбэка из Planfix) не выделяет новый
+click_id и ничего не пишет — клиент получает сохранённый первый ответ.
+
+Ключ события — присланный клиентом (заголовок Idempotency-Key или поле event_key),
+иначе отпечаток: событие + ip + user-agent + utm + page_city (+ телефон формы).
+Ключ колбэка — текст сообщения и режим ответа (sync/async).
+
+Хранилище — Redis: SET NX EX занимает ключ на время обработки, затем в него кладётся ответ.
+Второй запрос, пришедший, пока первый ещё обрабатывается, ждёт его ответа
+до IDEMPOTENCY_WAIT_MS. Без Redis — память процесса (дедупликация в пределах воркера).
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+from services.ingest import FlatEvent
+from services.metrics import registry, track
+from services.redis_client import get_aredis
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "1") not in ("0", "false", "no")
+IDEMPOTENCY_WINDOW_SECONDS = int(os.getenv("IDEMPOTENCY_WINDOW_SECONDS", "30"))
+IDEMPOTENCY_WAIT_MS = int(os.getenv("IDEMPOTENCY_WAIT_MS", "2000"))
+IDEMPOTENCY_KEY_PREFIX = os.getenv("IDEMPOTENCY_KEY_PREFIX", "idem:")
+IDEMPOTENCY_LOCAL_MAX = int(os.getenv("IDEMPOTENCY_LOCAL_MAX", "100000"))
+
+_PENDING = "__pending__"
+_POLL_INTERVAL = 0.05
+
+# Локальный фолбэк: ключ -> (истекает, значение)
+_local: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+IDEMPOTENCY = registry.counter("idempotency_requests_total", "Idempotency outcomes", ("outcome",))
+
+Response = Union[dict, JSONResponse]
+
+
+def _digest(*parts) -> str:
+    raw = json.dumps(parts, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def _key(event: str, data: FlatEvent, ip: str, ua: str, explicit: Optional[str]) -> Optional[str]:
+    if not IDEMPOTENCY_ENABLED:
+        return None
+    if explicit:
+        return f"{IDEMPOTENCY_KEY_PREFIX}k:{event}:{_digest(explicit)}"
+    return IDEMPOTENCY_KEY_PREFIX + "f:" + _digest(
+        event, ip, ua, data.page_city or "",
+        data.utm_source, data.utm_medium, data.utm_campaign, data.utm_content, data.utm_term,
+        data.form.phone if data.form else None,
+    )
+
+
+def event_key(request: Request, event: str, data: FlatEvent, ip: str, ua: str) -> Optional[str]:
+    """Ключ события: присланный клиентом (заголовок или event_key) или отпечаток запроса."""
+    return _key(event, data, ip, ua, request.headers.get("idempotency-key") or data.event_key)
+
+
+def item_key(event: str, data: FlatEvent, ip: str, ua: str) -> Optional[str]:
+    """Ключ элемента /events/batch: его event_key или отпечаток (заголовок относится ко всей пачке)."""
+    return _key(event, data, ip, ua, data.event_key)
+
+
+def bot_key(messenger: str, msg: str, confirm: bool) -> Optional[str]:
+    """Ключ колбэка; режим входит в ключ — повтор с ?confirm=true не получит сохранённый 202."""
+    if not IDEMPOTENCY_ENABLED:
+        return None
+    mode = "sync" if confirm else "async"
+    return f"{IDEMPOTENCY_KEY_PREFIX}bot:{messenger}:{mode}:{_digest(msg)}"
+
+
+# ── хранилище ───────────────────────────────────────────────────────────────
+def _local_get(key: str) -> Optional[str]:
+    item = _local.get(key)
+    if item is None:
+        return None
+    if item[0] < time.monotonic():
+        _local.pop(key, None)
+        return None
+    return item[1]
+
+
+def _local_set(key: str, value: str) -> None:
+    _local[key] = (time.monotonic() + IDEMPOTENCY_WINDOW_SECONDS, value)
+    _local.move_to_end(key)
+    while len(_local) > IDEMPOTENCY_LOCAL_MAX:
+        _local.popitem(last=False)
+
+
+async def _try_claim(keys: List[str]) -> List[bool]:
+    """SET NX для каждого ключа: True — ключ наш, False — такой запрос уже был (или идёт)."""
+    r = get_aredis()
+    if r is not None:
+        try:
+            pipe = r.pipeline(transaction=False)
+            for key in keys:
+                pipe.set(key, _PENDING, nx=True, ex=IDEMPOTENCY_WINDOW_SECONDS)
+            with track("redis", "idempotency_claim"):
+                return [bool(res) for res in await pipe.execute()]
+        except Exception as e:
+            logger.warning("idempotency_redis_error", extra={"op": "claim", "error": str(e)})
+    claimed = []
+    for key in keys:
+        free = _local_get(key) is None
+        if free:
+            _local_set(key, _PENDING)
+        claimed.append(free)
+    return claimed
+
+
+async def _get(keys: List[str]) -> List[Optional[str]]:
+    r = get_aredis()
+    if r is not None:
+        try:
+            with track("redis", "idempotency_get"):
+                return await r.mget(keys)
+        except Exception as e:
+            logger.warning("idempotency_redis_error", extra={"op": "get", "error": str(e)})
+    return [_local_get(key) for key in keys]
+
+
+async def complete_many(responses: Dict[str, dict]) -> None:
+    """Сохраняет ответы под занятыми ключами (TTL ключа не меняется)."""
+    if not responses:
+        return
+    r = get_aredis()
+    if r is not None:
+        try:
+            pipe = r.pipeline(transaction=False)
+            for key, body in responses.items():
+                pipe.set(key, json.dumps(body, ensure_ascii=False), xx=True, keepttl=True)
+            with track("redis", "idempotency_complete"):
+                await pipe.execute()
+            return
+        except Exception as e:
+            logger.warning("idempotency_redis_error", extra={"op": "complete", "error": str(e)})
+    for key, body in responses.items():
+        _local_set(key, json.dumps(body, ensure_ascii=False))
+
+
+async def release_many(keys: List[str]) -> None:
+    """Освобождает ключи необработанных запросов — повтор клиента пройдёт заново."""
+    if not keys:
+        return
+    r = get_aredis()
+    if r is not None:
+        try:
+            with track("redis", "idempotency_release"):
+                await r.delete(*keys)
+            return
+        except Exception as e:
+            logger.warning("idempotency_redis_error", extra={"op": "release", "error": str(e)})
+    for key in keys:
+        _local.pop(key, None)
+
+
+async def claim_many(keys: List[Optional[str]]) -> List[Optional[dict]]:
+    """
+    Для каждого ключа: None — ключ занят нами, запрос нужно обработать;
+    dict — сохранённый ответ первого запроса. Ключ None (идемпотентность выключена) — всегда None.
+    Если первый запрос не успел ответить за IDEMPOTENCY_WAIT_MS — {"in_progress": True}.
+    """
+    out: List[Optional[dict]] = [None] * len(keys)
+    live = [(i, k) for i, k in enumerate(keys) if k]
+    if not live:
+        return out
+    claimed = await _try_claim([k for _, k in live])
+    waiting = [(i, k) for (i, k), ok in zip(live, claimed) if not ok]
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_MS / 1000
+    while waiting:
+        values = await _get([k for _, k in waiting])
+        still = []
+        for (i, k), raw in zip(waiting, values):
+            if raw is None:
+                # Первый запрос не удался и освободил ключ — обрабатываем как новый
+                if (await _try_claim([k]))[0]:
+                    continue
+                still.append((i, k))
+            elif raw == _PENDING:
+                still.append((i, k))
+            else:
+                out[i] = json.loads(raw)
+                IDEMPOTENCY.inc("replayed")
+        waiting = still
+        if waiting:
+            if time.monotonic() >= deadline:
+                for i, _ in waiting:
+                    out[i] = {"in_progress": True}
+                    IDEMPOTENCY.inc("in_progress")
+                break
+            await asyncio.sleep(_POLL_INTERVAL)
+    return out
+
+
+def replay_response(stored: dict) -> JSONResponse:
+    if stored.get("in_progress"):
+        return JSONResponse(status_code=409, content={"ok": False, "error": "duplicate request in progress"})
+    return JSONResponse(status_code=stored["status"], content=stored["body"], headers={"Idempotent-Replay": "true"})
+
+
+async def once(key: Optional[str], handler: Callable[[], Awaitable[Response]]) -> Response:
+    """
+    Выполняет handler() один раз на ключ в пределах окна. Успешный ответ (2xx) сохраняется
+    и отдаётся повторам; при ошибке ключ освобождается.
+    """
+    if key is None:
+        return await handler()
+    stored = (await claim_many([key]))[0]
+    if stored is not None:
+        logger.info("idempotent_replay", extra={"key": key, "in_progress": bool(stored.get("in_progress"))})
+        return replay_response(stored)
+    try:
+        result = await handler()
+    except BaseException:
+        await release_many([key])
+        raise
+    if isinstance(result, JSONResponse):
+        if result.status_code >= 300:
+            await release_many([key])
+            return result
+        body = {"status": result.status_code, "body": json.loads(result.body)}
+    else:
+        body = {"status": 200, "body": result}
+    await complete_many({key: body})
+    IDEMPOTENCY.inc("processed")
+    return result
@@ -0,0 +1,248 @@
+# services/ingest.py
+"""
+Быстрый путь приёма событий.
+
+- Тело читается одним json-разбором (orjson, если установлен) и раскладывается в плоский
+  FlatEvent без вложенных моделей UTM/ClientInfo. Быстрый разбор принимает только
+  «чистую» форму (строки — строками, целые — int); всё остальное (приведение типов,
+  ошибки) уходит в обычную валидацию Pydantic с тем же результатом и теми же 422.
+- Часовой пояс создаётся один раз, строка времени кэшируется на секунду.
+- Шаблоны ссылок t.me / wa.me собираются из окружения один раз при импорте.
+
+Эквивалентность старому пути (модели Pydantic + getattr) проверяет bench/ingest_bench.py.
+"""
+import os
+import json
+import time
+from datetime import datetime
+from typing import Any, NamedTuple, Optional
+from urllib.parse import quote
+from zoneinfo import ZoneInfo
+
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+from models.event import MessengerClick, FormSubmit, BatchEvent
+
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None
+
+MOSCOW_TZ = ZoneInfo("Europe/Moscow")
+
+TELEGRAM_BOT_USERNAME = os.getenv("TELEGRAM_BOT_USERNAME")
+WHATSAPP_NUMBER = os.getenv("WHATSAPP_NUMBER")
+_TG_PREFIX = f"https://t.me/{TELEGRAM_BOT_USERNAME}?start=" if TELEGRAM_BOT_USERNAME else None
+_WA_PREFIX = (
+    f"https://wa.me/{WHATSAPP_NUMBER}?text={quote(os.getenv('WHATSAPP_PREFILL_TEXT', ''))}"
+    if WHATSAPP_NUMBER else None
+)
+
+_UTM_FIELDS = ("source", "medium", "campaign", "content")
+_batch_adapter = TypeAdapter(BatchEvent)
+
+
+class FormFields(NamedTuple):
+    name: str
+    phone: str
+
+
+class FlatEvent(NamedTuple):
+    """Событие лендинга в плоском виде; значения — как у соответствующих полей моделей."""
+    type: Optional[str]
+    page_city: Optional[str]
+    utm_source: str
+    utm_medium: str
+    utm_campaign: str
+    utm_content: str
+    utm_term: Optional[str]
+    time_on_page_ms: Optional[int]
+    referrer: Optional[str]
+    form: Optional[FormFields]
+    event_key: Optional[str]
+
+
+# ── время и ссылки ──────────────────────────────────────────────────────────
+_ts_second = -1
+_ts_value = ""
+
+
+def moscow_timestamp() -> str:
+    """Текущее время по Москве "dd.mm.YYYY HH:MM:SS"; strftime — не чаще раза в секунду."""
+    global _ts_second, _ts_value
+    now = int(time.time())
+    if now != _ts_second:
+        _ts_value = datetime.fromtimestamp(now, MOSCOW_TZ).strftime("%d.%m.%Y %H:%M:%S")
+        _ts_second = now
+    return _ts_value
+
+
+def tg_link(click_id: str) -> Optional[str]:
+    return _TG_PREFIX + click_id if _TG_PREFIX else None
+
+
+def wa_link(click_id: str) -> Optional[str]:
+    return _WA_PREFIX + click_id if _WA_PREFIX else None
+
+
+# ── разбор ──────────────────────────────────────────────────────────────────
+def loads(raw: bytes) -> Any:
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+def _opt_str(value) -> bool:
+    return value is None or type(value) is str
+
+
+def _fast(obj: Any, event: Optional[str], form_required: bool) -> Optional[FlatEvent]:
+    """Плоский разбор «чистого» тела; None — нужна полная валидация."""
+    if type(obj) is not dict:
+        return None
+    utm = obj.get("utm")
+    if type(utm) is not dict:
+        return None
+    page_city = obj.get("page_city", "")
+    event_key = obj.get("event_key")
+    if not (_opt_str(page_city) and _opt_str(event_key)):
+        return None
+    utm_values = [utm.get(f, "") for f in _UTM_FIELDS]
+    term = utm.get("term", "")
+    if any(type(v) is not str for v in utm_values) or not _opt_str(term):
+        return None
+
+    time_on_page, referrer = 0, ""
+    if "client" in obj:
+        client = obj["client"]
+        if client is None:
+            pass
+        elif type(client) is dict:
+            time_on_page = client.get("time_on_page_ms", 0)
+            referrer = client.get("referrer", "")
+            if not ((time_on_page is None or type(time_on_page) is int) and _opt_str(referrer)):
+                return None
+        else:
+            return None
+
+    form = None
+    if form_required:
+        raw_form = obj.get("form")
+        if type(raw_form) is not dict:
+            return None
+        name, phone = raw_form.get("name"), raw_form.get("phone")
+        if type(name) is not str or type(phone) is not str:
+            return None
+        form = FormFields(name, phone)
+
+    return FlatEvent(event, page_city, *utm_values, term, time_on_page, referrer, form, event_key)
+
+
+def flatten(data: BaseModel, event: Optional[str] = None) -> FlatEvent:
+    """FlatEvent из провалидированной модели (MessengerClick / FormSubmit / элемент пачки)."""
+    utm = data.utm
+    client = data.client
+    form = getattr(data, "form", None)
+    return FlatEvent(
+        getattr(data, "type", event),
+        data.page_city,
+        utm.source, utm.medium, utm.campaign, utm.content, utm.term,
+        client.time_on_page_ms if client else 0,
+        client.referrer if client else "",
+        FormFields(form.name, form.phone) if form else None,
+        data.event_key,
+    )
+
+
+def _request_error(e: ValidationError) -> RequestValidationError:
+    # Тот же формат 422, что отдаёт FastAPI при валидации параметра-модели
+    return RequestValidationError([
+        {**err, "loc": ("body", *err["loc"])}
+        for err in e.errors(include_url=False)
+    ])
+
+
+def decode_event(obj: Any, event: str) -> FlatEvent:
+    """Тело /events/<event> -> FlatEvent; RequestValidationError, если модель его не принимает."""
+    is_form = event == "form_submit"
+    flat = _fast(obj, event, is_form)
+    if flat is not None:
+        return flat
+    try:
+        model = (FormSubmit if is_form else MessengerClick).model_validate(obj)
+    except ValidationError as e:
+        raise _request_error(e)
+    return flatten(model, event)
+
+
+def decode_batch_item(obj: Any) -> FlatEvent:
+    """Элемент /events/batch -> FlatEvent; ValidationError — как у TypeAdapter(BatchEvent)."""
+    if type(obj) is dict:
+        event = obj.get("type")
+        if event in ("telegram_click", "whatsapp_click", "form_submit"):
+            flat = _fast(obj, event, event == "form_submit")
+            if flat is not None:
+                return flat
+    return flatten(_batch_adapter.validate_python(obj))
+
+
+def openapi_body(model: type) -> dict:
+    """openapi_extra для эндпоинта, читающего тело сам: схема модели с развёрнутыми $defs."""
+    schema = model.model_json_schema()
+    defs = schema.pop("$defs", {})
+
+    def inline(node):
+        if isinstance(node, dict):
+            ref = node.get("$ref", "")
+            if ref.startswith("#/$defs/"):
+                return inline(defs[ref[len("#/$defs/"):]])
+            return {k: inline(v) for k, v in node.items()}
+        if isinstance(node, list):
+            return [inline(v) for v in node]
+        return node
+
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": inline(schema)}}}}
+
+
+async def read_event(request: Request, event: str) -> FlatEvent:
+    raw = await request.body()
+    try:
+        obj = loads(raw)
+    except ValueError as e:
+        raise RequestValidationError([{
+            "type": "json_invalid", "loc": ("body", 0), "msg": "JSON decode error",
+            "input": {}, "ctx": {"error": str(e)},
+        }])
+    return decode_event(obj, event)
+
+
+def build_row(
+    click_id: str,
+    event: str,
+    data: FlatEvent,
+    ip: str,
+    city: str,
+    ua: str,
+    region: str = "",
+    country: str = "",
+) -> list:
+    """Строка листа A..Q (порядок колонок — как в main._build_common_values)."""
+    return [
+        click_id,               # A id
+        moscow_timestamp(),     # B timestamp
+        event,                  # C event
+        data.page_city or "",   # D page_city
+        data.utm_source,        # E utm_source
+        data.utm_medium,        # F utm_medium
+        data.utm_campaign,      # G utm_campaign
+        data.utm_content,       # H utm_content
+        data.utm_term,          # I utm_term
+        data.time_on_page_ms,   # J time_on_page_ms
+        ip,                     # K ip
+        city,                   # L geo_city
+        ua,                     # M user_agent
+        data.referrer,          # N referrer
+        "",                     # O messenger (заполняется позже ботом)
+        region,                 # P geo_region
+        country,                # Q geo_country
+    ]
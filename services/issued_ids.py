@@ -0,0 +1,189 @@
+# services/issued_ids.py
+"""
+Реестр выданных click_id.
+
+Redis-битмап (бит с номером click_id) — общий для всех воркеров, плюс bloom-фильтр
+в памяти процесса как быстрое зеркало: положительный ответ фильтра не требует Redis,
+отрицательный проверяется GETBIT. Колбэк бота с невыданным ID отклоняется
+без обращения к хранилищу и Google Sheets, а из нескольких чисел в тексте
+сообщения выбирается то, которое действительно выдавалось.
+
+ID, выданные до появления реестра, в битмапе отсутствуют: всё ниже порога (floor),
+зафиксированного при первом старте по счётчику click_id, считается «неизвестным»,
+а не «невыданным». Без Redis ответ тоже «неизвестно» — работает прежний путь.
+
+ID, отмеченные, пока Redis был недоступен, до рестарта процесса живут только в памяти.
+Поэтому «невыданный» по битмапу ID перед отказом ищется в локальном хранилище событий:
+если событие там есть, ID считается выданным, а бит дописывается при следующей отметке.
+"""
+import os
+import hashlib
+import logging
+from typing import Iterable, List, Optional, Set
+
+from services.event_store import event_store
+from services.metrics import registry, track
+from services.redis_client import get_aredis, CLICK_COUNTER_KEY
+
+logger = logging.getLogger(__name__)
+
+ISSUED_IDS_KEY = os.getenv("ISSUED_IDS_KEY", "issued_click_ids")
+ISSUED_IDS_FLOOR_KEY = ISSUED_IDS_KEY + ":floor"
+# Явный порог (например, после переноса истории); пусто — берётся из счётчика при первом старте
+ISSUED_IDS_FLOOR = os.getenv("ISSUED_IDS_FLOOR")
+ISSUED_IDS_BLOOM_BITS = int(os.getenv("ISSUED_IDS_BLOOM_BITS", str(1 << 23)))
+ISSUED_IDS_BLOOM_HASHES = int(os.getenv("ISSUED_IDS_BLOOM_HASHES", "4"))
+
+ISSUED, NOT_ISSUED, UNKNOWN = "issued", "not_issued", "unknown"
+
+ISSUED_CHECKS = registry.counter("issued_ids_checks_total", "Issued click_id registry lookups", ("result",))
+
+
+def _canonical(cid: str) -> bool:
+    """Число в том виде, в каком выдаются click_id: str(int), без ведущих нулей."""
+    return str(cid).isdigit() and cid == str(int(cid))
+
+
+class BloomFilter:
+    """Bloom-фильтр на bytearray; k позиций из одного blake2b (двойное хеширование)."""
+
+    def __init__(self, bits: int = ISSUED_IDS_BLOOM_BITS, hashes: int = ISSUED_IDS_BLOOM_HASHES):
+        self.bits = max(8, bits)
+        self.hashes = max(1, hashes)
+        self._data = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, item: str) -> Iterable[int]:
+        digest = hashlib.blake2b(item.encode("ascii"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, item: str) -> None:
+        for pos in self._positions(item):
+            self._data[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._data[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class IssuedIdRegistry:
+    def __init__(self):
+        self.bloom = BloomFilter()
+        self.floor: Optional[int] = None
+        # Выданные, но ещё не записанные в Redis (он был недоступен) — дошлём при следующей отметке
+        self._unsynced: Set[int] = set()
+
+    async def start(self) -> None:
+        """Фиксирует порог: ID ниже него выданы до реестра и в битмапе отсутствуют."""
+        if ISSUED_IDS_FLOOR:
+            self.floor = int(ISSUED_IDS_FLOOR)
+            return
+        r = get_aredis()
+        if r is None:
+            return
+        try:
+            with track("redis", "issued_floor"):
+                current = await r.get(CLICK_COUNTER_KEY)
+                # Порог ставит только первый воркер первого запуска
+                await r.set(ISSUED_IDS_FLOOR_KEY, int(current or 999) + 1, nx=True)
+                raw = await r.get(ISSUED_IDS_FLOOR_KEY)
+            self.floor = int(raw)
+            logger.info("issued_ids_ready", extra={"floor": self.floor})
+        except Exception as e:
+            logger.warning("issued_ids_redis_error", extra={"op": "start", "error": str(e)})
+
+    async def mark(self, click_ids: List[str]) -> None:
+        """Отмечает ID выданными; ошибка Redis не мешает записи события."""
+        nums = [int(c) for c in click_ids if str(c).isdigit()]
+        for n in nums:
+            self.bloom.add(str(n))
+        todo = self._unsynced | set(nums)
+        if not todo:
+            return
+        r = get_aredis()
+        if r is None:
+            self._unsynced = todo
+            return
+        try:
+            pipe = r.pipeline(transaction=False)
+            for n in todo:
+                pipe.setbit(ISSUED_IDS_KEY, n, 1)
+            with track("redis", "issued_mark"):
+                await pipe.execute()
+            self._unsynced = set()
+        except Exception as e:
+            self._unsynced = todo
+            logger.warning("issued_ids_redis_error", extra={"op": "mark", "error": str(e), "pending": len(todo)})
+
+    async def check_many(self, click_ids: List[str]) -> List[str]:
+        """
+        ISSUED / NOT_ISSUED / UNKNOWN для каждого ID.
+        ID выдаются как str(int), поэтому запись с ведущими нулями ("01234") — не выданный ID:
+        иначе она совпала бы с битом 1234, а в хранилище и листе такого click_id нет.
+        """
+        out = [UNKNOWN] * len(click_ids)
+        ask = []
+        for i, cid in enumerate(click_ids):
+            if not _canonical(cid):
+                out[i] = NOT_ISSUED
+            elif cid in self.bloom or int(cid) in self._unsynced:
+                out[i] = ISSUED
+            else:
+                ask.append(i)
+        r = get_aredis()
+        if ask and r is not None:
+            try:
+                pipe = r.pipeline(transaction=False)
+                for i in ask:
+                    pipe.getbit(ISSUED_IDS_KEY, int(click_ids[i]))
+                with track("redis", "issued_check"):
+                    bits = await pipe.execute()
+                for i, bit in zip(ask, bits):
+                    n = int(click_ids[i])
+                    if bit:
+                        self.bloom.add(str(n))
+                        out[i] = ISSUED
+                    elif self.floor is not None and n >= self.floor:
+                        out[i] = NOT_ISSUED
+            except Exception as e:
+                logger.warning("issued_ids_redis_error", extra={"op": "check", "error": str(e)})
+        for i, res in enumerate(out):
+            if res == NOT_ISSUED and _canonical(click_ids[i]) and await self._stored(click_ids[i]):
+                out[i] = ISSUED
+        for res in out:
+            ISSUED_CHECKS.inc(res)
+        return out
+
+    async def _stored(self, click_id: str) -> bool:
+        """Событие с этим ID есть в хранилище — бит потерян (отметка без Redis до рестарта); восстанавливаем."""
+        try:
+            if await event_store.get(click_id) is None:
+                return False
+        except Exception as e:
+            logger.warning("issued_ids_store_error", extra={"op": "check", "error": str(e)})
+            return False
+        n = int(click_id)
+        self.bloom.add(str(n))
+        self._unsynced.add(n)
+        logger.info("issued_ids_restored", extra={"click_id": click_id})
+        return True
+
+    async def check(self, click_id: str) -> str:
+        return (await self.check_many([click_id]))[0]
+
+    async def pick(self, candidates: List[str]) -> Optional[str]:
+        """
+        Из чисел, найденных в тексте, выбирает click_id: последнее выданное, иначе последнее
+        «неизвестное» (старый ID или Redis недоступен); None — если все точно не выдавались.
+        """
+        if not candidates:
+            return None
+        results = await self.check_many(candidates)
+        for wanted in (ISSUED, UNKNOWN):
+            for cid, res in zip(reversed(candidates), reversed(results)):
+                if res == wanted:
+                    return cid
+        return None
+
+
+issued_ids = IssuedIdRegistry()
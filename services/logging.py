@@ -1,9 +1,195 @@
 # services/logging.py
-import logging
 import os
-from logging.handlers import RotatingFileHandler
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+from typing import Dict, List, Optional
+from logging.handlers import QueueHandler, RotatingFileHandler
+
+# Поля, которые есть у любого LogRecord; всё остальное пришло через extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "sample_rate"}
+
+_listener: Optional["BatchingQueueListener"] = None
+
+
+def _extra_fields(record: logging.LogRecord) -> Dict[str, object]:
+    return {k: v for k, v in record.__dict__.items() if k not in _RECORD_ATTRS and not k.startswith("_")}
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Одна запись — одна JSON-строка; extra-поля (click_id, ip, error, ...) идут отдельными ключами."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        data.update(_extra_fields(record))
+        if getattr(record, "sample_rate", None) is not None:
+            data["sample_rate"] = record.sample_rate
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Прежний текстовый формат, но с extra-полями в конце строки как key=value."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        extra = _extra_fields(record)
+        if not extra:
+            return line
+        pairs = " ".join(f"{k}={v}" for k, v in extra.items())
+        head, sep, tail = line.partition("\n")
+        return f"{head} | {pairs}{sep}{tail}"
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает только долю записей для шумных сообщений: LOG_SAMPLE="telegram_link_built=0.1,...".
+    К пропущенным записям добавляется sample_rate, чтобы при анализе можно было перевзвесить.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Решение принимается один раз на запись, даже если фильтр стоит на нескольких обработчиках
+        decided = getattr(record, "_sampled", None)
+        if decided is not None:
+            return decided
+        rate = self.rates.get(record.msg) if isinstance(record.msg, str) else None
+        keep = rate is None or rate >= 1.0 or random.random() < rate
+        if keep and rate is not None:
+            record.sample_rate = rate
+        record._sampled = keep
+        return keep
+
+
+def _parse_sample_rates(raw: str) -> Dict[str, float]:
+    rates = {}
+    for part in raw.split(","):
+        name, _, rate = part.strip().partition("=")
+        if name and rate:
+            try:
+                rates[name.strip()] = max(0.0, min(1.0, float(rate)))
+            except ValueError:
+                pass
+    return rates
+
+
+class _DeferredFlushMixin:
+    """Во время пачки flush() откладывается, чтобы сбросить поток один раз на всю пачку."""
+
+    defer_flush = False
+
+    def flush(self):
+        if not self.defer_flush:
+            super().flush()
+
+
+class _RotatingFileHandler(_DeferredFlushMixin, RotatingFileHandler):
+    pass
+
+
+class _StreamHandler(_DeferredFlushMixin, logging.StreamHandler):
+    pass
+
+
+class _PreparedQueueHandler(QueueHandler):
+    """
+    Очередь внутри процесса, поэтому запись не сериализуем: только фиксируем сообщение
+    и traceback текстом, а extra-поля оставляем как есть для JSON-форматтера.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class BatchingQueueListener:
+    """
+    Фоновый поток-писатель: забирает записи из очереди пачками (до `batch_size` или
+    не дольше `flush_interval` секунд), пишет их во все обработчики и сбрасывает
+    каждый поток один раз на пачку. Event loop на диске и ротации не блокируется.
+    """
+
+    _STOP = object()
+
+    def __init__(self, q: "queue.Queue", handlers: List[logging.Handler], batch_size: int, flush_interval: float):
+        self.queue = q
+        self.handlers = handlers
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.0, flush_interval)
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread.is_alive():
+            self.queue.put_nowait(self._STOP)
+            self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            stopping = batch[0] is self._STOP
+            while not stopping and len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=self.flush_interval) if self.flush_interval else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write([r for r in batch if r is not self._STOP])
+            if stopping:
+                return
+
+    def _write(self, records: List[logging.LogRecord]) -> None:
+        if not records:
+            return
+        for h in self.handlers:
+            h.defer_flush = True
+        try:
+            for record in records:
+                for h in self.handlers:
+                    if record.levelno >= h.level:
+                        h.handle(record)
+        finally:
+            for h in self.handlers:
+                h.defer_flush = False
+                h.flush()
+
+
+def _formatter(kind: str, fmt: str, datefmt: str) -> logging.Formatter:
+    if kind == "json":
+        return JsonLinesFormatter(datefmt=datefmt)
+    return TextFormatter(fmt=fmt, datefmt=datefmt)
+
 
 def setup_logging():
+    """
+    LOG_ASYNC=1 — записи уходят в очередь, пишет их фоновый поток пачками
+    (LOG_BATCH_SIZE / LOG_FLUSH_INTERVAL_MS). LOG_FORMAT_FILE / LOG_FORMAT_CONSOLE: text | json.
+    LOG_SAMPLE — доля сохраняемых записей для шумных сообщений.
+    """
+    global _listener
     os.makedirs("logs", exist_ok=True)
 
     fmt = "%(asctime)s | %(levelname)s | %(name)s | %(message)s"
@@ -12,23 +198,48 @@ def setup_logging():
     logger = logging.getLogger()
     logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 
-    sh = logging.StreamHandler()
+    if _listener is not None or any(isinstance(h, (_PreparedQueueHandler, _RotatingFileHandler)) for h in logger.handlers):
+        return
+
+    sh = _StreamHandler()
     sh.setLevel(os.getenv("LOG_LEVEL_CONSOLE", "INFO").upper())
-    sh.setFormatter(logging.Formatter(fmt=fmt, datefmt=datefmt))
+    sh.setFormatter(_formatter(os.getenv("LOG_FORMAT_CONSOLE", "text").lower(), fmt, datefmt))
 
-    fh = RotatingFileHandler(
-        filename="logs/app.log",
+    fh = _RotatingFileHandler(
+        filename=os.getenv("LOG_FILE", "logs/app.log"),
         maxBytes=10 * 1024 * 1024,  # 10 MB
         backupCount=5,
         encoding="utf-8",
     )
     fh.setLevel(os.getenv("LOG_LEVEL_FILE", "INFO").upper())
-    fh.setFormatter(logging.Formatter(fmt=fmt, datefmt=datefmt))
+    fh.setFormatter(_formatter(os.getenv("LOG_FORMAT_FILE", "json").lower(), fmt, datefmt))
+
+    sampler = SamplingFilter(_parse_sample_rates(os.getenv("LOG_SAMPLE", "")))
 
-    if not any(isinstance(h, RotatingFileHandler) for h in logger.handlers):
-        logger.addHandler(fh)
-    if not any(isinstance(h, logging.StreamHandler) for h in logger.handlers):
-        logger.addHandler(sh)
+    if os.getenv("LOG_ASYNC", "0") == "1":
+        q: "queue.Queue" = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", "0")))
+        qh = _PreparedQueueHandler(q)
+        qh.addFilter(sampler)
+        _listener = BatchingQueueListener(
+            q,
+            [fh, sh],
+            batch_size=int(os.getenv("LOG_BATCH_SIZE", "256")),
+            flush_interval=int(os.getenv("LOG_FLUSH_INTERVAL_MS", "200")) / 1000.0,
+        )
+        _listener.start()
+        atexit.register(shutdown_logging)
+        logger.addHandler(qh)
+    else:
+        for h in (fh, sh):
+            h.addFilter(sampler)
+            logger.addHandler(h)
 
     logging.getLogger("httpx").setLevel("WARNING")
-    logging.getLogger("googleapiclient").setLevel("WARNING")
+
+
+def shutdown_logging() -> None:
+    """Дописывает очередь и останавливает фоновый поток (идемпотентно)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
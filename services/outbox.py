@@ -0,0 +1,279 @@
+# services/outbox.py
+import os
+import json
+import time
+import socket
+import sqlite3
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from services.metrics import DELIVERIES, DELIVERY_RETRIES
+from services.tracing import span
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "./data/outbox.sqlite3")
+OUTBOX_SYNCHRONOUS = os.getenv("OUTBOX_SYNCHRONOUS", "FULL").upper()
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "200"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1.0"))
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "2"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "300"))
+OUTBOX_DRAIN_TIMEOUT = float(os.getenv("OUTBOX_DRAIN_TIMEOUT", "20"))
+
+# Обработчик доставки: получает payload, возвращает True при успехе
+Handler = Callable[[dict], Awaitable[bool]]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind            TEXT    NOT NULL,
+    payload         TEXT    NOT NULL,
+    created_at      REAL    NOT NULL,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL    NOT NULL,
+    lease_owner     TEXT,
+    lease_until     REAL    NOT NULL DEFAULT 0,
+    last_error      TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (next_attempt_at, id);
+"""
+
+
+class Outbox:
+    """
+    Локальный журнал исходящих доставок (Sheets, Planfix) на SQLite.
+
+    put() дописывает запись; одновременные вызовы склеиваются в одну транзакцию
+    (один fsync на пачку), и put() возвращается только после коммита.
+    Воркер доставки забирает записи с арендой (lease), вызывает обработчик по `kind`
+    и удаляет запись только после успеха — семантика at-least-once.
+    Всё, что не доставлено к остановке, переигрывается при следующем старте.
+    """
+
+    def __init__(self, path: str = OUTBOX_PATH):
+        self.path = path
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._handlers: Dict[str, Handler] = {}
+        # Все обращения к SQLite идут через один поток — соединение не делим между потоками
+        self._db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox-db")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pending: List[Tuple[str, str, asyncio.Future]] = []
+        self._commit_task: Optional[asyncio.Task] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._closing = False
+
+    # ── lifecycle ───────────────────────────────────────────────────────────
+    def register_handler(self, kind: str, handler: Handler) -> None:
+        self._handlers[kind] = handler
+
+    async def start(self) -> None:
+        await self._db(self._open)
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        backlog = await self.size()
+        self._worker = asyncio.create_task(self._run(), name="outbox-worker")
+        logger.info("outbox_started", extra={"path": self.path, "backlog": backlog})
+
+    async def stop(self, drain_timeout: float = OUTBOX_DRAIN_TIMEOUT) -> None:
+        """Дожидается доставки всего, что уже можно доставить (не дольше drain_timeout), и закрывает журнал."""
+        if self._worker is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._worker), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("outbox_drain_timeout", extra={"timeout": drain_timeout})
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._worker = None
+        if self._commit_task is not None:
+            await self._commit_task
+        left = await self.size()
+        await self._db(self._close)
+        logger.info("outbox_stopped", extra={"left": left})
+
+    # ── write path ──────────────────────────────────────────────────────────
+    async def put(self, kind: str, payload: dict) -> None:
+        await self.put_many([(kind, payload)])
+
+    async def put_many(self, items: List[Tuple[str, dict]]) -> None:
+        """Записывает несколько доставок; возвращается после того, как они надёжно легли на диск."""
+        if not items:
+            return
+        loop = asyncio.get_running_loop()
+        futs = []
+        for kind, payload in items:
+            fut = loop.create_future()
+            self._pending.append((kind, json.dumps(payload, ensure_ascii=False), fut))
+            futs.append(fut)
+        if self._commit_task is None or self._commit_task.done():
+            self._commit_task = asyncio.create_task(self._commit_loop())
+        # Ожидание групповой транзакции (включая очередь перед ней)
+        with span("outbox.commit"):
+            await asyncio.gather(*futs)
+
+    async def _commit_loop(self) -> None:
+        # Пока идёт коммит, новые записи копятся в _pending и уходят следующей транзакцией
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                await self._db(self._insert, [(kind, payload) for kind, payload, _ in batch])
+            except Exception as e:
+                logger.exception("outbox_put_fail", extra={"rows": len(batch)})
+                for _, _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.set_result(None)
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    # ── delivery worker ─────────────────────────────────────────────────────
+    async def _run(self) -> None:
+        while True:
+            try:
+                claimed = await self._db(self._claim, OUTBOX_BATCH_SIZE)
+            except Exception:
+                logger.exception("outbox_claim_fail")
+                claimed = []
+
+            if claimed:
+                await self._deliver(claimed)
+                continue
+
+            if self._closing:
+                return
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, claimed: List[Tuple[int, str, str, int]]) -> None:
+        async def one(row_id: int, kind: str, payload: str, attempts: int):
+            handler = self._handlers.get(kind)
+            if handler is None:
+                return row_id, attempts, f"no handler for kind={kind}"
+            try:
+                ok = await handler(json.loads(payload))
+            except Exception as e:
+                logger.exception("outbox_handler_exception", extra={"kind": kind, "outbox_id": row_id})
+                return row_id, attempts, str(e)
+            return row_id, attempts, None if ok else "handler returned failure"
+
+        results = await asyncio.gather(*(one(*row) for row in claimed))
+        kinds = {row[0]: row[1] for row in claimed}
+        for row_id, _, error in results:
+            DELIVERIES.inc(kinds[row_id], "ok" if error is None else "fail")
+        done = [row_id for row_id, _, error in results if error is None]
+        failed = [(row_id, attempts, error) for row_id, attempts, error in results if error is not None]
+        for row_id, _, _ in failed:
+            DELIVERY_RETRIES.inc(kinds[row_id])
+        try:
+            await self._db(self._settle, done, failed)
+        except Exception:
+            # Аренда истечёт, и записи будут доставлены повторно — это допустимо (at-least-once)
+            logger.exception("outbox_settle_fail", extra={"done": len(done), "failed": len(failed)})
+        if failed:
+            logger.warning("outbox_delivery_retry", extra={"done": len(done), "failed": len(failed)})
+
+    async def size(self) -> int:
+        return await self._db(self._count)
+
+    async def stats(self) -> Dict[str, Tuple[int, float]]:
+        """kind -> (число ожидающих записей, возраст самой старой в секундах)."""
+        return await self._db(self._stats)
+
+    # ── SQLite (выполняется в потоке outbox-db) ─────────────────────────────
+    async def _db(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._db_executor, fn, *args)
+
+    def _open(self) -> None:
+        if self._conn is not None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={OUTBOX_SYNCHRONOUS}")
+        conn.executescript(_SCHEMA)
+        self._conn = conn
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _insert(self, rows: List[Tuple[str, str]]) -> None:
+        now = time.time()
+        with self._tx():
+            self._conn.executemany(
+                "INSERT INTO outbox (kind, payload, created_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+                [(kind, payload, now, now) for kind, payload in rows],
+            )
+
+    def _claim(self, limit: int) -> List[Tuple[int, str, str, int]]:
+        now = time.time()
+        with self._tx():
+            rows = self._conn.execute(
+                "SELECT id, kind, payload, attempts FROM outbox "
+                "WHERE next_attempt_at <= ? AND lease_until <= ? ORDER BY id LIMIT ?",
+                (now, now, limit),
+            ).fetchall()
+            if rows:
+                self._conn.executemany(
+                    "UPDATE outbox SET lease_owner = ?, lease_until = ? WHERE id = ?",
+                    [(self.owner, now + OUTBOX_LEASE_SECONDS, row[0]) for row in rows],
+                )
+        return rows
+
+    def _settle(self, done: List[int], failed: List[Tuple[int, int, str]]) -> None:
+        now = time.time()
+        with self._tx():
+            if done:
+                self._conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in done])
+            if failed:
+                self._conn.executemany(
+                    "UPDATE outbox SET attempts = ?, next_attempt_at = ?, lease_owner = NULL, "
+                    "lease_until = 0, last_error = ? WHERE id = ?",
+                    [
+                        (attempts + 1, now + min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * (2 ** attempts)), error, i)
+                        for i, attempts, error in failed
+                    ],
+                )
+
+    def _stats(self) -> Dict[str, Tuple[int, float]]:
+        if self._conn is None:
+            return {}
+        now = time.time()
+        rows = self._conn.execute("SELECT kind, COUNT(*), MIN(created_at) FROM outbox GROUP BY kind").fetchall()
+        return {kind: (count, max(0.0, now - oldest)) for kind, count, oldest in rows}
+
+    def _count(self) -> int:
+        if self._conn is None:
+            return 0
+        return self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    @contextmanager
+    def _tx(self):
+        # IMMEDIATE — чтобы несколько воркеров uvicorn не забрали одни и те же записи
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+
+outbox = Outbox()
@@ -1,16 +1,116 @@
 # services/planfix.py
 import os
+import time
 import asyncio
 import logging
 import httpx
-from typing import Dict
+from typing import Dict, Optional
+
+from services.metrics import registry, track
 
 logger = logging.getLogger(__name__)
 
 PLANFIX_WEBHOOK_URL = os.getenv("PLANFIX_WEBHOOK_URL")
 HTTP_TIMEOUT = float(os.getenv("PLANFIX_HTTP_TIMEOUT", "5"))
-RETRIES = int(os.getenv("PLANFIX_RETRIES", "3"))
-BACKOFF_BASE = float(os.getenv("PLANFIX_BACKOFF_BASE", "0.8"))
+MAX_CONCURRENCY = int(os.getenv("PLANFIX_MAX_CONCURRENCY", "10"))
+MAX_KEEPALIVE = int(os.getenv("PLANFIX_MAX_KEEPALIVE", "10"))
+BREAKER_THRESHOLD = int(os.getenv("PLANFIX_BREAKER_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("PLANFIX_BREAKER_RESET_SECONDS", "30"))
+
+
+class CircuitBreaker:
+    """
+    Простой circuit breaker: после `threshold` неудач подряд размыкается на `reset_seconds`,
+    затем пропускает одну пробную попытку (half_open). Успех замыкает цепь, неудача — снова размыкает.
+    """
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.threshold = max(1, threshold)
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self.state = "half_open"
+            self._probe_in_flight = False
+        if self.state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            logger.info("planfix_breaker_closed")
+        self.state = "closed"
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                logger.warning("planfix_breaker_open", extra={"failures": self.failures})
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+
+# Счётчики клиента Planfix (зеркалируются в /metrics коллектором ниже)
+stats: Dict[str, float] = {
+    "sent_ok": 0,
+    "sent_fail": 0,
+    "breaker_rejected": 0,
+}
+
+breaker = CircuitBreaker()
+_client: Optional[httpx.AsyncClient] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def _new_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=HTTP_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=MAX_CONCURRENCY,
+            max_keepalive_connections=MAX_KEEPALIVE,
+        ),
+        headers={"Content-Type": "application/json"},
+    )
+
+
+async def init_planfix() -> None:
+    """Создаёт общий httpx-клиент с keep-alive пулом. Вызывается из lifespan приложения."""
+    global _client, _semaphore
+    if _client is None:
+        _client = _new_client()
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        logger.info("planfix_client_ready", extra={"max_concurrency": MAX_CONCURRENCY})
+
+
+async def close_planfix() -> None:
+    global _client, _semaphore
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+        _semaphore = None
+
+
+PLANFIX_EVENTS = registry.counter("planfix_events_total", "Planfix client outcomes", ("outcome",))
+PLANFIX_BREAKER = registry.gauge("planfix_breaker_open", "1 if the Planfix circuit breaker is not closed")
+
+
+def _collect_metrics() -> None:
+    for outcome in ("sent_ok", "sent_fail", "breaker_rejected"):
+        PLANFIX_EVENTS.set_total(stats[outcome], outcome)
+    PLANFIX_BREAKER.set(0 if breaker.state == "closed" else 1)
+
+
+registry.add_collector(_collect_metrics)
 
 
 def build_planfix_payload(name: str, phone: str, page_city: str) -> Dict:
@@ -24,34 +124,38 @@ def build_planfix_payload(name: str, phone: str, page_city: str) -> Dict:
     }
 
 
-async def send_to_planfix(payload: Dict):
+async def send_to_planfix(payload: Dict) -> bool:
     """
-    Отправляем POST запрос в Planfix с ретраями.
+    Отправляем POST запрос в Planfix через общий клиент — одна попытка за вызов.
+    Возвращает True, если лид принят (или отправка отключена), False — при ошибке
+    или разомкнутой цепи: тогда запись остаётся в outbox, и когда повторять, решают
+    его backoff (settle) и circuit breaker, а не собственный цикл ожиданий.
     """
     if not PLANFIX_WEBHOOK_URL:
         logger.info("PLANFIX_WEBHOOK_URL not set — skipping send_to_planfix")
-        return
-
-    attempt = 0
-    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-        while attempt < RETRIES:
-            try:
-                resp = await client.post(
-                    PLANFIX_WEBHOOK_URL,
-                    json=payload,
-                    headers={"Content-Type": "application/json"},
-                )
-                if resp.status_code < 400:
-                    logger.info("Planfix OK", extra={"status": resp.status_code, "payload": payload})
-                    return
-                # treat as error to retry
-                body = await resp.aread() if hasattr(resp, "aread") else resp.text
-                raise Exception(f"Planfix error {resp.status_code}: {body}")
-            except Exception as e:
-                attempt += 1
-                if attempt >= RETRIES:
-                    logger.exception("Planfix failed final", extra={"attempts": attempt, "error": str(e), "payload": payload})
-                    return
-                backoff = BACKOFF_BASE * (2 ** (attempt - 1))
-                logger.warning("Planfix error, retrying", extra={"attempt": attempt, "backoff": backoff, "error": str(e)})
-                await asyncio.sleep(backoff)
+        return True
+
+    if _client is None:
+        await init_planfix()
+
+    if not breaker.allow():
+        stats["breaker_rejected"] += 1
+        logger.warning("Planfix breaker open, deferring", extra={"breaker": breaker.state})
+        return False
+    try:
+        async with _semaphore:
+            # Латентность — в dependency_duration_seconds{dependency="planfix"}
+            with track("planfix", "post"):
+                resp = await _client.post(PLANFIX_WEBHOOK_URL, json=payload)
+        if resp.status_code >= 400:
+            raise Exception(f"Planfix error {resp.status_code}: {resp.text}")
+    except Exception as e:
+        breaker.record_failure()
+        stats["sent_fail"] += 1
+        logger.warning("Planfix failed, deferring to outbox", extra={"error": str(e), "payload": payload})
+        return False
+
+    breaker.record_success()
+    stats["sent_ok"] += 1
+    logger.info("Planfix OK", extra={"status": resp.status_code, "payload": payload})
+    return True
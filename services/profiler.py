@@ -0,0 +1,118 @@
+# services/profiler.py
+"""
+Профилирование работающего воркера по запросу (POST /admin/profile), без рестарта.
+
+- collapsed — сэмплирующий профайлер: отдельный поток раз в PROFILE_SAMPLE_INTERVAL_MS
+  снимает стеки всех потоков (sys._current_frames) и пишет их в формате collapsed stacks
+  ("поток;функция;функция N") — его читают flamegraph.pl и speedscope.
+- pstats — cProfile в потоке event loop (весь async-код воркера) с дампом в .pstats.
+
+Профилируется тот воркер, который принял запрос; файл — PROFILE_DIR/profile-<pid>-<время>.<формат>.
+Одновременно идёт не больше одного профиля на процесс.
+"""
+import os
+import sys
+import time
+import asyncio
+import cProfile
+import logging
+import threading
+from collections import Counter
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "./data/profiles")
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "120"))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+
+FORMATS = ("collapsed", "pstats")
+
+
+class ProfilerBusy(RuntimeError):
+    """В этом процессе профиль уже снимается."""
+
+
+class _Sampler(threading.Thread):
+    def __init__(self, seconds: float, interval: float, path: str):
+        super().__init__(name="profiler-sampler", daemon=True)
+        self.seconds = seconds
+        self.interval = interval
+        self.path = path
+        self.stacks: Counter = Counter()
+
+    def run(self) -> None:
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                thread = names.get(ident) or str(ident)
+                self.stacks[";".join([thread, *reversed(stack)])] += 1
+            time.sleep(self.interval)
+        self._dump()
+
+    def _dump(self) -> None:
+        try:
+            with open(self.path, "w", encoding="utf-8") as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            logger.info("profile_written", extra={"path": self.path, "samples": sum(self.stacks.values())})
+        except Exception as e:
+            logger.error("profile_write_failed", extra={"path": self.path, "error": str(e)})
+        finally:
+            _finish()
+
+
+_active: Optional[Dict[str, object]] = None
+
+
+def _finish() -> None:
+    global _active
+    _active = None
+
+
+def status() -> Optional[Dict[str, object]]:
+    return dict(_active) if _active else None
+
+
+def start(seconds: float, fmt: str = "collapsed") -> Dict[str, object]:
+    """Запускает профиль на seconds секунд в фоне; возвращает описание (путь файла и т. д.)."""
+    global _active
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    if _active is not None:
+        raise ProfilerBusy(f"profile already running until {_active['until']}")
+    seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.{fmt}")
+    _active = {"format": fmt, "path": path, "pid": os.getpid(), "seconds": seconds, "until": time.time() + seconds}
+
+    if fmt == "collapsed":
+        _Sampler(seconds, PROFILE_SAMPLE_INTERVAL_MS / 1000, path).start()
+    else:
+        # cProfile видит только поток, в котором включён, — это поток event loop
+        profile = cProfile.Profile()
+        profile.enable()
+
+        def stop() -> None:
+            profile.disable()
+            try:
+                profile.dump_stats(path)
+                logger.info("profile_written", extra={"path": path})
+            except Exception as e:
+                logger.error("profile_write_failed", extra={"path": path, "error": str(e)})
+            finally:
+                _finish()
+
+        asyncio.get_running_loop().call_later(seconds, stop)
+
+    logger.warning("profile_started", extra=_active)
+    return dict(_active)
@@ -0,0 +1,209 @@
+# services/projector.py
+import os
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from services import delivery_stream, geoip, sheet_shards
+from services.event_store import EventStore, event_store, COL_MESSENGER
+from services.sheet_shards import DEFAULT
+from services.sheets import append_rows_to_sheets, update_messengers_by_ids
+from services.metrics import DELIVERIES
+
+logger = logging.getLogger(__name__)
+
+PROJECTION_BATCH_SIZE = int(os.getenv("SHEETS_PROJECTION_BATCH_SIZE", "200"))
+# Потолок пачки при отставании: вызовы Sheets ограничены квотой, поэтому догоняем крупными пачками
+PROJECTION_BATCH_MAX = int(os.getenv("SHEETS_PROJECTION_BATCH_MAX", "2000"))
+PROJECTION_POLL_INTERVAL = float(os.getenv("SHEETS_PROJECTION_POLL_INTERVAL", "0.5"))
+PROJECTION_LEASE_SECONDS = float(os.getenv("SHEETS_PROJECTION_LEASE_SECONDS", "30"))
+PROJECTION_BACKOFF_BASE = float(os.getenv("SHEETS_PROJECTION_BACKOFF_BASE", "2"))
+PROJECTION_BACKOFF_MAX = float(os.getenv("SHEETS_PROJECTION_BACKOFF_MAX", "60"))
+PROJECTION_DRAIN_TIMEOUT = float(os.getenv("SHEETS_PROJECTION_DRAIN_TIMEOUT", "20"))
+
+ROWS = "sheets_rows"
+UPDATES = "sheets_updates"
+
+
+def _names(shard: str) -> Tuple[str, str]:
+    """Отметки (строки, изменения) шарда; у основного — прежние имена."""
+    if shard == DEFAULT:
+        return ROWS, UPDATES
+    return f"{ROWS}:{shard}", f"{UPDATES}:{shard}"
+
+
+class SheetsProjector:
+    """
+    Инкрементальная проекция локального хранилища событий в Google Sheets.
+
+    Две отметки (hwm) в том же SQLite: "sheets_rows" — последнее записанное в лист событие,
+    "sheets_updates" — последнее применённое изменение (messenger из колбэков бота).
+    Отметка двигается только после успешной записи, поэтому после падения проекция
+    продолжает с того же места. Проецирует один воркер — тот, у кого аренда.
+    Изменение применяется не раньше, чем в лист попала сама строка.
+
+    При шардировании (services/sheet_shards) у каждого шарда свой цикл и свои отметки
+    "sheets_rows:<шард>" / "sheets_updates:<шард>": цикл проходит все события, а пишет только
+    свои, так что медленная или недоступная таблица не задерживает остальные. Отметки нового
+    шарда начинаются с отметок основного — уже записанная история заново не проецируется.
+
+    При DELIVERY_MODE=stream (services/delivery_stream) проекция ничего не пишет в лист сама:
+    строки и изменения публикуются в Redis Stream, отметки двигаются после XADD.
+    """
+
+    def __init__(self, store: EventStore = event_store, shards: Optional[List[str]] = None):
+        self.store = store
+        # При DELIVERY_MODE=stream проекция только публикует в стрим, по шардам раскладывают воркеры
+        self.shards = shards or ([DEFAULT] if delivery_stream.STREAM_DELIVERY else sheet_shards.names())
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._wakeups: Dict[str, asyncio.Event] = {}
+        self._closing = False
+        self._failures: Dict[str, int] = {}
+        self._batch_size: Dict[str, int] = {}
+
+    def projections(self) -> List[str]:
+        """Имена всех отметок (для отставания в /ready и /metrics)."""
+        return [name for shard in self.shards for name in _names(shard)]
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        self._closing = False
+        for shard in self.shards:
+            self._wakeups[shard] = asyncio.Event()
+            self._failures[shard] = 0
+            self._batch_size[shard] = PROJECTION_BATCH_SIZE
+            self._tasks[shard] = asyncio.create_task(self._run(shard), name=f"sheets-projector-{shard}")
+        logger.info("projector_started", extra={"batch": PROJECTION_BATCH_SIZE, "shards": self.shards})
+
+    async def stop(self, drain_timeout: float = PROJECTION_DRAIN_TIMEOUT) -> None:
+        """Догоняет хранилище (не дольше drain_timeout) и отпускает аренду."""
+        if not self._tasks:
+            return
+        self._closing = True
+        self.notify()
+        tasks = list(self._tasks.values())
+        _, pending = await asyncio.wait([asyncio.shield(t) for t in tasks], timeout=drain_timeout)
+        if pending:
+            logger.warning("projector_drain_timeout", extra={"timeout": drain_timeout})
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._tasks = {}
+        for name in self.projections():
+            await self.store.release_projection(name)
+        logger.info("projector_stopped")
+
+    def notify(self) -> None:
+        """Будит проекцию сразу после записи в хранилище, не дожидаясь опроса."""
+        for wakeup in self._wakeups.values():
+            wakeup.set()
+
+    async def _run(self, shard: str) -> None:
+        wakeup = self._wakeups[shard]
+        while True:
+            try:
+                progressed = await self._project_rows(shard)
+                progressed = await self._project_updates(shard) or progressed
+                self._failures[shard] = 0
+            except Exception:
+                logger.exception("projector_error", extra={"shard": shard})
+                self._failures[shard] += 1
+                progressed = False
+                if not self._closing:
+                    delay = min(PROJECTION_BACKOFF_MAX, PROJECTION_BACKOFF_BASE * (2 ** (self._failures[shard] - 1)))
+                    await asyncio.sleep(delay)
+                    continue
+
+            if progressed:
+                continue
+            if self._closing:
+                return
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), PROJECTION_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _acquire(self, shard: str) -> Tuple[Optional[int], str]:
+        rows_name, _ = _names(shard)
+        seed = None if shard == DEFAULT else ROWS
+        return await self.store.acquire_projection(rows_name, PROJECTION_LEASE_SECONDS, seed), rows_name
+
+    async def _project_rows(self, shard: str) -> bool:
+        hwm, name = await self._acquire(shard)
+        if hwm is None:
+            return False
+        limit = self._batch_size[shard]
+        batch = await self.store.events_after(hwm, limit)
+        # Полная пачка — есть хвост: следующую берём вдвое больше; неполная — возвращаемся к обычной
+        self._batch_size[shard] = min(PROJECTION_BATCH_MAX, limit * 2) if len(batch) == limit else PROJECTION_BATCH_SIZE
+        if not batch:
+            return False
+        if delivery_stream.STREAM_DELIVERY:
+            # В лист строки пишут воркеры доставки (worker.py); отметка означает «передано в стрим»
+            rows = [values for _, values in batch]
+            await delivery_stream.publish_rows(rows)
+        else:
+            # При GEOIP_ENRICH_AT=delivery гео заполняется здесь, вне пути запроса
+            rows = [geoip.enrich_row(values) for _, values in batch if sheet_shards.shard_for_row(values) == shard]
+            if rows:
+                ok, result = await append_rows_to_sheets(rows, shard=shard)
+                DELIVERIES.inc("sheets", "ok" if ok else "fail", amount=len(rows))
+                if not ok:
+                    raise RuntimeError(f"sheets append failed: {result}")
+        await self.store.advance_projection(name, batch[-1][0])
+        logger.info("sheets_projected", extra={"shard": shard, "rows": len(rows), "hwm": batch[-1][0]})
+        return True
+
+    async def _project_updates(self, shard: str) -> bool:
+        # Изменения проецирует тот же воркер, что и строки
+        rows_hwm, _ = await self._acquire(shard)
+        if rows_hwm is None:
+            return False
+        _, name = _names(shard)
+        hwm = await self.store.acquire_projection(name, PROJECTION_LEASE_SECONDS, None if shard == DEFAULT else UPDATES)
+        if hwm is None:
+            return False
+        route = None if delivery_stream.STREAM_DELIVERY else sheet_shards.route_column()
+        changes = await self.store.changes_after(hwm, PROJECTION_BATCH_SIZE, route)
+        # Только изменения строк, которые уже есть в листе; порядок hwm не нарушаем
+        ready = []
+        for change in changes:
+            if change[1] > rows_hwm:
+                break
+            ready.append(change)
+        if not ready:
+            return False
+
+        # Несколько изменений одной ячейки схлопываем — в лист уходит последнее значение
+        latest: Dict[str, str] = {}
+        for change in ready:
+            _, _, click_id, col, value = change[:5]
+            if col != COL_MESSENGER:
+                continue
+            # Изменения строк других шардов пишут их циклы
+            if route is None or sheet_shards.shard_for_value(change[5]) == shard:
+                latest[click_id] = value
+        if delivery_stream.STREAM_DELIVERY:
+            await delivery_stream.publish_messengers(latest)
+        else:
+            # Все ячейки — одним values.batchUpdate
+            results = await update_messengers_by_ids(latest, shard=shard)
+            errors = [res for ok, res in results.values() if not ok and res != "ID not found"]
+            if errors:
+                raise RuntimeError(f"sheets update failed: {errors[0]}")
+            for click_id, (ok, _) in results.items():
+                if not ok:
+                    # Строка должна быть в листе — её удалили вручную; повторять бессмысленно
+                    logger.warning("sheets_update_row_missing", extra={"click_id": click_id, "shard": shard})
+        await self.store.advance_projection(name, ready[-1][0])
+        logger.info("sheets_updates_projected", extra={"shard": shard, "changes": len(ready), "cells": len(latest)})
+        return True
+
+
+projector = SheetsProjector()
@@ -0,0 +1,129 @@
+# services/readiness.py
+"""
+Проверка готовности воркера для /ready.
+
+В отличие от /health (процесс жив), /ready отвечает, можно ли слать трафик:
+- redis   — PING; без него клики идут из локального резерва, пока тот не кончится;
+- sheets  — по последним вызовам API (без лишних запросов в квоту);
+- geoip   — база открыта или отключена настройкой;
+- backlog — очереди доставки (outbox, проекция в Sheets и стрим воркеров доставки).
+
+fail у любой проверки — воркер не готов (503); degraded — готов, но с предупреждением.
+Результат кэшируется на READY_CACHE_SECONDS, одновременные пробы ждут одну проверку.
+"""
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from services import geoip, delivery_stream
+from services.redis_client import ping_redis, allocator
+from services.sheets import targets as sheets_targets
+from services.outbox import outbox
+from services.event_store import event_store
+from services.projector import projector
+
+logger = logging.getLogger(__name__)
+
+READY_CACHE_SECONDS = float(os.getenv("READY_CACHE_SECONDS", "2"))
+# Отставание доставки (записей / секунд), после которого backlog помечается degraded
+READY_MAX_BACKLOG = int(os.getenv("READY_MAX_BACKLOG", "10000"))
+READY_MAX_BACKLOG_AGE = float(os.getenv("READY_MAX_BACKLOG_AGE", "600"))
+# Sheets считается degraded, если последняя ошибка свежее последнего успеха и не старше этого (с)
+READY_SHEETS_ERROR_WINDOW = float(os.getenv("READY_SHEETS_ERROR_WINDOW", "120"))
+
+OK, DEGRADED, FAIL = "ok", "degraded", "fail"
+
+_started = False
+_cached: Optional[dict] = None
+_cached_at = 0.0
+_lock: Optional[asyncio.Lock] = None
+
+
+def mark_started(started: bool = True) -> None:
+    """lifespan отмечает окончание старта (и начало остановки — started=False)."""
+    global _started, _cached
+    _started = started
+    _cached = None
+
+
+async def _check_redis() -> Dict[str, object]:
+    if await ping_redis():
+        return {"status": OK}
+    left = allocator.available_without_redis()
+    # ID ещё выдаются из резерва — трафик принимаем, но это ненадолго
+    return {"status": DEGRADED if left > 0 else FAIL, "reserve_left": left}
+
+
+def _check_sheets_client(client) -> Dict[str, object]:
+    err = client.last_error
+    out: Dict[str, object] = {"last_ok_age": round(time.time() - client.last_ok, 1) if client.last_ok else None}
+    if err and err[0] > client.last_ok and time.time() - err[0] < READY_SHEETS_ERROR_WINDOW:
+        # Строки копятся в хранилище событий, приём не страдает
+        out.update(status=DEGRADED, error=err[1])
+    else:
+        out["status"] = OK
+    return out
+
+
+def _check_sheets() -> Dict[str, object]:
+    shards = {name: _check_sheets_client(target.client) for name, target in sheets_targets.items()}
+    if len(shards) == 1:
+        return next(iter(shards.values()))
+    # Несколько таблиц (services/sheet_shards): degraded, если хотя бы одна
+    status = DEGRADED if any(c["status"] != OK for c in shards.values()) else OK
+    return {"status": status, "shards": shards}
+
+
+def _check_geoip() -> Dict[str, object]:
+    if geoip.enabled():
+        return {"status": OK}
+    # Без базы город просто пустой; degraded, только если путь задан, а открыть не удалось
+    return {"status": DEGRADED if geoip.GEOIP_DB_PATH else OK, "enabled": False}
+
+
+async def _check_backlog() -> Dict[str, object]:
+    queues = {**(await outbox.stats()), **(await event_store.projection_lag(projector.projections()))}
+    status = OK
+    if delivery_stream.STREAM_DELIVERY:
+        try:
+            queues.update(await delivery_stream.stats())
+        except Exception as e:
+            # Без Redis события копятся в хранилище — это видно по отставанию проекции
+            logger.warning("delivery_stream_stats_failed", extra={"error": str(e)})
+            status = DEGRADED
+    for depth, age in queues.values():
+        if depth > READY_MAX_BACKLOG or age > READY_MAX_BACKLOG_AGE:
+            status = DEGRADED
+    return {"status": status, "queues": {k: {"depth": d, "oldest_age": round(a, 1)} for k, (d, a) in queues.items()}}
+
+
+async def _run_checks() -> dict:
+    redis_res, backlog_res = await asyncio.gather(_check_redis(), _check_backlog(), return_exceptions=True)
+    checks = {
+        "redis": redis_res,
+        "sheets": _check_sheets(),
+        "geoip": _check_geoip(),
+        "backlog": backlog_res,
+    }
+    for name, res in checks.items():
+        if isinstance(res, Exception):
+            checks[name] = {"status": FAIL, "error": str(res)}
+    ready = _started and all(c["status"] != FAIL for c in checks.values())
+    return {"ready": ready, "started": _started, "checks": checks}
+
+
+async def check_ready() -> dict:
+    global _cached, _cached_at, _lock
+    if _cached is not None and time.monotonic() - _cached_at < READY_CACHE_SECONDS:
+        return _cached
+    if _lock is None:
+        _lock = asyncio.Lock()
+    async with _lock:
+        if _cached is None or time.monotonic() - _cached_at >= READY_CACHE_SECONDS:
+            _cached = await _run_checks()
+            _cached_at = time.monotonic()
+            if not _cached["ready"]:
+                logger.warning("not_ready", extra={"checks": {k: v["status"] for k, v in _cached["checks"].items()}})
+    return _cached
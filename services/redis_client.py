@@ -1,30 +1,57 @@
 # services/redis_client.py
 import os
-import uuid
+import json
+import time
+import asyncio
 import logging
-from typing import Optional
+from typing import List, Optional
+
+from services.metrics import track
 
 try:
     import redis  # type: ignore
+    import redis.asyncio as aioredis  # type: ignore
 except Exception as e:
     redis = None
+    aioredis = None
+
+try:
+    import fcntl  # type: ignore
+except ImportError:  # Windows: резерв не делится между процессами, блокировка не нужна
+    fcntl = None
 
-# Глобальный клиент Redis; инициализируется через init_redis()
+logger = logging.getLogger(__name__)
+
+# Глобальные клиенты Redis; инициализируются через init_redis()
 _redis_client: Optional["redis.Redis"] = None # type: ignore
+_aredis_client: Optional["aioredis.Redis"] = None # type: ignore
 CLICK_COUNTER_KEY = os.getenv("CLICK_COUNTER_KEY", "click_id_counter")
+CLICK_ID_BLOCK_SIZE = int(os.getenv("CLICK_ID_BLOCK_SIZE", "20"))
+CLICK_ID_RESERVE_SIZE = int(os.getenv("CLICK_ID_RESERVE_SIZE", "500"))
+CLICK_ID_RESERVE_DIR = os.getenv("CLICK_ID_RESERVE_DIR", "./data/click_id_reserve")
+# Сколько ID резерва помечаем израсходованными на диске за одну запись
+CLICK_ID_RESERVE_CHUNK = int(os.getenv("CLICK_ID_RESERVE_CHUNK", "10"))
+# После неудачной аренды не ходим в Redis столько секунд (клики идут из резерва без таймаутов)
+CLICK_ID_RETRY_SECONDS = float(os.getenv("CLICK_ID_RETRY_SECONDS", "5"))
+
+
+class ClickIdUnavailable(RuntimeError):
+    """Нет ни Redis, ни локального резерва — выдать уникальный числовой ID нельзя."""
 
 
 def init_redis(logger: Optional[logging.Logger] = None) -> None:
     """
-    Инициализация глобального Redis-клиента и стартового значения счётчика.
-    Если Redis или пакет redis недоступен — оставляем _redis_client = None (фолбэк в get_next_click_id()).
+    Инициализация глобальных Redis-клиентов (sync и asyncio) и стартового значения счётчика.
+    Если Redis или пакет redis недоступен — оставляем клиентов None; click_id тогда выдаются
+    из локального резерва (см. ClickIdAllocator).
     """
-    global _redis_client
+    global _redis_client, _aredis_client
 
     if redis is None:
         if logger:
-            logger.error("Python package 'redis' is not installed; falling back to UUID for click_id")
+            logger.error("Python package 'redis' is not installed; click_id will come from local reserve only")
         _redis_client = None
+        _aredis_client = None
         return
 
     host = os.getenv("REDIS_HOST", "127.0.0.1")
@@ -43,29 +70,221 @@ def init_redis(logger: Optional[logging.Logger] = None) -> None:
     except Exception as e:
         _redis_client = None
         if logger:
-            logger.error("Redis connection failed; falling back to UUID for click_id", extra={"error": str(e)})
+            logger.error("Redis connection failed; click_id will come from local reserve", extra={"error": str(e)})
+
+    # Async-клиент создаём всегда: соединение откроется при первом запросе,
+    # так что Redis, поднявшийся после старта, подхватится без рестарта
+    _aredis_client = aioredis.Redis(
+        host=host, port=port, db=db, decode_responses=True,
+        socket_timeout=1.0, socket_connect_timeout=1.0,
+    )
+
 
+async def close_redis() -> None:
+    global _aredis_client
+    if _aredis_client is not None:
+        await _aredis_client.aclose()
+        _aredis_client = None
 
-def get_next_click_id(strict: bool = False) -> str:
+
+async def ping_redis(timeout: float = 1.0) -> bool:
+    """Доступен ли Redis прямо сейчас (PING через async-клиент)."""
+    client = get_aredis()
+    if client is None:
+        return False
+    try:
+        with track("redis", "ping"):
+            return bool(await asyncio.wait_for(client.ping(), timeout))
+    except Exception:
+        return False
+
+
+def get_redis() -> Optional["redis.Redis"]: # type: ignore
+    """Текущий синхронный Redis-клиент или None, если Redis недоступен."""
+    return _redis_client
+
+
+def get_aredis() -> Optional["aioredis.Redis"]: # type: ignore
+    """Текущий asyncio Redis-клиент или None."""
+    return _aredis_client
+
+
+class ClickIdAllocator:
     """
-    Возвращает следующий атомарный клик-ID как строку.
-    - Если Redis доступен: INCR по CLICK_COUNTER_KEY (начиная с 1000).
-    - Если недоступен:
-        * strict=True  -> выбрасываем исключение (чтобы отдать 500 на уровне хендлера).
-        * strict=False -> делаем безопасный фолбэк на короткий UUID (12 hex-символов).
+    Выдаёт числовые click_id из блоков, арендованных у Redis через INCRBY.
+
+    - Обычный путь: ID берутся из памяти процесса; в Redis ходим раз в `block_size` кликов.
+      INCRBY атомарен, поэтому блоки разных воркеров uvicorn не пересекаются.
+    - Резерв: заранее арендованный диапазон `reserve_size`, сохранённый в файле.
+      Если Redis недоступен, ID выдаются из него; курсор пишется на диск наперёд
+      (`reserve_chunk` штук), так что после падения процесса ID не повторяются.
+      Файл резерва захватывается flock'ом — два процесса одним резервом не пользуются.
+
+    ID остаются целыми числами, которые ловит INT_CLICK_ID_RE в main.py.
     """
-    global _redis_client
 
-    if _redis_client is not None:
+    def __init__(
+        self,
+        block_size: int = CLICK_ID_BLOCK_SIZE,
+        reserve_size: int = CLICK_ID_RESERVE_SIZE,
+        reserve_dir: str = CLICK_ID_RESERVE_DIR,
+        reserve_chunk: int = CLICK_ID_RESERVE_CHUNK,
+    ):
+        self.block_size = max(1, block_size)
+        self.reserve_size = max(0, reserve_size)
+        self.reserve_dir = reserve_dir
+        self.reserve_chunk = max(1, reserve_chunk)
+        self._next = 0
+        self._end = 0  # полуинтервал [_next, _end)
+        self._lock = asyncio.Lock()
+        self._redis_retry_at = 0.0
+        # Резерв: [_r_next, _r_end), на диске записан _r_persisted (>= _r_next)
+        self._r_next = 0
+        self._r_end = 0
+        self._r_persisted = 0
+        self._r_path: Optional[str] = None
+        self._r_fd: Optional[int] = None
+
+    # ── основной путь ───────────────────────────────────────────────────────
+    async def allocate(self, n: int = 1) -> List[str]:
+        """Возвращает n уникальных click_id (строками) в порядке возрастания."""
+        if n <= 0:
+            return []
+        async with self._lock:
+            out: List[int] = []
+            take = min(n, self._end - self._next)
+            out.extend(range(self._next, self._next + take))
+            self._next += take
+
+            need = n - len(out)
+            if need:
+                leased = await self._lease(need)
+                if leased is not None:
+                    out.extend(leased)
+                else:
+                    out.extend(await self._from_reserve(need))
+            return [str(i) for i in out]
+
+    async def _lease(self, need: int) -> Optional[List[int]]:
+        """Одним INCRBY арендует блок, покрывающий need ID; остаток блока остаётся в памяти."""
+        client = get_aredis()
+        if client is None or time.monotonic() < self._redis_retry_at:
+            return None
+        size = -(-need // self.block_size) * self.block_size
+        refill_reserve = self._reserve_left() < self.reserve_size // 2
+        try:
+            pipe = client.pipeline(transaction=False)
+            # Если Redis был пуст при старте, счётчик всё равно начинается с 1000
+            pipe.setnx(CLICK_COUNTER_KEY, 999)
+            pipe.incrby(CLICK_COUNTER_KEY, size)
+            if refill_reserve:
+                pipe.incrby(CLICK_COUNTER_KEY, self.reserve_size)
+            with track("redis", "incrby"):
+                res = await pipe.execute()
+        except Exception as e:
+            self._redis_retry_at = time.monotonic() + CLICK_ID_RETRY_SECONDS
+            logger.warning("click_id_lease_failed", extra={"error": str(e)})
+            return None
+
+        end = int(res[1]) + 1
+        start = end - size
+        self._next, self._end = start + need, end
+        if refill_reserve:
+            r_end = int(res[2]) + 1
+            await self._set_reserve(r_end - self.reserve_size, r_end)
+        return list(range(start, start + need))
+
+    # ── резерв ──────────────────────────────────────────────────────────────
+    def _reserve_left(self) -> int:
+        return self._r_end - self._r_next
+
+    def available_without_redis(self) -> int:
+        """Сколько ID можно выдать, не обращаясь к Redis (остаток блока + резерв)."""
+        return (self._end - self._next) + self._reserve_left()
+
+    async def _from_reserve(self, need: int) -> List[int]:
+        if self._reserve_left() < need:
+            raise ClickIdUnavailable("Redis is not available and local click_id reserve is exhausted")
+        ids = list(range(self._r_next, self._r_next + need))
+        self._r_next += need
+        if self._r_next > self._r_persisted:
+            self._r_persisted = min(self._r_end, self._r_next + self.reserve_chunk)
+            # Курсор на диске до выдачи ID (под self._lock), но fsync — не в потоке event loop
+            await asyncio.to_thread(self._write_reserve, self._r_persisted, self._r_end)
+        logger.warning("click_id_from_reserve", extra={"count": need, "left": self._reserve_left()})
+        return ids
+
+    async def _set_reserve(self, start: int, end: int) -> None:
+        # Новый диапазон заменяет остаток старого: неизрасходованные ID старого просто пропадают
+        self._r_next, self._r_end, self._r_persisted = start, end, start
+        await asyncio.to_thread(self._write_reserve, start, end)
+        logger.info("click_id_reserve_leased", extra={"start": start, "end": end})
+
+    def _write_reserve(self, persisted: int, end: int) -> None:
+        if self._r_path is None:
+            return
+        tmp = self._r_path + ".tmp"
         try:
-            next_id = _redis_client.incr(CLICK_COUNTER_KEY)
-            return str(next_id)
-        except Exception:
-            # Падаем в фолбэк ниже
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"next": persisted, "end": end}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._r_path)
+        except Exception as e:
+            logger.error("click_id_reserve_write_failed", extra={"path": self._r_path, "error": str(e)})
+
+    def _claim_reserve_file(self) -> None:
+        """Захватывает свободный файл резерва (или создаёт новый) и загружает из него диапазон."""
+        os.makedirs(self.reserve_dir, exist_ok=True)
+        slot = 0
+        while True:
+            path = os.path.join(self.reserve_dir, f"reserve-{slot}.json")
+            lock_path = path + ".lock"
+            fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o644)
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    os.close(fd)
+                    slot += 1
+                    continue
+            self._r_fd, self._r_path = fd, path
+            break
+
+        try:
+            with open(self._r_path, encoding="utf-8") as f:
+                data = json.load(f)
+            self._r_next = self._r_persisted = int(data["next"])
+            self._r_end = int(data["end"])
+        except FileNotFoundError:
             pass
+        except Exception as e:
+            logger.error("click_id_reserve_read_failed", extra={"path": self._r_path, "error": str(e)})
+        logger.info("click_id_reserve_claimed", extra={"path": self._r_path, "left": self._reserve_left()})
+
+    async def start(self) -> None:
+        """Захватывает файл резерва и, если Redis доступен, сразу дозаполняет резерв."""
+        if self._r_fd is None:
+            await asyncio.to_thread(self._claim_reserve_file)
+        if self._reserve_left() < self.reserve_size // 2:
+            async with self._lock:
+                leased = await self._lease(self.block_size)
+                if leased:
+                    # первый блок оставляем в памяти — он пойдёт на ближайшие клики
+                    self._next = leased[0]
+
+
+allocator = ClickIdAllocator()
 
-    if strict:
-        raise RuntimeError("Redis is not available for click_id generation")
 
-    # Мягкий фолбэк
-    return uuid.uuid4().hex[:12]
+async def get_next_click_ids(n: int) -> List[str]:
+    """n следующих click_id одной арендой (одним вызовом Redis в худшем случае)."""
+    return await allocator.allocate(n)
+
+
+async def get_next_click_id() -> str:
+    """
+    Возвращает следующий уникальный числовой клик-ID как строку (начиная с 1000).
+    Без Redis — из локального резерва; если и он исчерпан — ClickIdUnavailable.
+    """
+    return (await allocator.allocate(1))[0]
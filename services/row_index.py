@@ -0,0 +1,312 @@
+# services/row_index.py
+"""
+Индекс click_id -> номер строки в листе Google Sheets.
+
+Новые строки вставляются сразу под заголовок, поэтому абсолютный номер строки
+у каждой записи постоянно растёт. Вместо него храним порядковый номер вставки (seq)
+и общий счётчик вставленных строк (total): строка = 2 + (total - seq).
+Самая свежая запись (seq == total) всегда во второй строке.
+
+В режиме SHEETS_LAYOUT=append строки дописываются в конец вкладки и не сдвигаются,
+поэтому там храним готовое положение: click_id -> (вкладка, строка).
+
+Хранилище — Redis (общий для всех воркеров), при его недоступности — память процесса.
+Промахи кэшируются с TTL, чтобы повторяющиеся колбэки бота не вызывали
+повторную выгрузку всей колонки A.
+
+Индекс — кэш поверх листа, поэтому хранится ограниченно: хеши разбиты по месяцу записи
+("<ключ>:YYYY_MM") и живут ROW_INDEX_RETENTION_DAYS после последней записи в них.
+Поиск смотрит все ещё живые месяцы; id старше срока находятся сканом колонки A, как при промахе.
+"""
+import os
+import time
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from services.metrics import track
+from services.redis_client import get_aredis
+
+logger = logging.getLogger(__name__)
+
+ROW_INDEX_KEY = os.getenv("ROW_INDEX_KEY", "sheet_row_seq")
+ROW_TOTAL_KEY = os.getenv("ROW_TOTAL_KEY", "sheet_row_total")
+ROW_LOC_KEY = os.getenv("ROW_LOC_KEY", "sheet_row_loc")
+ROW_MISS_PREFIX = os.getenv("ROW_MISS_PREFIX", "sheet_row_miss:")
+ROW_MISS_TTL = int(os.getenv("ROW_INDEX_MISS_TTL", "60"))
+# Сколько дней индекс помнит строку (колбэки бота приходят в пределах окна атрибуции)
+ROW_INDEX_RETENTION_DAYS = max(1, int(os.getenv("ROW_INDEX_RETENTION_DAYS", "60")))
+
+# TTL месячного хеша продлевается каждой записью в него: живёт до конца месяца + срок хранения
+_BUCKET_TTL = ROW_INDEX_RETENTION_DAYS * 86400
+_BUCKETS = ROW_INDEX_RETENTION_DAYS // 28 + 2
+
+HEADER_ROWS = 1
+
+
+def month_suffix(offset: int = 0) -> str:
+    """YYYY_MM текущего месяца (UTC) минус offset месяцев."""
+    t = time.gmtime()
+    y, m = divmod(t.tm_year * 12 + t.tm_mon - 1 - offset, 12)
+    return f"{y}_{m + 1:02d}"
+
+
+def _row_from_seq(seq: int, total: int) -> Optional[int]:
+    if seq <= 0 or seq > total:
+        return None
+    return HEADER_ROWS + 1 + (total - seq)
+
+
+class RowIndex:
+    """Индекс одной таблицы; у дополнительных шардов (services/sheet_shards) ключи с суффиксом ":<шард>"."""
+
+    def __init__(self, shard: Optional[str] = None):
+        suffix = f":{shard}" if shard else ""
+        self.index_key = ROW_INDEX_KEY + suffix
+        self.total_key = ROW_TOTAL_KEY + suffix
+        self.loc_key = ROW_LOC_KEY + suffix
+        self.miss_prefix = ROW_MISS_PREFIX + (f"{shard}:" if shard else "")
+        # Локальный фолбэк, если Redis недоступен
+        self._local_seq: Dict[str, int] = {}
+        self._local_total = 0
+        self._local_miss: Dict[str, float] = {}
+        self._local_loc: Dict[str, Tuple[str, int]] = {}
+
+    @staticmethod
+    def _buckets(key: str) -> List[str]:
+        """Месячные хеши ключа, от текущего к старым."""
+        return [f"{key}:{month_suffix(i)}" for i in range(_BUCKETS)]
+
+    @staticmethod
+    def _hset_current(pipe, key: str, mapping: Dict[str, object]) -> None:
+        bucket = f"{key}:{month_suffix()}"
+        items = list(mapping.items())
+        for start in range(0, len(items), 10000):
+            pipe.hset(bucket, mapping=dict(items[start:start + 10000]))
+        pipe.expire(bucket, _BUCKET_TTL)
+
+    async def record_inserted(self, click_ids: List[str]) -> None:
+        """
+        Регистрирует пачку только что вставленных строк (в порядке поступления;
+        последняя оказалась во второй строке листа). Сбрасывает для них кэш промахов.
+        """
+        ids = [str(c) for c in click_ids if c]
+        if not ids:
+            return
+        n = len(ids)
+        r = get_aredis()
+        if r is not None:
+            try:
+                with track("redis", "row_index_record"):
+                    total = int(await r.incrby(self.total_key, n))
+                    first = total - n + 1
+                    pipe = r.pipeline(transaction=False)
+                    self._hset_current(pipe, self.index_key, {cid: first + i for i, cid in enumerate(ids)})
+                    pipe.delete(*[self.miss_prefix + cid for cid in ids])
+                    await pipe.execute()
+                return
+            except Exception as e:
+                logger.warning("row_index_redis_error", extra={"op": "record_inserted", "error": str(e)})
+
+        self._local_total += n
+        first = self._local_total - n + 1
+        for i, cid in enumerate(ids):
+            self._local_seq[cid] = first + i
+            self._local_miss.pop(cid, None)
+
+    async def lookup(self, click_id: str) -> Optional[int]:
+        """Ожидаемый 1-based номер строки для click_id или None, если в индексе его нет."""
+        r = get_aredis()
+        if r is not None:
+            try:
+                pipe = r.pipeline(transaction=False)
+                for bucket in self._buckets(self.index_key):
+                    pipe.hget(bucket, click_id)
+                pipe.get(self.total_key)
+                with track("redis", "row_index_lookup"):
+                    *seqs, total = await pipe.execute()
+                seq = next((s for s in seqs if s is not None), None)
+                if seq is None or total is None:
+                    return None
+                return _row_from_seq(int(seq), int(total))
+            except Exception as e:
+                logger.warning("row_index_redis_error", extra={"op": "lookup", "error": str(e)})
+
+        seq = self._local_seq.get(click_id)
+        if seq is None:
+            return None
+        return _row_from_seq(seq, self._local_total)
+
+    async def lookup_many(self, click_ids: List[str]) -> Dict[str, int]:
+        """Как self.lookup(), но для многих id за один запрос к Redis; в ответе только найденные."""
+        if not click_ids:
+            return {}
+        r = get_aredis()
+        if r is not None:
+            try:
+                pipe = r.pipeline(transaction=False)
+                for bucket in self._buckets(self.index_key):
+                    pipe.hmget(bucket, click_ids)
+                pipe.get(self.total_key)
+                with track("redis", "row_index_lookup"):
+                    *buckets, total = await pipe.execute()
+                if total is None:
+                    return {}
+                # Более свежий месяц перекрывает старый
+                seqs = {cid: seq for found in reversed(buckets) for cid, seq in zip(click_ids, found) if seq is not None}
+                rows = {cid: _row_from_seq(int(seq), int(total)) for cid, seq in seqs.items()}
+                return {cid: row for cid, row in rows.items() if row}
+            except Exception as e:
+                logger.warning("row_index_redis_error", extra={"op": "lookup_many", "error": str(e)})
+
+        rows = {cid: _row_from_seq(self._local_seq[cid], self._local_total) for cid in click_ids if cid in self._local_seq}
+        return {cid: row for cid, row in rows.items() if row}
+
+    async def seed(self, column_a: List[list]) -> None:
+        """
+        Перестраивает индекс по выгруженной колонке A (включая заголовок):
+        total = число строк данных, seq каждой строки выводится из её позиции.
+        """
+        total = max(0, len(column_a) - HEADER_ROWS)
+        mapping = {}
+        for i, row in enumerate(column_a[HEADER_ROWS:], start=HEADER_ROWS + 1):
+            if row and row[0]:
+                mapping[str(row[0])] = total - (i - HEADER_ROWS - 1)
+
+        r = get_aredis()
+        if r is not None:
+            try:
+                pipe = r.pipeline(transaction=True)
+                pipe.delete(*self._buckets(self.index_key))
+                self._hset_current(pipe, self.index_key, mapping)
+                pipe.set(self.total_key, total)
+                with track("redis", "row_index_seed"):
+                    await pipe.execute()
+                logger.info("row_index_seeded", extra={"rows": total, "ids": len(mapping)})
+                return
+            except Exception as e:
+                logger.warning("row_index_redis_error", extra={"op": "seed", "error": str(e)})
+
+        self._local_seq = mapping
+        self._local_total = total
+        logger.info("row_index_seeded (local)", extra={"rows": total, "ids": len(mapping)})
+
+    async def _store_locations(self, mapping: Dict[str, str]) -> None:
+        if not mapping:
+            return
+        r = get_aredis()
+        if r is not None:
+            try:
+                pipe = r.pipeline(transaction=False)
+                self._hset_current(pipe, self.loc_key, mapping)
+                pipe.delete(*[self.miss_prefix + cid for cid in mapping])
+                with track("redis", "row_index_seed"):
+                    await pipe.execute()
+                return
+            except Exception as e:
+                logger.warning("row_index_redis_error", extra={"op": "store_locations", "error": str(e)})
+        for cid, loc in mapping.items():
+            row, _, title = loc.partition(":")
+            self._local_loc[cid] = (title, int(row))
+            self._local_miss.pop(cid, None)
+
+    async def record_located(self, tab: str, first_row: int, click_ids: List[str]) -> None:
+        """Режим append: строки click_ids записаны во вкладку tab подряд, начиная с first_row."""
+        await self._store_locations({str(cid): f"{first_row + i}:{tab}" for i, cid in enumerate(click_ids) if cid})
+
+    async def seed_located(self, tab: str, column_a: List[list]) -> None:
+        """Режим append: перестраивает положения по выгруженной колонке A вкладки (включая заголовок)."""
+        await self._store_locations({
+            str(row[0]): f"{i}:{tab}"
+            for i, row in enumerate(column_a[HEADER_ROWS:], start=HEADER_ROWS + 1)
+            if row and row[0]
+        })
+        logger.info("row_index_seeded", extra={"tab": tab, "rows": max(0, len(column_a) - HEADER_ROWS)})
+
+    async def lookup_location(self, click_id: str) -> Optional[Tuple[str, int]]:
+        """Режим append: (вкладка, 1-based строка) для click_id или None."""
+        r = get_aredis()
+        if r is not None:
+            try:
+                pipe = r.pipeline(transaction=False)
+                for bucket in self._buckets(self.loc_key):
+                    pipe.hget(bucket, click_id)
+                with track("redis", "row_index_lookup"):
+                    raw = next((v for v in await pipe.execute() if v is not None), None)
+                if raw is None:
+                    return None
+                row, _, title = raw.partition(":")
+                return title, int(row)
+            except Exception as e:
+                logger.warning("row_index_redis_error", extra={"op": "lookup_location", "error": str(e)})
+        return self._local_loc.get(click_id)
+
+    async def lookup_locations(self, click_ids: List[str]) -> Dict[str, Tuple[str, int]]:
+        """Как self.lookup_location(), но для многих id за один запрос к Redis; в ответе только найденные."""
+        if not click_ids:
+            return {}
+        r = get_aredis()
+        if r is not None:
+            try:
+                pipe = r.pipeline(transaction=False)
+                for bucket in self._buckets(self.loc_key):
+                    pipe.hmget(bucket, click_ids)
+                with track("redis", "row_index_lookup"):
+                    buckets = await pipe.execute()
+                out = {}
+                # Более свежий месяц перекрывает старый
+                for found in reversed(buckets):
+                    for cid, raw in zip(click_ids, found):
+                        if raw is not None:
+                            row, _, title = raw.partition(":")
+                            out[cid] = (title, int(row))
+                return out
+            except Exception as e:
+                logger.warning("row_index_redis_error", extra={"op": "lookup_locations", "error": str(e)})
+        return {cid: self._local_loc[cid] for cid in click_ids if cid in self._local_loc}
+
+    async def forget(self, click_id: str) -> None:
+        """Удаляет устаревшую запись индекса (строка не подтвердилась при проверке)."""
+        r = get_aredis()
+        if r is not None:
+            try:
+                pipe = r.pipeline(transaction=False)
+                for bucket in self._buckets(self.index_key) + self._buckets(self.loc_key):
+                    pipe.hdel(bucket, click_id)
+                with track("redis", "row_index_forget"):
+                    await pipe.execute()
+                return
+            except Exception as e:
+                logger.warning("row_index_redis_error", extra={"op": "forget", "error": str(e)})
+        self._local_seq.pop(click_id, None)
+        self._local_loc.pop(click_id, None)
+
+    async def is_known_missing(self, click_id: str) -> bool:
+        """True, если недавно уже искали этот click_id по всей колонке и не нашли."""
+        r = get_aredis()
+        if r is not None:
+            try:
+                with track("redis", "row_index_miss"):
+                    return bool(await r.exists(self.miss_prefix + click_id))
+            except Exception as e:
+                logger.warning("row_index_redis_error", extra={"op": "is_known_missing", "error": str(e)})
+
+        expires = self._local_miss.get(click_id)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            self._local_miss.pop(click_id, None)
+            return False
+        return True
+
+    async def mark_missing(self, click_id: str) -> None:
+        if ROW_MISS_TTL <= 0:
+            return
+        r = get_aredis()
+        if r is not None:
+            try:
+                with track("redis", "row_index_miss"):
+                    await r.set(self.miss_prefix + click_id, 1, ex=ROW_MISS_TTL)
+                return
+            except Exception as e:
+                logger.warning("row_index_redis_error", extra={"op": "mark_missing", "error": str(e)})
+        self._local_miss[click_id] = time.monotonic() + ROW_MISS_TTL
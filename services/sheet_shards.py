@@ -0,0 +1,165 @@
+# services/sheet_shards.py
+"""
+Маршрутизация строк по нескольким таблицам (шардам) Google Sheets.
+
+Одна таблица — одна квота записи и один предел размера на всю сеть клиник. При
+SHEETS_SHARD_BY строки раскладываются по таблицам по значению колонки строки:
+- page_city (он же landing — у каждой посадочной страницы свой page_city), utm_source или utm_campaign;
+- SHEETS_SHARD_ROUTES=значение=шард,... — какое значение куда; всё остальное — в основную
+  таблицу (шард "default": SHEETS_ID / SHEET_NAME / SHEET_GID);
+- SHEETS_SHARDS=msk,spb — дополнительные шарды, для каждого SHEETS_SHARD_<ИМЯ>_ID, _SHEET_NAME,
+  _GID и _SERVICE_FILE (пусто — ключ основной таблицы; у шардов с одним ключом общая квота).
+
+Куда записан click_id, запоминается при записи (Redis-хеш SHEET_SHARD_MAP_KEY, только для
+не основных шардов) — колбэк бота ищет строку сразу в нужной таблице. Хеши разбиты по месяцу
+записи ("<ключ>:YYYY_MM") и живут SHEET_SHARD_MAP_RETENTION_DAYS; id старше срока ищутся
+так же, как записанные до шардирования, — в основной таблице, затем в остальных.
+Хранилище — Redis (общий для всех воркеров), при его недоступности — память процесса.
+"""
+import os
+import logging
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from services.metrics import track
+from services.redis_client import get_aredis
+from services.row_index import month_suffix
+
+logger = logging.getLogger(__name__)
+
+DEFAULT = "default"
+
+# Колонки строки из main._build_common_values (0-based), по которым можно шардировать
+_COLUMNS = {"page_city": 3, "landing": 3, "utm_source": 4, "utm_campaign": 6}
+
+SHEETS_SHARD_BY = os.getenv("SHEETS_SHARD_BY", "").strip().lower()
+SHEET_SHARD_MAP_KEY = os.getenv("SHEET_SHARD_MAP_KEY", "sheet_shard_of")
+SHEET_SHARD_MAP_RETENTION_DAYS = max(1, int(os.getenv("SHEET_SHARD_MAP_RETENTION_DAYS", "60")))
+# Как в services/row_index: TTL месячного хеша продлевается записью — живёт до конца месяца + срок
+_MAP_BUCKETS = SHEET_SHARD_MAP_RETENTION_DAYS // 28 + 2
+
+if SHEETS_SHARD_BY and SHEETS_SHARD_BY not in _COLUMNS:
+    raise RuntimeError(f"SHEETS_SHARD_BY: ожидается одно из {', '.join(_COLUMNS)}")
+
+
+class ShardConfig(NamedTuple):
+    name: str
+    spreadsheet_id: str
+    sheet_name: str
+    gid: int
+    service_file: Optional[str]
+
+
+def _load_shards() -> Dict[str, ShardConfig]:
+    shards: Dict[str, ShardConfig] = {}
+    for name in (s.strip().lower() for s in os.getenv("SHEETS_SHARDS", "").split(",")):
+        if not name or name == DEFAULT:
+            continue
+        prefix = f"SHEETS_SHARD_{name.upper()}_"
+        spreadsheet_id = os.getenv(prefix + "ID")
+        if not spreadsheet_id:
+            raise RuntimeError(f"{prefix}ID не задан")
+        shards[name] = ShardConfig(
+            name=name,
+            spreadsheet_id=spreadsheet_id,
+            sheet_name=os.getenv(prefix + "SHEET_NAME") or os.getenv("SHEET_NAME") or "",
+            gid=int(os.getenv(prefix + "GID", "0")),
+            service_file=os.getenv(prefix + "SERVICE_FILE") or None,
+        )
+    return shards
+
+
+def _load_routes(shards: Dict[str, ShardConfig]) -> Dict[str, str]:
+    routes: Dict[str, str] = {}
+    for item in os.getenv("SHEETS_SHARD_ROUTES", "").split(","):
+        value, sep, shard = item.partition("=")
+        if not sep:
+            continue
+        shard = shard.strip().lower()
+        if shard != DEFAULT and shard not in shards:
+            raise RuntimeError(f"SHEETS_SHARD_ROUTES: шард {shard!r} не описан в SHEETS_SHARDS")
+        routes[value.strip().lower()] = shard
+    return routes
+
+
+# Дополнительные шарды (основной описывают SHEETS_ID / SHEET_NAME / SHEET_GID)
+SHARDS = _load_shards()
+ROUTES = _load_routes(SHARDS)
+
+# Локальный фолбэк, если Redis недоступен
+_local_map: Dict[str, str] = {}
+
+
+def enabled() -> bool:
+    return bool(SHEETS_SHARD_BY and SHARDS)
+
+
+def names() -> List[str]:
+    """Все шарды, основной первым."""
+    return [DEFAULT, *SHARDS] if enabled() else [DEFAULT]
+
+
+def shard_for_value(value) -> str:
+    """Шард для значения колонки SHEETS_SHARD_BY."""
+    if not enabled():
+        return DEFAULT
+    return ROUTES.get(str(value or "").strip().lower(), DEFAULT)
+
+
+def shard_for_row(values: list) -> str:
+    """Шард для строки события."""
+    if not enabled():
+        return DEFAULT
+    i = _COLUMNS[SHEETS_SHARD_BY]
+    return shard_for_value(values[i] if len(values) > i else "")
+
+
+def route_column() -> Optional[str]:
+    """Поле хранилища событий, по которому шардируем (landing -> page_city); None без шардирования."""
+    if not enabled():
+        return None
+    return "page_city" if SHEETS_SHARD_BY == "landing" else SHEETS_SHARD_BY
+
+
+async def remember(click_ids: Iterable[str], shard: str) -> None:
+    """Запоминает, в какой шард записаны строки (основной не храним — он по умолчанию)."""
+    if shard == DEFAULT:
+        return
+    ids = [str(c) for c in click_ids if c]
+    if not ids:
+        return
+    r = get_aredis()
+    if r is not None:
+        try:
+            bucket = f"{SHEET_SHARD_MAP_KEY}:{month_suffix()}"
+            pipe = r.pipeline(transaction=False)
+            pipe.hset(bucket, mapping={cid: shard for cid in ids})
+            pipe.expire(bucket, SHEET_SHARD_MAP_RETENTION_DAYS * 86400)
+            with track("redis", "shard_remember"):
+                await pipe.execute()
+            return
+        except Exception as e:
+            logger.warning("sheet_shards_redis_error", extra={"op": "remember", "error": str(e)})
+    for cid in ids:
+        _local_map[cid] = shard
+
+
+async def shards_of(click_ids: List[str]) -> Dict[str, Optional[str]]:
+    """click_id -> шард, куда он записан; None — неизвестно (ищем в основном, потом в остальных)."""
+    if not enabled() or not click_ids:
+        return {cid: DEFAULT for cid in click_ids}
+    r = get_aredis()
+    if r is not None:
+        try:
+            pipe = r.pipeline(transaction=False)
+            for i in range(_MAP_BUCKETS):
+                pipe.hmget(f"{SHEET_SHARD_MAP_KEY}:{month_suffix(i)}", click_ids)
+            with track("redis", "shard_lookup"):
+                buckets = await pipe.execute()
+            found: Dict[str, Optional[str]] = {cid: None for cid in click_ids}
+            # Более свежий месяц перекрывает старый
+            for raw in reversed(buckets):
+                found.update({cid: s for cid, s in zip(click_ids, raw) if s in SHARDS})
+            return found
+        except Exception as e:
+            logger.warning("sheet_shards_redis_error", extra={"op": "shards_of", "error": str(e)})
+    return {cid: _local_map.get(cid) for cid in click_ids}
@@ -0,0 +1,187 @@
+# services/sheet_tabs.py
+"""
+Реестр вкладок (партиций) листа для режима SHEETS_LAYOUT=append.
+
+Строки дописываются в конец текущей вкладки, а вкладки ротируются:
+- SHEETS_ROLLOVER=month — по месяцу события (колонка B), вкладка "<SHEET_NAME>_YYYY_MM";
+- SHEETS_ROLLOVER=rows  — после SHEETS_ROLLOVER_ROWS строк, вкладка "<SHEET_NAME>_001", "_002", ...;
+- SHEETS_ROLLOVER=none  — одна вкладка SHEET_NAME.
+
+Для каждой вкладки храним sheetId, число строк и диапазон click_id (min/max),
+записанных в неё. По диапазонам find_row_by_id выбирает, какие вкладки сканировать,
+вместо просмотра всей истории.
+
+Хранилище — Redis (общий для всех воркеров), при его недоступности — память процесса.
+"""
+import os
+import re
+import time
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from services.metrics import track
+from services.redis_client import get_aredis
+
+logger = logging.getLogger(__name__)
+
+SHEETS_ROLLOVER = os.getenv("SHEETS_ROLLOVER", "month").lower()
+SHEETS_ROLLOVER_ROWS = int(os.getenv("SHEETS_ROLLOVER_ROWS", "100000"))
+SHEET_TABS_KEY = os.getenv("SHEET_TABS_KEY", "sheet_tabs")
+
+_ROWS_SUFFIX_RE = re.compile(r"_(\d+)$")
+
+
+def _month_of(values: list) -> str:
+    """YYYY_MM из timestamp строки ("dd.mm.YYYY HH:MM:SS"); текущий месяц, если разобрать не удалось."""
+    raw = str(values[1]) if len(values) > 1 else ""
+    try:
+        ts = datetime.strptime(raw[:10], "%d.%m.%Y")
+    except ValueError:
+        ts = datetime.now()
+    return ts.strftime("%Y_%m")
+
+
+class SheetTabs:
+    """Вкладки одной таблицы; у дополнительных шардов (services/sheet_shards) ключи с суффиксом ":<шард>"."""
+
+    def __init__(self, sheet_name: str, shard: Optional[str] = None):
+        self.sheet_name = sheet_name
+        key = SHEET_TABS_KEY + (f":{shard}" if shard else "")
+        self._ids_key = key + ":ids"          # hash  title -> sheetId
+        self._created_key = key + ":created"  # zset  title -> время регистрации
+        self._rows_key = key + ":rows"        # hash  title -> строк данных
+        self._min_key = key + ":min_id"       # zset  title -> минимальный click_id
+        self._max_key = key + ":max_id"       # zset  title -> максимальный click_id
+        # Локальный фолбэк, если Redis недоступен; _sheet_ids ещё и кэш поверх Redis
+        self._sheet_ids: Dict[str, int] = {}
+        self._local_created: Dict[str, float] = {}
+        self._local_rows: Dict[str, int] = {}
+        self._local_range: Dict[str, Tuple[int, int]] = {}
+
+    def _rows_tab(self, n: int) -> str:
+        return f"{self.sheet_name}_{n:03d}"
+
+    async def _current_rows_tab(self) -> str:
+        """Последняя вкладка режима rows; следующая, если в ней уже SHEETS_ROLLOVER_ROWS строк."""
+        numbered = []
+        for title in await self.all_tabs():
+            m = _ROWS_SUFFIX_RE.search(title)
+            if m and title == self._rows_tab(int(m.group(1))):
+                numbered.append((int(m.group(1)), title))
+        if not numbered:
+            return self._rows_tab(1)
+        n, title = max(numbered)
+        if await self.row_count(title) >= SHEETS_ROLLOVER_ROWS:
+            return self._rows_tab(n + 1)
+        return title
+
+    async def tab_for_rows(self, rows: List[list]) -> List[Tuple[str, List[list]]]:
+        """Раскладывает пачку строк по вкладкам, сохраняя порядок поступления внутри вкладки."""
+        if SHEETS_ROLLOVER == "month":
+            groups: Dict[str, List[list]] = {}
+            for values in rows:
+                groups.setdefault(f"{self.sheet_name}_{_month_of(values)}", []).append(values)
+            return list(groups.items())
+        if SHEETS_ROLLOVER == "rows":
+            return [(await self._current_rows_tab(), rows)]
+        return [(self.sheet_name, rows)]
+
+    async def sheet_id(self, title: str) -> Optional[int]:
+        """sheetId вкладки, если она уже создана и зарегистрирована."""
+        if title in self._sheet_ids:
+            return self._sheet_ids[title]
+        r = get_aredis()
+        if r is not None:
+            try:
+                with track("redis", "sheet_tabs_get"):
+                    raw = await r.hget(self._ids_key, title)
+                if raw is not None:
+                    self._sheet_ids[title] = int(raw)
+                    return self._sheet_ids[title]
+            except Exception as e:
+                logger.warning("sheet_tabs_redis_error", extra={"op": "sheet_id", "error": str(e)})
+        return None
+
+    async def register(self, title: str, gid: int) -> None:
+        """Запоминает созданную (или найденную в метаданных таблицы) вкладку."""
+        self._sheet_ids[title] = gid
+        r = get_aredis()
+        if r is not None:
+            try:
+                pipe = r.pipeline(transaction=False)
+                pipe.hset(self._ids_key, title, gid)
+                pipe.zadd(self._created_key, {title: time.time()}, nx=True)
+                with track("redis", "sheet_tabs_register"):
+                    await pipe.execute()
+                return
+            except Exception as e:
+                logger.warning("sheet_tabs_redis_error", extra={"op": "register", "error": str(e)})
+        self._local_created.setdefault(title, time.time())
+
+    async def record_rows(self, title: str, click_ids: List[str]) -> None:
+        """Учитывает дописанные во вкладку строки: счётчик строк и диапазон click_id."""
+        nums = [int(c) for c in click_ids if str(c).isdigit()]
+        r = get_aredis()
+        if r is not None:
+            try:
+                pipe = r.pipeline(transaction=False)
+                pipe.hincrby(self._rows_key, title, len(click_ids))
+                if nums:
+                    # LT/GT не мешают добавить новый элемент, но обновляют только в нужную сторону
+                    pipe.zadd(self._min_key, {title: min(nums)}, lt=True)
+                    pipe.zadd(self._max_key, {title: max(nums)}, gt=True)
+                with track("redis", "sheet_tabs_record"):
+                    await pipe.execute()
+                return
+            except Exception as e:
+                logger.warning("sheet_tabs_redis_error", extra={"op": "record_rows", "error": str(e)})
+
+        self._local_rows[title] = self._local_rows.get(title, 0) + len(click_ids)
+        if nums:
+            lo, hi = self._local_range.get(title, (min(nums), max(nums)))
+            self._local_range[title] = (min(lo, min(nums)), max(hi, max(nums)))
+
+    async def row_count(self, title: str) -> int:
+        r = get_aredis()
+        if r is not None:
+            try:
+                with track("redis", "sheet_tabs_get"):
+                    return int(await r.hget(self._rows_key, title) or 0)
+            except Exception as e:
+                logger.warning("sheet_tabs_redis_error", extra={"op": "row_count", "error": str(e)})
+        return self._local_rows.get(title, 0)
+
+    async def all_tabs(self) -> List[str]:
+        """Все зарегистрированные вкладки, от новых к старым."""
+        r = get_aredis()
+        if r is not None:
+            try:
+                with track("redis", "sheet_tabs_get"):
+                    return list(await r.zrevrange(self._created_key, 0, -1))
+            except Exception as e:
+                logger.warning("sheet_tabs_redis_error", extra={"op": "all_tabs", "error": str(e)})
+        return sorted(self._local_created, key=self._local_created.get, reverse=True)
+
+    async def tabs_for_id(self, click_id: str) -> List[str]:
+        """Вкладки, чей диапазон click_id покрывает данный id (от новых к старым)."""
+        if not str(click_id).isdigit():
+            return await self.all_tabs()
+        cid = int(click_id)
+        r = get_aredis()
+        if r is not None:
+            try:
+                tabs = await self.all_tabs()
+                pipe = r.pipeline(transaction=False)
+                for t in tabs:
+                    pipe.zscore(self._min_key, t)
+                    pipe.zscore(self._max_key, t)
+                with track("redis", "sheet_tabs_get"):
+                    scores = await pipe.execute()
+                return [
+                    t for i, t in enumerate(tabs)
+                    if scores[2 * i] is not None and scores[2 * i] <= cid <= scores[2 * i + 1]
+                ]
+            except Exception as e:
+                logger.warning("sheet_tabs_redis_error", extra={"op": "tabs_for_id", "error": str(e)})
+        return [t for t in await self.all_tabs() if t in self._local_range and self._local_range[t][0] <= cid <= self._local_range[t][1]]
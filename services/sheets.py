@@ -1,34 +1,40 @@
 # services/sheets.py
 import os
+import re
+import zlib
+import asyncio
 import logging
-from typing import Optional, Tuple, List
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from typing import Dict, Optional, Set, Tuple, List
 from dotenv import load_dotenv
 
+from services import sheet_shards
+from services.row_index import RowIndex
+from services.sheet_shards import DEFAULT
+from services.sheet_tabs import SheetTabs
+from services.sheets_client import AsyncSheetsClient, SheetsApiError
+from services.sheets_scheduler import priority, for_credential, HIGH, LOW
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
 SHEETS_ID = os.getenv("SHEETS_ID")
 SHEET_NAME = os.getenv("SHEET_NAME")
 SERVICE_FILE = os.getenv("GOOGLE_SERVICE_ACCOUNT_FILE")
-TOTAL_COLUMNS = int(os.getenv("SHEETS_TOTAL_COLUMNS", "15"))
+# A..Q, как в ingest.build_row; строки длиннее обрезаются
+TOTAL_COLUMNS = int(os.getenv("SHEETS_TOTAL_COLUMNS", "17"))
 SHEET_GID = int(os.getenv("SHEET_GID", "0"))
+# prepend — новые строки сверху единственного листа; append — в конец вкладок с ротацией (services/sheet_tabs)
+SHEETS_LAYOUT = os.getenv("SHEETS_LAYOUT", "prepend").lower()
+# Переопределение адреса API (например, локальный стенд bench/fake_sheets.py)
+SHEETS_API_ENDPOINT = os.getenv("SHEETS_API_ENDPOINT")
 
 if not SHEETS_ID:
     raise RuntimeError("SHEETS_ID не задан")
 if not SHEET_NAME:
     raise RuntimeError("SHEET_NAME не задан")
-if not SERVICE_FILE:
+if not SERVICE_FILE and not SHEETS_API_ENDPOINT:
     raise RuntimeError("GOOGLE_SERVICE_ACCOUNT_FILE не задан")
 
-SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
-credentials = service_account.Credentials.from_service_account_file(
-    SERVICE_FILE, scopes=SCOPES
-)
-service = build("sheets", "v4", credentials=credentials)
-sheet = service.spreadsheets()
-
 
 def _pad_row(values: list, total: int) -> list:
     """Возвращает список ровно из `total` элементов, дополняя пустыми в конце."""
@@ -47,99 +53,473 @@ def _col_letter(idx_1_based: int) -> str:
     return s
 
 
-def append_row_to_sheets(values: list) -> Tuple[bool, object]:
-    """
-    Вставляет новую строку в начало листа (index 0) и записывает туда values.
-    Возвращает (True, result) или (False, error_str).
+def _a1(tab: str, ref: str) -> str:
+    """Диапазон A1 с названием вкладки в кавычках (в названии могут быть пробелы)."""
+    return "'" + tab.replace("'", "''") + "'!" + ref
+
+
+_UPDATED_ROW_RE = re.compile(r"![A-Z]+(\d+)")
+
+
+def _cell(value) -> dict:
+    """CellData для updateCells: числа пишем как число, всё остальное — строкой (как RAW)."""
+    if isinstance(value, bool):
+        return {"userEnteredValue": {"boolValue": value}}
+    if isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": "" if value is None else str(value)}}
+
 
-    Реализация:
-    1) Используем numeric `SHEET_GID` из .env.
-    2) Делаем batchUpdate с request 'insertDimension' (insert row at start после заголовка).
-    3) Записываем значения в A2.. (обязательно pad до TOTAL_COLUMNS).
+class SheetsTarget:
     """
-    try:
-        # 1) Вставляем пустую строку в начало (вторая строка, т.к. первая — заголовок)
-        requests = [
-            {
-                "insertDimension": {
-                    "range": {
-                        "sheetId": SHEET_GID,
-                        "dimension": "ROWS",
-                        "startIndex": 1,
-                        "endIndex": 2,
-                    },
-                    "inheritFromBefore": False,
+    Одна таблица (шард, services/sheet_shards): свой клиент, индекс строк и реестр вкладок.
+    Токен и квоты — общие у таблиц с одним ключом сервисного аккаунта.
+    """
+
+    def __init__(self, name: str, spreadsheet_id: str, sheet_name: str, gid: int, service_file: Optional[str] = None):
+        self.name = name
+        self.sheet_name = sheet_name
+        self.gid = gid
+        shard = None if name == DEFAULT else name
+        own_key = service_file and (not SERVICE_FILE or os.path.realpath(service_file) != os.path.realpath(SERVICE_FILE))
+        # Без ключа (SERVICE_FILE пуст) допускается только стенд с переопределённым SHEETS_API_ENDPOINT
+        self.client = AsyncSheetsClient(
+            spreadsheet_id,
+            service_file=(service_file or SERVICE_FILE) or None,
+            scheduler=for_credential(service_file if own_key else None),
+        )
+        self.index = RowIndex(shard)
+        self.tabs = SheetTabs(sheet_name, shard)
+        self._header: Optional[list] = None
+
+    async def warm(self) -> bool:
+        try:
+            await self.client.get("spreadsheetId", "warmup")
+            return True
+        except Exception as e:
+            logger.warning("sheets_warmup_failed", extra={"shard": self.name, "error": str(e)})
+            return False
+
+    async def append_rows(self, rows: List[list]) -> Tuple[bool, object]:
+        """Пишет пачку строк согласно SHEETS_LAYOUT. Возвращает (True, result) или (False, error_str)."""
+        # Массовая дозапись уступает квоту обновлениям из колбэков бота
+        with priority(LOW):
+            if SHEETS_LAYOUT == "append":
+                ok, result = await self._append_rows_at_end(rows)
+            else:
+                ok, result = await self._prepend_rows(rows)
+        if ok:
+            await sheet_shards.remember([values[0] if values else "" for values in rows], self.name)
+        return ok, result
+
+    async def _prepend_rows(self, rows: List[list]) -> Tuple[bool, object]:
+        """
+        Вставляет пачку строк в начало листа одним batchUpdate.
+        Возвращает (True, result) или (False, error_str).
+
+        Реализация:
+        1) Используем numeric sheetId листа: `SHEET_GID` из .env, у шардов — SHEETS_SHARD_<ИМЯ>_GID.
+        2) 'insertDimension' вставляет len(rows) пустых строк сразу после заголовка.
+        3) 'updateCells' в том же batchUpdate записывает значения начиная с A2
+           (каждая строка pad до TOTAL_COLUMNS).
+
+        rows идут в порядке поступления; как и при вставке по одной, самое свежее
+        событие оказывается наверху, поэтому пишем их в обратном порядке.
+        batchUpdate атомарен — либо записаны все строки, либо ни одной.
+        """
+        if not rows:
+            return True, None
+        try:
+            n = len(rows)
+            requests = [
+                {
+                    "insertDimension": {
+                        "range": {
+                            "sheetId": self.gid,
+                            "dimension": "ROWS",
+                            "startIndex": 1,
+                            "endIndex": 1 + n,
+                        },
+                        "inheritFromBefore": False,
+                    }
+                },
+                {
+                    "updateCells": {
+                        "start": {"sheetId": self.gid, "rowIndex": 1, "columnIndex": 0},
+                        "rows": [
+                            {"values": [_cell(v) for v in _pad_row(values, TOTAL_COLUMNS)]}
+                            for values in reversed(rows)
+                        ],
+                        "fields": "userEnteredValue",
+                    }
+                },
+            ]
+            result = await self.client.batch_update(requests, "append")
+
+            logger.debug("sheets.prepend rows=%s result: %s", n, result)
+            await self.index.record_inserted([values[0] if values else "" for values in rows])
+            return True, result
+
+        except Exception as e:
+            logger.exception("SHEETS ERROR append_rows_to_sheets")
+            return False, str(e)
+
+    async def _header_row(self) -> list:
+        """Заголовок основного листа — копируется в каждую новую вкладку."""
+        if self._header is None:
+            res = await self.client.values_get(_a1(self.sheet_name, "1:1"), "get_header")
+            values = res.get("values", [])
+            self._header = values[0] if values else []
+        return self._header
+
+    async def _register_existing_tab(self, title: str) -> Optional[int]:
+        meta = await self.client.get("sheets.properties(sheetId,title)", "get_tabs")
+        for s in meta.get("sheets", []):
+            props = s.get("properties", {})
+            if props.get("title") == title:
+                await self.tabs.register(title, int(props.get("sheetId", 0)))
+                return int(props.get("sheetId", 0))
+        return None
+
+    async def _ensure_tab(self, title: str) -> int:
+        """
+        sheetId вкладки; если её ещё нет — создаёт одним batchUpdate вместе со строкой заголовка.
+        sheetId задаём сами (crc32 названия), чтобы в том же batchUpdate записать заголовок.
+        Гонку воркеров за одну вкладку разрешает ответ "already exists".
+        """
+        gid = await self.tabs.sheet_id(title)
+        if gid is not None:
+            return gid
+        gid = await self._register_existing_tab(title)
+        if gid is not None:
+            return gid
+
+        gid = zlib.crc32(title.encode("utf-8")) & 0x7FFFFFFF
+        header = await self._header_row()
+        requests = [{
+            "addSheet": {
+                "properties": {
+                    "sheetId": gid,
+                    "title": title,
+                    "gridProperties": {"columnCount": max(TOTAL_COLUMNS, len(header)), "frozenRowCount": 1},
                 }
             }
-        ]
-        batch_body = {"requests": requests}
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=SHEETS_ID, body=batch_body
-        ).execute()
-
-        # 2) Записываем значения во вторую строку A2.. (обязательно pad до TOTAL_COLUMNS)
-        row = _pad_row(values, TOTAL_COLUMNS)
-        result = sheet.values().update(
-            spreadsheetId=SHEETS_ID,
-            range=f"{SHEET_NAME}!A2",
-            valueInputOption="RAW",
-            body={"values": [row]},
-        ).execute()
-
-        logger.debug("sheets.prepend result: %s", result)
-        return True, result
-
-    except Exception as e:
-        logger.exception("SHEETS ERROR append_row_to_sheets")
-        return False, str(e)
-
-
-def find_row_by_id(record_id: str) -> Optional[int]:
-    """
-    Возвращает 1-based номер строки, где в кол. A равен record_id. None если не нашли.
-    """
-    try:
-        res = sheet.values().get(spreadsheetId=SHEETS_ID, range=f"{SHEET_NAME}!A:A").execute()
+        }]
+        if header:
+            requests.append({
+                "updateCells": {
+                    "start": {"sheetId": gid, "rowIndex": 0, "columnIndex": 0},
+                    "rows": [{"values": [_cell(v) for v in header]}],
+                    "fields": "userEnteredValue",
+                }
+            })
+        try:
+            await self.client.batch_update(requests, "add_tab")
+        except SheetsApiError as e:
+            if "already exists" not in str(e):
+                raise
+            existing = await self._register_existing_tab(title)
+            if existing is None:
+                raise
+            return existing
+        await self.tabs.register(title, gid)
+        logger.info("sheet_tab_created", extra={"tab": title, "sheet_id": gid})
+        return gid
+
+    async def _append_rows_at_end(self, rows: List[list]) -> Tuple[bool, object]:
+        """
+        Режим append: values.append в конец вкладки, выбранной services/sheet_tabs (по месяцу
+        события или по числу строк). Существующие строки не сдвигаются, поэтому стоимость записи
+        не зависит от объёма истории, а положение строки из ответа (updatedRange) сразу
+        попадает в индекс. Пачка на стыке месяцев уходит двумя вызовами — по одному на вкладку.
+        """
+        if not rows:
+            return True, None
+        try:
+            results = []
+            for title, group in await self.tabs.tab_for_rows(rows):
+                await self._ensure_tab(title)
+                result = await self.client.values_append(
+                    _a1(title, "A1"), [_pad_row(values, TOTAL_COLUMNS) for values in group], "append"
+                )
+                results.append(result)
+                ids = [str(values[0]) if values else "" for values in group]
+                m = _UPDATED_ROW_RE.search(result.get("updates", {}).get("updatedRange", ""))
+                if m:
+                    await self.index.record_located(title, int(m.group(1)), ids)
+                await self.tabs.record_rows(title, ids)
+                logger.debug("sheets.append tab=%s rows=%s result: %s", title, len(group), result)
+            return True, results[0] if len(results) == 1 else results
+
+        except Exception as e:
+            logger.exception("SHEETS ERROR append_rows_to_sheets")
+            return False, str(e)
+
+    async def _row_has_id(self, row_idx_1_based: int, record_id: str, tab: Optional[str] = None) -> bool:
+        """Проверяет одной ячейкой, что в A{row} действительно лежит record_id."""
+        res = await self.client.values_get(_a1(tab or self.sheet_name, f"A{row_idx_1_based}"), "verify_row")
         values = res.get("values", [])
-        for i, row in enumerate(values, start=1):
-            if row and len(row) >= 1 and row[0] == record_id:
-                return i
-        return None
-    except Exception:
-        logger.exception("SHEETS ERROR find_row_by_id")
+        return bool(values and values[0] and str(values[0][0]) == record_id)
+
+    async def find_row_by_id(self, record_id: str) -> Optional[int]:
+        """
+        Возвращает 1-based номер строки, где в кол. A равен record_id. None если не нашли.
+
+        Сначала смотрим в индекс (services/row_index) и проверяем найденную строку одной ячейкой.
+        Полный скан колонки A — только при промахе индекса; результат скана
+        перестраивает индекс, а ненайденный id кэшируется как промах на ROW_INDEX_MISS_TTL.
+        """
+        try:
+            row = await self.index.lookup(record_id)
+            if row:
+                if await self._row_has_id(row, record_id):
+                    return row
+                logger.info("row_index_stale", extra={"click_id": record_id, "row": row})
+                await self.index.forget(record_id)
+
+            if await self.index.is_known_missing(record_id):
+                logger.debug("row_index_cached_miss %s", record_id)
+                return None
+
+            res = await self.client.values_get(_a1(self.sheet_name, "A:A"), "scan_ids")
+            values = res.get("values", [])
+            for i, row in enumerate(values, start=1):
+                if row and len(row) >= 1 and row[0] == record_id:
+                    # Индекс не знал про существующую строку — пересобираем его по скану
+                    await self.index.seed(values)
+                    return i
+            await self.index.mark_missing(record_id)
+            return None
+        except Exception:
+            logger.exception("SHEETS ERROR find_row_by_id")
+            return None
+
+    async def locate_by_id(self, record_id: str) -> Optional[Tuple[str, int]]:
+        """
+        (вкладка, 1-based строка) для record_id или None.
+
+        В режиме append сначала индекс положений (проверяется одной ячейкой), затем скан
+        колонки A только тех вкладок, чей диапазон click_id покрывает record_id,
+        и напоследок — основной лист со строками, записанными до перехода на append.
+        """
+        if SHEETS_LAYOUT != "append":
+            row = await self.find_row_by_id(record_id)
+            return (self.sheet_name, row) if row else None
+        try:
+            loc = await self.index.lookup_location(record_id)
+            if loc:
+                if await self._row_has_id(loc[1], record_id, tab=loc[0]):
+                    return loc
+                logger.info("row_index_stale", extra={"click_id": record_id, "tab": loc[0], "row": loc[1]})
+                await self.index.forget(record_id)
+
+            if await self.index.is_known_missing(record_id):
+                return None
+
+            scanned = await self.tabs.tabs_for_id(record_id)
+            for title in scanned:
+                res = await self.client.values_get(_a1(title, "A:A"), "scan_ids")
+                values = res.get("values", [])
+                for i, row in enumerate(values, start=1):
+                    if row and row[0] == record_id:
+                        await self.index.seed_located(title, values)
+                        return title, i
+        except Exception:
+            logger.exception("SHEETS ERROR locate_by_id")
+            return None
+
+        # Строки, записанные в основной лист ещё в режиме prepend (find_row_by_id сам кэширует промах)
+        if self.sheet_name not in scanned:
+            row = await self.find_row_by_id(record_id)
+            return (self.sheet_name, row) if row else None
+        await self.index.mark_missing(record_id)
         return None
 
+    async def existing_ids(self) -> Set[str]:
+        """Все id из колонки A основного листа (и вкладок в режиме append) — одним values.batchGet."""
+        titles = [self.sheet_name]
+        if SHEETS_LAYOUT == "append":
+            titles += [t for t in (await self.tabs.all_tabs()) if t != self.sheet_name]
+        res = await self.client.values_batch_get([_a1(t, "A:A") for t in titles], "scan_ids")
+        return {
+            str(row[0])
+            for vr in res.get("valueRanges", [])
+            for row in vr.get("values", []) if row
+        }
+
+    async def update_cell(self, row_idx_1_based: int, col_idx_1_based: int, value: str, tab: Optional[str] = None) -> Tuple[bool, object]:
+        """Обновляет одну ячейку (по умолчанию на основном листе таблицы). Возвращает (True, result) или (False, error_str)."""
+        try:
+            rng = _a1(tab or self.sheet_name, f"{_col_letter(col_idx_1_based)}{row_idx_1_based}")
+            result = await self.client.values_update(rng, [[value]], "update_cell")
+            logger.debug("sheets.update_cell %s = %s -> %s", rng, value, result)
+            return True, result
+        except Exception as e:
+            logger.exception("SHEETS ERROR update_cell")
+            return False, str(e)
+
+    async def _indexed_locations(self, record_ids: List[str]) -> Dict[str, Tuple[str, int]]:
+        if SHEETS_LAYOUT == "append":
+            return await self.index.lookup_locations(record_ids)
+        return {rid: (self.sheet_name, row) for rid, row in (await self.index.lookup_many(record_ids)).items()}
+
+    async def locate_many(self, record_ids: List[str]) -> Dict[str, Optional[Tuple[str, int]]]:
+        """
+        Положения сразу для многих id: кандидаты из индекса проверяются одним values.batchGet,
+        остальные ищутся по одному через locate_by_id (первый же скан пересобирает индекс).
+        """
+        found: Dict[str, Optional[Tuple[str, int]]] = {}
+        candidates = await self._indexed_locations(record_ids)
+        if candidates:
+            ids = list(candidates)
+            res = await self.client.values_batch_get(
+                [_a1(candidates[rid][0], f"A{candidates[rid][1]}") for rid in ids], "verify_rows"
+            )
+            for rid, vr in zip(ids, res.get("valueRanges", [])):
+                values = vr.get("values", [])
+                if values and values[0] and str(values[0][0]) == rid:
+                    found[rid] = candidates[rid]
+                else:
+                    await self.index.forget(rid)
+        for rid in record_ids:
+            if rid not in found:
+                found[rid] = await self.locate_by_id(rid)
+        return found
+
+    async def update_messengers(self, updates: Dict[str, str]) -> Dict[str, Tuple[bool, object]]:
+        """
+        Пишет messenger (колонка O) для многих id одним values.batchUpdate.
+        Возвращает id -> (True, None) | (False, "ID not found") | (False, error_str).
+        """
+        if not updates:
+            return {}
+        try:
+            with priority(HIGH):
+                locations = await self.locate_many(list(updates))
+            data = [
+                {"range": _a1(loc[0], f"{_col_letter(15)}{loc[1]}"), "values": [[updates[rid]]]}
+                for rid, loc in locations.items() if loc
+            ]
+            if data:
+                with priority(HIGH):
+                    await self.client.values_batch_update(data, "update_cells")
+            logger.debug("sheets.update_cells cells=%s missing=%s", len(data), len(updates) - len(data))
+            return {rid: (True, None) if loc else (False, "ID not found") for rid, loc in locations.items()}
+        except Exception as e:
+            logger.exception("SHEETS ERROR update_messengers_by_ids")
+            return {rid: (False, str(e)) for rid in updates}
+
+    async def update_messenger_by_id(self, record_id: str, messenger: str) -> Tuple[bool, object]:
+        """
+        Находим строку по id (A) и пишем messenger в колонку O (по умолчанию 15).
+        Возвращает (True, result) или (False, error_str).
+        """
+        try:
+            with priority(HIGH):
+                loc = await self.locate_by_id(record_id)
+                if not loc:
+                    logger.warning("update_messenger_by_id: ID not found %s", record_id)
+                    return False, "ID not found"
+                # колонка O = 15 (1-based)
+                tab, row = loc
+                return await self.update_cell(row, 15, messenger, tab=tab)
+        except Exception:
+            logger.exception("SHEETS ERROR update_messenger_by_id")
+            return False, "internal error"
+
+
+def _build_targets() -> Dict[str, SheetsTarget]:
+    out = {DEFAULT: SheetsTarget(DEFAULT, SHEETS_ID, SHEET_NAME, SHEET_GID)}
+    if sheet_shards.enabled():
+        for cfg in sheet_shards.SHARDS.values():
+            out[cfg.name] = SheetsTarget(cfg.name, cfg.spreadsheet_id, cfg.sheet_name, cfg.gid, cfg.service_file)
+    return out
+
+
+# Шард -> таблица; основная — DEFAULT
+targets = _build_targets()
+
+
+async def append_rows_to_sheets(rows: List[list], shard: Optional[str] = None) -> Tuple[bool, object]:
+    """
+    Пишет пачку строк согласно SHEETS_LAYOUT. Возвращает (True, result) или (False, error_str).
+    shard=None — строки раскладываются по шардам (sheet_shards.shard_for_row) и пишутся параллельно;
+    ok только если записались все части.
+    """
+    if shard is not None:
+        return await targets[shard].append_rows(rows)
+    groups: Dict[str, List[list]] = {}
+    for values in rows:
+        groups.setdefault(sheet_shards.shard_for_row(values), []).append(values)
+    if len(groups) <= 1:
+        return await targets[next(iter(groups), DEFAULT)].append_rows(rows)
+    results = await asyncio.gather(*(targets[name].append_rows(group) for name, group in groups.items()))
+    for ok, result in results:
+        if not ok:
+            return False, result
+    return True, [result for _, result in results]
+
+
+async def append_row_to_sheets(values: list) -> Tuple[bool, object]:
+    """
+    Вставляет новую строку в начало листа (сразу после заголовка) и записывает туда values.
+    Возвращает (True, result) или (False, error_str).
+    """
+    return await append_rows_to_sheets([values])
+
+
+async def update_messengers_by_ids(updates: Dict[str, str], shard: Optional[str] = None) -> Dict[str, Tuple[bool, object]]:
+    """
+    Пишет messenger (колонка O) для многих id — по одному values.batchUpdate на шард.
+    Возвращает id -> (True, None) | (False, "ID not found") | (False, error_str).
+
+    shard=None — шард каждого id берётся из карты sheet_shards; id с неизвестным шардом
+    (записанные до шардирования или без Redis) ищутся в основной таблице, затем в остальных.
+    """
+    if shard is not None or len(targets) == 1:
+        return await targets[shard or DEFAULT].update_messengers(updates)
+    known = await sheet_shards.shards_of(list(updates))
+    groups: Dict[str, Dict[str, str]] = {}
+    for cid, name in known.items():
+        groups.setdefault(name or DEFAULT, {})[cid] = updates[cid]
+    results: Dict[str, Tuple[bool, object]] = {}
+    for part in await asyncio.gather(*(targets[name].update_messengers(g) for name, g in groups.items())):
+        results.update(part)
+
+    lost = {cid: updates[cid] for cid, name in known.items() if name is None and results[cid] == (False, "ID not found")}
+    for name, target in targets.items():
+        if not lost or name == DEFAULT:
+            continue
+        found = {cid: res for cid, res in (await target.update_messengers(lost)).items() if res[0]}
+        results.update(found)
+        await sheet_shards.remember(found, name)
+        for cid in found:
+            lost.pop(cid)
+    return results
 
-def update_cell(row_idx_1_based: int, col_idx_1_based: int, value: str) -> Tuple[bool, object]:
-    """Обновляет одну ячейку. Возвращает (True, result) или (False, error_str)."""
-    try:
-        rng = f"{SHEET_NAME}!{_col_letter(col_idx_1_based)}{row_idx_1_based}"
-        body = {"values": [[value]]}
-        result = sheet.values().update(
-            spreadsheetId=SHEETS_ID,
-            range=rng,
-            valueInputOption="RAW",
-            body=body,
-        ).execute()
-        logger.debug("sheets.update_cell %s = %s -> %s", rng, value, result)
-        return True, result
-    except Exception as e:
-        logger.exception("SHEETS ERROR update_cell")
-        return False, str(e)
-
-
-def update_messenger_by_id(record_id: str, messenger: str) -> Tuple[bool, object]:
+
+async def update_messenger_by_id(record_id: str, messenger: str) -> Tuple[bool, object]:
     """
-    Находим строку по id (A) и пишем messenger в колонку O (по умолчанию 15).
+    Находим строку по id (A) в шарде, куда он записан, и пишем messenger в колонку O.
     Возвращает (True, result) или (False, error_str).
     """
-    try:
-        row = find_row_by_id(record_id)
-        if not row:
-            logger.warning("update_messenger_by_id: ID not found %s", record_id)
-            return False, "ID not found"
-        # колонка O = 15 (1-based)
-        return update_cell(row, 15, messenger)
-    except Exception:
-        logger.exception("SHEETS ERROR update_messenger_by_id")
-        return False, "internal error"
+    shard = (await sheet_shards.shards_of([record_id]))[record_id]
+    return await targets[shard or DEFAULT].update_messenger_by_id(record_id, messenger)
+
+
+async def existing_ids() -> Set[str]:
+    """Все id из колонки A всех шардов."""
+    parts = await asyncio.gather(*(target.existing_ids() for target in targets.values()))
+    return set().union(*parts)
+
+
+async def warm_sheets() -> bool:
+    """
+    Прогрев при старте: токен сервисного аккаунта и keep-alive соединение к API каждого шарда
+    (один дешёвый GET метаданных). Ошибка не мешает старту — строки ждут в хранилище событий.
+    """
+    return all(await asyncio.gather(*(target.warm() for target in targets.values())))
+
+
+async def close_sheets() -> None:
+    await asyncio.gather(*(target.client.close() for target in targets.values()))
@@ -0,0 +1,199 @@
+# services/sheets_client.py
+"""
+Асинхронный клиент Google Sheets API v4 поверх общего httpx.AsyncClient.
+
+Вместо googleapiclient/httplib2: пул соединений с keep-alive и gzip, запросы собираются
+напрямую (без discovery-документа), httpx.AsyncClient безопасен для одновременных корутин.
+Токен сервисного аккаунта кэшируется и обновляется заранее, одним обновлением на всех.
+Каждый вызов проходит через services/sheets_scheduler: квоты чтения/записи, приоритет, повтор на 429.
+"""
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+import httpx
+
+from services.metrics import track, SHEETS_THROTTLED
+from services.sheets_scheduler import SheetsScheduler, scheduler as default_scheduler
+
+logger = logging.getLogger(__name__)
+
+SHEETS_API_ENDPOINT = os.getenv("SHEETS_API_ENDPOINT") or "https://sheets.googleapis.com/"
+SHEETS_HTTP_TIMEOUT = float(os.getenv("SHEETS_HTTP_TIMEOUT", "30"))
+SHEETS_MAX_CONNECTIONS = int(os.getenv("SHEETS_MAX_CONNECTIONS", "10"))
+SHEETS_MAX_KEEPALIVE = int(os.getenv("SHEETS_MAX_KEEPALIVE", "10"))
+# За сколько секунд до истечения обновлять токен
+TOKEN_REFRESH_MARGIN = 300
+
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+
+
+class SheetsApiError(Exception):
+    """Ответ Sheets API со статусом >= 400."""
+
+    def __init__(self, status: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(f"<SheetsApiError {status}: {message}>")
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+class _TokenSource:
+    """OAuth-токен сервисного аккаунта: кэш до (expiry - TOKEN_REFRESH_MARGIN), обновление в потоке."""
+
+    def __init__(self, service_file: Optional[str]):
+        self.service_file = service_file
+        self._credentials = None
+        self._lock = asyncio.Lock()
+
+    def _load(self):
+        from google.oauth2 import service_account
+
+        return service_account.Credentials.from_service_account_file(self.service_file, scopes=SCOPES)
+
+    def _fresh(self) -> bool:
+        c = self._credentials
+        if c is None or not c.token:
+            return False
+        if c.expiry is None:
+            return True
+        # expiry у google-auth — naive UTC
+        return (c.expiry - datetime.utcnow()).total_seconds() > TOKEN_REFRESH_MARGIN
+
+    def _refresh(self) -> None:
+        import google.auth.transport.requests
+
+        if self._credentials is None:
+            self._credentials = self._load()
+        self._credentials.refresh(google.auth.transport.requests.Request())
+
+    async def header(self) -> Dict[str, str]:
+        if not self.service_file:
+            return {}
+        if not self._fresh():
+            async with self._lock:
+                if not self._fresh():
+                    with track("sheets", "token_refresh"):
+                        await asyncio.to_thread(self._refresh)
+        return {"Authorization": f"Bearer {self._credentials.token}"}
+
+
+# Ключ сервисного аккаунта -> токен: клиенты разных таблиц с одним ключом обновляют его один раз
+_token_sources: Dict[str, _TokenSource] = {}
+
+
+def _token_source(service_file: Optional[str]) -> _TokenSource:
+    key = service_file or ""
+    if key not in _token_sources:
+        _token_sources[key] = _TokenSource(service_file)
+    return _token_sources[key]
+
+
+def _throttle_pause(exc: Exception) -> Optional[float]:
+    """Пауза из Retry-After (0.0 — заголовка нет), если это ответ 429; None для прочих ошибок."""
+    if isinstance(exc, SheetsApiError) and exc.status == 429:
+        return exc.retry_after or 0.0
+    return None
+
+
+def _retry_after(resp: httpx.Response) -> Optional[float]:
+    raw = resp.headers.get("Retry-After")
+    try:
+        return float(raw) if raw is not None else None
+    except ValueError:
+        return None
+
+
+class AsyncSheetsClient:
+    def __init__(self, spreadsheet_id: str, service_file: Optional[str] = None, endpoint: str = SHEETS_API_ENDPOINT,
+                 scheduler: SheetsScheduler = default_scheduler):
+        self.spreadsheet_id = spreadsheet_id
+        self.scheduler = scheduler
+        self.endpoint = endpoint.rstrip("/") + "/"
+        self._tokens = _token_source(service_file)
+        self._client: Optional[httpx.AsyncClient] = None
+        # Для /ready: время последнего успешного ответа и последняя ошибка (время, текст)
+        self.last_ok = 0.0
+        self.last_error: Optional[Tuple[float, str]] = None
+
+    def _http(self) -> httpx.AsyncClient:
+        # Создаём при первом вызове — уже внутри event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.endpoint,
+                timeout=SHEETS_HTTP_TIMEOUT,
+                limits=httpx.Limits(max_connections=SHEETS_MAX_CONNECTIONS, max_keepalive_connections=SHEETS_MAX_KEEPALIVE),
+                headers={"Accept-Encoding": "gzip", "User-Agent": "data-collection (gzip)"},
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _request(self, method: str, path: str, operation: str, **kwargs) -> dict:
+        # Квоты Sheets раздельные: чтение — GET, всё остальное — запись
+        kind = "read" if method == "GET" else "write"
+        return await self.scheduler.run(
+            kind, lambda: self._send(method, path, operation, **kwargs), _throttle_pause
+        )
+
+    async def _send(self, method: str, path: str, operation: str, **kwargs) -> dict:
+        try:
+            headers = await self._tokens.header()
+            with track("sheets", operation):
+                resp = await self._http().request(method, f"v4/spreadsheets/{self.spreadsheet_id}{path}",
+                                                  headers=headers, **kwargs)
+                if resp.status_code >= 400:
+                    if resp.status_code == 429:
+                        SHEETS_THROTTLED.inc(operation)
+                    try:
+                        message = resp.json().get("error", {}).get("message", resp.text)
+                    except ValueError:
+                        message = resp.text
+                    raise SheetsApiError(resp.status_code, message, _retry_after(resp))
+        except Exception as e:
+            self.last_error = (time.time(), str(e))
+            raise
+        self.last_ok = time.time()
+        return resp.json() if resp.content else {}
+
+    @staticmethod
+    def _range(a1: str) -> str:
+        return quote(a1, safe="")
+
+    # ── spreadsheets ────────────────────────────────────────────────────────
+    async def get(self, fields: str, operation: str = "get") -> dict:
+        return await self._request("GET", "", operation, params={"fields": fields})
+
+    async def batch_update(self, requests: List[dict], operation: str = "batch_update") -> dict:
+        return await self._request("POST", ":batchUpdate", operation, json={"requests": requests})
+
+    # ── spreadsheets.values ─────────────────────────────────────────────────
+    async def values_get(self, a1: str, operation: str = "values_get") -> dict:
+        return await self._request("GET", f"/values/{self._range(a1)}", operation)
+
+    async def values_batch_get(self, ranges: List[str], operation: str = "values_batch_get") -> dict:
+        return await self._request("GET", "/values:batchGet", operation, params=[("ranges", r) for r in ranges])
+
+    async def values_update(self, a1: str, values: List[list], operation: str = "values_update") -> dict:
+        return await self._request(
+            "PUT", f"/values/{self._range(a1)}", operation,
+            params={"valueInputOption": "RAW"}, json={"values": values},
+        )
+
+    async def values_batch_update(self, data: List[dict], operation: str = "values_batch_update") -> dict:
+        return await self._request(
+            "POST", "/values:batchUpdate", operation, json={"valueInputOption": "RAW", "data": data}
+        )
+
+    async def values_append(self, a1: str, values: List[list], operation: str = "values_append") -> dict:
+        return await self._request(
+            "POST", f"/values/{self._range(a1)}:append", operation,
+            params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"}, json={"values": values},
+        )
@@ -0,0 +1,200 @@
+# services/sheets_scheduler.py
+"""
+Планировщик вызовов Google Sheets API с учётом квот.
+
+У Sheets отдельные поминутные квоты на чтение и запись, поэтому два token bucket:
+"read" (GET) и "write" (всё остальное), размером по SHEETS_READ_QUOTA_PER_MIN /
+SHEETS_WRITE_QUOTA_PER_MIN. Вызов ждёт токен в очереди с приоритетом: обновления
+из колбэков бота (HIGH) идут раньше массовой дозаписи строк (LOW).
+
+На 429 скорость бакета уменьшается вдвое, бакет замирает до Retry-After, а вызов
+возвращается в очередь и повторяется — вместо ошибки. После успешных вызовов
+скорость постепенно возвращается к номиналу (AIMD).
+Очередь ограничена SHEETS_QUEUE_MAX: сверх неё вызывающие ждут места (обратное давление).
+"""
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+import contextvars
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from services.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+SHEETS_READ_QUOTA_PER_MIN = float(os.getenv("SHEETS_READ_QUOTA_PER_MIN", "60"))
+SHEETS_WRITE_QUOTA_PER_MIN = float(os.getenv("SHEETS_WRITE_QUOTA_PER_MIN", "60"))
+SHEETS_QUOTA_BURST = int(os.getenv("SHEETS_QUOTA_BURST", "5"))
+SHEETS_QUEUE_MAX = int(os.getenv("SHEETS_QUEUE_MAX", "1000"))
+SHEETS_QUOTA_MAX_RETRIES = int(os.getenv("SHEETS_QUOTA_MAX_RETRIES", "10"))
+# Пауза после 429 без Retry-After (с)
+SHEETS_QUOTA_DEFAULT_BACKOFF = float(os.getenv("SHEETS_QUOTA_DEFAULT_BACKOFF", "10"))
+
+HIGH, NORMAL, LOW = 0, 1, 2
+
+T = TypeVar("T")
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("sheets_priority", default=NORMAL)
+
+
+@contextmanager
+def priority(level: int):
+    """Все вызовы Sheets внутри блока (включая вложенные корутины) идут с этим приоритетом."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """Бакет с адаптивной скоростью: rate падает вдвое на 429 и растёт на 10% номинала за успех."""
+
+    def __init__(self, name: str, per_minute: float, burst: int):
+        self.name = name
+        self.nominal = max(per_minute, 1.0) / 60.0
+        self.rate = self.nominal
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """0, если токен есть (и он списан), иначе сколько секунд ждать следующего."""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def throttled(self, retry_after: Optional[float]) -> None:
+        now = time.monotonic()
+        self.rate = max(self.nominal / 16, self.rate / 2)
+        self.tokens = 0.0
+        self.updated = now
+        self.paused_until = max(self.paused_until, now + (retry_after or SHEETS_QUOTA_DEFAULT_BACKOFF))
+        logger.warning("sheets_quota_throttled", extra={
+            "bucket": self.name, "rate_per_min": round(self.rate * 60, 1), "pause": retry_after,
+        })
+
+    def succeeded(self) -> None:
+        if self.rate < self.nominal:
+            self.rate = min(self.nominal, self.rate + self.nominal * 0.1)
+
+
+class SheetsScheduler:
+    def __init__(self, read_per_min: float = SHEETS_READ_QUOTA_PER_MIN,
+                 write_per_min: float = SHEETS_WRITE_QUOTA_PER_MIN,
+                 burst: int = SHEETS_QUOTA_BURST, max_queue: int = SHEETS_QUEUE_MAX):
+        self.buckets: Dict[str, TokenBucket] = {
+            "read": TokenBucket("read", read_per_min, burst),
+            "write": TokenBucket("write", write_per_min, burst),
+        }
+        self.max_queue = max(1, max_queue)
+        # kind -> heap (priority, порядок, future)
+        self._queues: Dict[str, List[Tuple[int, int, asyncio.Future]]] = {"read": [], "write": []}
+        self._timers: Dict[str, Optional[asyncio.TimerHandle]] = {"read": None, "write": None}
+        self._order = itertools.count()
+        self._space: Optional[asyncio.Semaphore] = None
+        self.stats: Dict[str, int] = {"calls": 0, "throttled": 0, "retried": 0, "gave_up": 0}
+
+    def queued(self, kind: str) -> int:
+        return sum(1 for _, _, fut in self._queues[kind] if not fut.done())
+
+    async def run(self, kind: str, call: Callable[[], Awaitable[T]], is_throttle: Callable[[Exception], Optional[float]]) -> T:
+        """
+        Выполняет call(), дождавшись токена бакета `kind`. is_throttle(exc) возвращает
+        паузу из Retry-After (или 0.0), если исключение — ответ 429, иначе None.
+        """
+        if self._space is None:
+            self._space = asyncio.Semaphore(self.max_queue)
+        level = _priority.get()
+        bucket = self.buckets[kind]
+        attempt = 0
+        async with self._space:
+            while True:
+                await self._acquire(kind, level)
+                self.stats["calls"] += 1
+                try:
+                    result = await call()
+                except Exception as e:
+                    pause = is_throttle(e)
+                    if pause is None:
+                        raise
+                    self.stats["throttled"] += 1
+                    bucket.throttled(pause or None)
+                    attempt += 1
+                    if attempt > SHEETS_QUOTA_MAX_RETRIES:
+                        self.stats["gave_up"] += 1
+                        raise
+                    self.stats["retried"] += 1
+                    # Повтор — с тем же приоритетом, но в конец своей очереди
+                    continue
+                bucket.succeeded()
+                return result
+
+    async def _acquire(self, kind: str, level: int) -> None:
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queues[kind], (level, next(self._order), fut))
+        self._pump(kind)
+        await fut
+
+    def _pump(self, kind: str) -> None:
+        """Раздаёт токены ожидающим по приоритету; если токенов нет — взводит таймер до следующего."""
+        timer = self._timers[kind]
+        if timer is not None:
+            timer.cancel()
+            self._timers[kind] = None
+        queue, bucket = self._queues[kind], self.buckets[kind]
+        while queue:
+            if queue[0][2].done():
+                heapq.heappop(queue)
+                continue
+            wait = bucket.wait_time()
+            if wait > 0:
+                self._timers[kind] = asyncio.get_running_loop().call_later(wait, self._pump, kind)
+                return
+            _, _, fut = heapq.heappop(queue)
+            fut.set_result(None)
+
+
+scheduler = SheetsScheduler()
+# Квоты Sheets считаются на проект сервисного аккаунта, поэтому планировщик — один на ключ:
+# таблицы (шарды, services/sheet_shards) с одним ключом делят его, с отдельным ключом — получают свой
+schedulers: Dict[str, SheetsScheduler] = {"default": scheduler}
+
+
+def for_credential(service_file: Optional[str]) -> SheetsScheduler:
+    """Планировщик ключа сервисного аккаунта; None — ключ основной таблицы."""
+    if not service_file:
+        return scheduler
+    # Полный путь: одноимённые ключи разных шардов (/a/key.json, /b/key.json) — разные квоты
+    name = os.path.realpath(service_file)
+    if name not in schedulers:
+        schedulers[name] = SheetsScheduler()
+    return schedulers[name]
+
+
+SHEETS_QUEUED = registry.gauge("sheets_scheduler_queued", "Sheets calls waiting for a quota token", ("bucket", "credential"))
+SHEETS_RATE = registry.gauge("sheets_scheduler_rate_per_minute", "Current adaptive Sheets call rate", ("bucket", "credential"))
+
+
+def _collect_metrics() -> None:
+    for credential, sched in schedulers.items():
+        for kind, bucket in sched.buckets.items():
+            SHEETS_QUEUED.set(sched.queued(kind), kind, credential)
+            SHEETS_RATE.set(round(bucket.rate * 60, 2), kind, credential)
+
+
+registry.add_collector(_collect_metrics)
@@ -0,0 +1,224 @@
+# services/sheets_writer.py
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from services import analytics, sheet_shards
+from services.sheets import append_rows_to_sheets, update_messengers_by_ids
+from services.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_ROWS = int(os.getenv("SHEETS_BATCH_MAX_ROWS", "50"))
+BATCH_MAX_DELAY_MS = int(os.getenv("SHEETS_BATCH_MAX_DELAY_MS", "500"))
+UPDATE_BATCH_MAX_CELLS = int(os.getenv("SHEETS_UPDATE_BATCH_MAX_CELLS", "100"))
+UPDATE_BATCH_MAX_DELAY_MS = int(os.getenv("SHEETS_UPDATE_BATCH_MAX_DELAY_MS", "300"))
+
+
+class SheetsBatchWriter:
+    """
+    Буферизующий писатель строк в Google Sheets.
+
+    submit() кладёт строку в буфер и возвращает future с (ok, result) именно для этой строки.
+    Буфер сбрасывается одним batchUpdate, когда набралось `max_rows` строк
+    или с момента первой строки в буфере прошло `max_delay_ms`.
+    """
+
+    def __init__(self, max_rows: int = BATCH_MAX_ROWS, max_delay_ms: int = BATCH_MAX_DELAY_MS):
+        self.max_rows = max(1, max_rows)
+        self.max_delay = max(0, max_delay_ms) / 1000.0
+        self._pending: List[Tuple[list, str, str, asyncio.Future]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+        self._closing = False
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="sheets-batch-writer")
+        logger.info("sheets_writer_started", extra={"max_rows": self.max_rows, "max_delay_ms": int(self.max_delay * 1000)})
+
+    async def stop(self) -> None:
+        """Останавливает цикл и дописывает всё, что осталось в буфере."""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        logger.info("sheets_writer_stopped")
+
+    def submit(self, values: list, click_id: str, event: str) -> "asyncio.Future[Tuple[bool, object]]":
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((values, click_id, event, fut))
+        if self._task is None:
+            # Писатель не запущен (например, вне lifespan) — пишем сразу одной пачкой
+            task = asyncio.ensure_future(self._flush(self._take()))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+        elif len(self._pending) >= self.max_rows or len(self._pending) == 1:
+            self._wakeup.set()
+        return fut
+
+    def _take(self) -> List[Tuple[list, str, str, asyncio.Future]]:
+        batch = self._pending[: self.max_rows]
+        del self._pending[: len(batch)]
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            if not self._pending:
+                if self._closing:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            # Ждём добора пачки, но не дольше max_delay с момента появления первой строки
+            deadline = time.monotonic() + self.max_delay
+            while len(self._pending) < self.max_rows and not self._closing:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            await self._flush(self._take())
+
+    async def _flush(self, batch: List[Tuple[list, str, str, asyncio.Future]]) -> None:
+        if not batch:
+            return
+        # Части пачки для разных таблиц (services/sheet_shards) пишутся параллельно,
+        # и каждая строка получает результат своей части
+        groups: Dict[str, List[Tuple[list, str, str, asyncio.Future]]] = {}
+        for item in batch:
+            groups.setdefault(sheet_shards.shard_for_row(item[0]), []).append(item)
+        await asyncio.gather(*(self._flush_shard(shard, items) for shard, items in groups.items()))
+
+    async def _flush_shard(self, shard: str, batch: List[Tuple[list, str, str, asyncio.Future]]) -> None:
+        rows = [values for values, _, _, _ in batch]
+        try:
+            ok, result = await append_rows_to_sheets(rows, shard=shard)
+        except Exception as e:
+            logger.exception("sheets_batch_exception", extra={"rows": len(rows), "shard": shard})
+            ok, result = False, str(e)
+
+        if ok:
+            logger.debug("sheets_batch_ok", extra={"rows": len(rows), "shard": shard})
+        else:
+            logger.error("sheets_batch_fail", extra={"rows": len(rows), "shard": shard, "error": str(result)})
+
+        for _, _, _, fut in batch:
+            if not fut.done():
+                fut.set_result((ok, result))
+
+
+class MessengerUpdateBatcher:
+    """
+    Очередь обновлений колонки O (messenger) по click_id.
+
+    submit() возвращает future с (ok, result) для своего id; ожидающие обновления
+    сливаются (для одного id побеждает последнее значение) и уходят одним
+    values.batchUpdate, когда набралось `max_cells` ячеек или прошло `max_delay_ms`.
+    """
+
+    def __init__(self, max_cells: int = UPDATE_BATCH_MAX_CELLS, max_delay_ms: int = UPDATE_BATCH_MAX_DELAY_MS):
+        self.max_cells = max(1, max_cells)
+        self.max_delay = max(0, max_delay_ms) / 1000.0
+        # click_id -> (messenger, futures всех, кто ждёт этот id)
+        self._pending: Dict[str, Tuple[str, List[asyncio.Future]]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+        self._closing = False
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="sheets-messenger-updates")
+
+    async def stop(self) -> None:
+        """Дописывает всё, что уже поставлено в очередь."""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    def submit(self, click_id: str, messenger: str) -> "asyncio.Future[Tuple[bool, object]]":
+        fut = asyncio.get_running_loop().create_future()
+        _, futs = self._pending.get(click_id, (messenger, []))
+        futs.append(fut)
+        self._pending[click_id] = (messenger, futs)
+        if self._task is None:
+            task = asyncio.ensure_future(self._flush(self._take()))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+        elif len(self._pending) >= self.max_cells or len(self._pending) == 1:
+            self._wakeup.set()
+        return fut
+
+    def _take(self) -> Dict[str, Tuple[str, List[asyncio.Future]]]:
+        ids = list(self._pending)[: self.max_cells]
+        return {cid: self._pending.pop(cid) for cid in ids}
+
+    async def _run(self) -> None:
+        while True:
+            if not self._pending:
+                if self._closing:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            deadline = time.monotonic() + self.max_delay
+            while len(self._pending) < self.max_cells and not self._closing:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            await self._flush(self._take())
+
+    async def _flush(self, batch: Dict[str, Tuple[str, List[asyncio.Future]]]) -> None:
+        if not batch:
+            return
+        updates = {cid: messenger for cid, (messenger, _) in batch.items()}
+        try:
+            results = await update_messengers_by_ids(updates)
+        except Exception as e:
+            logger.exception("sheets_updates_exception", extra={"cells": len(updates)})
+            results = {cid: (False, str(e)) for cid in updates}
+
+        failed = sum(1 for ok, _ in results.values() if not ok)
+        logger.debug("sheets_updates_flushed", extra={"cells": len(updates), "failed": failed})
+        # Контакт подтверждён, только когда messenger реально записан в лист
+        analytics.record_contacts([cid for cid, (ok, _) in results.items() if ok])
+        for cid, (_, futs) in batch.items():
+            for fut in futs:
+                if not fut.done():
+                    fut.set_result(results.get(cid, (False, "internal error")))
+
+
+writer = SheetsBatchWriter()
+messenger_updates = MessengerUpdateBatcher()
+
+SHEETS_BUFFER = registry.gauge("sheets_writer_buffered_rows", "Rows waiting in the Sheets batch buffer")
+registry.add_collector(lambda: SHEETS_BUFFER.set(len(writer._pending)))
+SHEETS_UPDATES_BUFFER = registry.gauge("sheets_messenger_updates_pending", "Messenger cell updates waiting for a batch")
+registry.add_collector(lambda: SHEETS_UPDATES_BUFFER.set(len(messenger_updates._pending)))
@@ -0,0 +1,110 @@
+# services/tracing.py
+"""
+Лёгкая трассировка запросов по этапам.
+
+TracingMiddleware заводит на каждый HTTP-запрос Trace в contextvar; span("name") и каждый
+metrics.track(...) (Redis, Sheets, Planfix, ...) добавляют в него этап со смещением
+и длительностью. Задачи, созданные внутри запроса (asyncio.gather, create_task), пишут
+в тот же Trace. Запросы дольше TRACE_SLOW_MS логируются одной записью slow_request
+с click_id и полной раскладкой этапов. Вне запроса span() ничего не делает.
+"""
+import os
+import time
+import uuid
+import logging
+import contextvars
+from contextlib import contextmanager
+from typing import Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") not in ("0", "false", "no")
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "500"))
+# Не больше стольких этапов на запрос (защита от циклов внутри запроса)
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "200"))
+
+
+class Trace:
+    __slots__ = ("trace_id", "method", "path", "started", "click_id", "spans")
+
+    def __init__(self, method: str, path: str):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.click_id: Optional[str] = None
+        # (этап, смещение от начала запроса, длительность) в секундах
+        self.spans: List[Tuple[str, float, float]] = []
+
+    def breakdown(self) -> List[dict]:
+        return [
+            {"span": name, "at_ms": round(offset * 1000, 2), "ms": round(duration * 1000, 2)}
+            for name, offset, duration in sorted(self.spans, key=lambda s: s[1])
+        ]
+
+
+_current: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("trace", default=None)
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+
+def record_span(name: str, started: float, duration: float) -> None:
+    """Добавляет этап, замеренный снаружи (started — по time.perf_counter())."""
+    trace = _current.get()
+    if trace is not None and len(trace.spans) < TRACE_MAX_SPANS:
+        trace.spans.append((name, started - trace.started, duration))
+
+
+@contextmanager
+def span(name: str):
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, started, time.perf_counter() - started)
+
+
+def set_click_id(click_id: str) -> None:
+    trace = _current.get()
+    if trace is not None:
+        trace.click_id = click_id
+
+
+class TracingMiddleware:
+    """ASGI-middleware: Trace на запрос и slow_request-лог для медленных."""
+
+    def __init__(self, app, skip: Iterable[str] = ("/metrics", "/health", "/ready")):
+        self.app = app
+        self.skip = set(skip)
+
+    async def __call__(self, scope, receive, send):
+        if not TRACE_ENABLED or scope["type"] != "http" or scope.get("path") in self.skip:
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(scope.get("method", ""), scope.get("path", ""))
+        status_holder = {"status": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status_holder["status"] = message["status"]
+            await send(message)
+
+        token = _current.set(trace)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            elapsed_ms = (time.perf_counter() - trace.started) * 1000
+            if elapsed_ms >= TRACE_SLOW_MS:
+                logger.warning("slow_request", extra={
+                    "trace_id": trace.trace_id, "method": trace.method, "path": trace.path,
+                    "status": status_holder["status"], "ms": round(elapsed_ms, 1),
+                    "click_id": trace.click_id, "spans": trace.breakdown(),
+                })
@@ -0,0 +1,60 @@
+# worker.py
+"""
+Воркер доставки для DELIVERY_MODE=stream: читает Redis Stream (services/delivery_stream)
+и пишет строки и messenger в Google Sheets, лиды — в Planfix.
+
+Запуск рядом с uvicorn, сколько угодно экземпляров (все в одной группе потребителей):
+    DELIVERY_MODE=stream python worker.py
+    DELIVERY_MODE=stream python worker.py --consumer delivery-2
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+import logging
+from services.logging import setup_logging
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+import signal
+import asyncio
+import argparse
+from typing import List, Optional
+
+from services.delivery_stream import DeliveryConsumer
+from services.geoip import init_geoip
+from services.planfix import init_planfix, close_planfix
+from services.redis_client import init_redis, close_redis
+from services.sheets import close_sheets, warm_sheets
+
+
+async def run(consumer_name: Optional[str]) -> None:
+    await asyncio.gather(
+        asyncio.to_thread(init_redis, logger),
+        asyncio.to_thread(init_geoip, logger),
+        init_planfix(),
+        warm_sheets(),
+    )
+    consumer = DeliveryConsumer(consumer_name)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        # Текущая пачка дописывается и подтверждается, неподтверждённое заберут другие воркеры
+        loop.add_signal_handler(sig, consumer.stop)
+    try:
+        await consumer.run()
+    finally:
+        await close_sheets()
+        await close_planfix()
+        await close_redis()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Delivery worker: Redis Stream -> Google Sheets / Planfix")
+    ap.add_argument("--consumer", help="consumer name in the group (default: host:pid)")
+    args = ap.parse_args(argv)
+    asyncio.run(run(args.consumer))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())